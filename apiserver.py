@@ -3,6 +3,7 @@
 import datetime
 import json
 import os
+import time
 from uuid import uuid4
 
 from flask import Flask, abort, jsonify, request, make_response
@@ -19,14 +20,16 @@ from pyfiles.constants import (
     MAX_LOCATION_ACTIVITY_INTERVAL_MS,
     int_activities)
 
-from pyfiles.database_interface import (init_db, users_table_insert, users_table_update, devices_table_insert, device_data_table_insert,
+from pyfiles.database_interface import (init_db, users_table_insert, users_table_update, devices_table_insert, device_data_table_copy, device_data_copy_columns,
                                         device_location_table_insert, device_activity_table_insert, verify_user_id, update_last_activity,
                                         update_messaging_token, get_device_table_id, get_device_table_id_for_session, get_users_table_id,
                                         get_session_token_for_device, get_user_id_from_device_id, activity_types, client_log_table_insert,
-                                        get_svg)
+                                        get_svg, point_ewkb_hex)
 
 from pyfiles.server_common import common_setlegmode, common_path
 
+from pyfiles.ingest_spool import IngestSpool, SpoolFull
+
 
 from pyfiles.authentication_helper import user_hash, authenticate_with_google_oauth
 
@@ -65,6 +68,20 @@ else:
 
 db, store = init_db(app)
 
+# Optional write-behind spool for data uploads
+ingest_spool = None
+if app.config.get('INGEST_SPOOL_DIR'):
+    ingest_spool = IngestSpool(
+        app.config['INGEST_SPOOL_DIR'],
+        app.config.get('INGEST_SPOOL_MAX_BYTES', 1 << 30),
+        app.config.get('INGEST_SPOOL_FLUSH_SECONDS', 2.0))
+
+    @app.before_first_request
+    def start_ingest_spool():
+        # Also replays segments left over from before a restart
+        ingest_spool.start()
+
+
 # REST interface:
 
 @app.route('/register', methods=['POST'])
@@ -202,18 +219,13 @@ def data_post():
     data_points = request.json['dataPoints']
 
     # Remember, if a single point fails, the whole batch fails
-    batch_size = 1024
-
-    def batch_chunks(x):
-        for i in range(0, len(x), batch_size):
-            yield x[i:i + batch_size]
-
     def prepare_point(point):
         location = point['location']
 
         result = {
             'device_id': device_id,
-            'coordinate': 'POINT(%f %f)' % (float(location['longitude']), float(location['latitude'])),
+            'coordinate': point_ewkb_hex(
+                float(location['longitude']), float(location['latitude'])),
             'accuracy': float(location['accuracy']),
             'time': datetime.datetime.fromtimestamp(int(point['time']) / 1000.0)
         }
@@ -256,9 +268,30 @@ def data_post():
                 result['activity_3_conf'] = 0
         return result
 
-    for chunk in batch_chunks(data_points):
-        batch = [prepare_point(x) for x in chunk]
-        device_data_table_insert(batch)
+    # Points of a time already in the batch would be skipped on insert
+    batch = []
+    times = set()
+    for point in map(prepare_point, data_points):
+        if point['time'] not in times:
+            times.add(point['time'])
+            batch.append(point)
+
+    # Acknowledge once durably spooled if configured, or write synchronously
+    # when the spool is backed up
+    if ingest_spool is not None:
+        try:
+            ingest_spool.append([
+                [x.get(c) for c in device_data_copy_columns] for x in batch])
+            return jsonify({
+            })
+        except SpoolFull:
+            print("data_post: spool full, writing synchronously")
+
+    t0 = time.time()
+    count = device_data_table_copy(batch)
+    seconds = time.time() - t0
+    print("data_post: device %d, %d points in %.3fs, %.0f rows/s" % (
+        device_id, count, seconds, count / seconds if seconds else 0))
     return jsonify({
     })
 
@@ -375,14 +408,17 @@ def device(session_token):
 @app.route('/path/<session_token>')
 def path(session_token):
     devices_table_id = get_device_table_id_for_session(session_token)
+    user_id = get_user_id_from_device_id(devices_table_id)
     client_log_table_insert(
         devices_table_id,
-        get_user_id_from_device_id(devices_table_id),
+        user_id,
         "MOBILE-PATH",
         request.args.get("date"))
     devices = db.metadata.tables["devices"]
     where = devices.c.token == session_token
-    return common_path(request, db, where)
+    if user_id is None or user_id < 0:
+        return common_path(request, db, where)
+    return common_path(request, db, where, user_id, devices_table_id)
 
 
 @app.route('/setlegmode', methods=['POST'])
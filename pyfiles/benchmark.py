@@ -0,0 +1,654 @@
+"""Micro-benchmarks comparing optimized trace and clustering helpers against
+the original implementations on synthetic data, checking the results match.
+
+    python -m pyfiles.benchmark cluster [nstops]
+    python -m pyfiles.benchmark simplify [npoints]
+    python -m pyfiles.benchmark hfp [recording]
+    python -m pyfiles.benchmark zip [npoints]
+    python -m pyfiles.benchmark places [nends]
+    python -m pyfiles.benchmark snapping [npoints]
+    python -m pyfiles.benchmark stabilizer [npoints]
+
+An HFP recording has a topic and payload per line, as output by
+mosquitto_sub -v -t '/hfp/v2/journey/ongoing/vp/#'. It is replayed at ten
+times real time; without one, a synthetic feed is generated.
+
+The zip benchmark streams a synthetic device_data export as
+common_download_zip does, and builds it in memory as before for a tenth of
+the points at most, reporting throughput and peak memory of each.
+
+The places benchmark clusters synthetic leg ends with cluster_places, and
+for up to 20000 of them one at a time as the places triggers do, reporting
+how many leg ends end up in a different place.
+
+The stabilizer benchmark checks window_best_activities, from rows and from a
+Trace, against the Counter based implementation it replaced.
+
+The snapping benchmark snaps synthetic points to synthetic roads with
+RoadSnapper, checking the first 200 against the nearest road and
+waypoint found by going through all of them.
+"""
+
+import json
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+from collections import Counter
+from csv import DictWriter
+from datetime import datetime, timedelta
+from heapq import heapify, heappop
+from io import StringIO
+
+import pyfiles.common_helpers as common_helpers
+
+from pyfiles.activity_stabilizer import (
+    GOOD_ACTIVITIES, NOT_SET, ON_FOOT_ACTIVITIES, window_best_activities)
+from pyfiles.constants import ACTIVITY_WIN
+from pyfiles.leg_ends_clusterer import LegEndsClusterer
+from pyfiles.places_clusterer import cluster_places, match_places
+from pyfiles.road_snapper import RoadSnapper
+from pyfiles.trace import ACTIVITY_COLUMNS, CONF_COLUMNS, Trace
+from pyfiles.vehicle_buffer import VehicleBuffer, hfp_vehicle_row
+from pyfiles.zip_stream import csv_chunks, zip_stream
+
+
+def synthetic_stops(n, seed=0):
+    """Stops scattered around n / 20 places in the Helsinki region."""
+    random.seed(seed)
+    places = [
+        (24.6 + .8 * random.random(), 60.1 + .3 * random.random())
+        for _ in range(n // 20 + 1)]
+    t = datetime(2017, 1, 1)
+    stops = []
+    for i in range(n):
+        lon, lat = random.choice(places)
+        t += timedelta(hours=3)
+        stops.append({
+            "coordinates": (
+                lon + random.gauss(0, .0015), lat + random.gauss(0, .0008)),
+            "time_start": t,
+            "time_end": t + timedelta(hours=1)})
+    return stops
+
+
+def synthetic_routes(n, seed=0):
+    """Route prototypes as in routes.get_routes, variations of n / 10
+    routes over a grid of waypoints."""
+    random.seed(seed)
+    bases = [
+        [(random.randrange(50), random.randrange(50)) for _ in range(30)]
+        for _ in range(n // 10 + 1)]
+    return [
+        {   "probs": Counter({
+                p: 1 for p in random.choice(bases) if random.random() < .8}),
+            "trips": [i]}
+        for i in range(n)]
+
+
+def synthetic_trace(n, seed=0):
+    """Device data rows of a random walk at one to ten second intervals."""
+    random.seed(seed)
+    lon, lat = 24.9, 60.2
+    t = datetime(2017, 1, 1)
+    activity = "WALKING"
+    rows = []
+    for i in range(n):
+        t += timedelta(seconds=random.randint(1, 10))
+        lon += random.gauss(0, 1e-4)
+        lat += random.gauss(0, 5e-5)
+        if random.random() < .002:
+            activity = random.choice(("WALKING", "IN_VEHICLE", "ON_BICYCLE"))
+        rows.append({
+            "geojson": json.dumps({
+                "type": "Point", "coordinates": [round(lon, 9), round(lat, 9)]}),
+            "time": t,
+            "activity": activity})
+    return rows
+
+
+def simplify_heapify(points, metric, maxpts=None, minmetric=None):
+    """The linked list and full heapify per removal simplify, for reference.
+    Heap entries carry the position to break ties, which the original would
+    fail to compare."""
+
+    class Dll:
+        def __init__(self, value, before=None, after=None):
+            self.value = value
+            self.before = before
+            self.after = after
+        def unlink(self):
+            if self.before:
+                self.before.after = self.after
+            if self.after:
+                self.after.before = self.before
+
+    def node_metric(node):
+        return metric(node.before.value, node.value, node.after.value)
+
+    linked = [Dll(x) for x in points]
+    for i in range(1, len(linked)):
+        linked[i].before = linked[i-1]
+    for i in range(len(linked) - 1):
+        linked[i].after = linked[i+1]
+
+    heap = [
+        [node_metric(node), i, node] for i, node in enumerate(linked[1:-1], 1)]
+    for node, heap_entry in zip(linked[1:-1], heap):
+        node.heap_entry = heap_entry
+    heapify(heap)
+
+    while heap:
+        m, _, node = heappop(heap)
+        if ((not maxpts or len(heap) <= maxpts - 3)
+                and (not minmetric or m > minmetric)):
+            break
+        node.unlink()
+        for neighbor in node.before, node.after:
+            if hasattr(neighbor, "heap_entry"):
+                neighbor.heap_entry[0] = node_metric(neighbor)
+        heapify(heap)
+
+    node = linked[0]
+    rv = []
+    while node:
+        rv.append(node.value)
+        node = node.after
+    return rv
+
+
+def simplify_geometry_parsing(
+        points, maxpts=None, mindist=None, interpolate=False,
+        keep_activity=False):
+    """The simplify_geometry parsing and projecting coordinates on every metric
+    evaluation, for reference."""
+
+    points = list(points)
+    if (not points or not mindist and (not maxpts or len(points) <= maxpts)):
+        return points
+
+    ballpark = json.loads(points[0]['geojson'])['coordinates']
+    projector = common_helpers.Equirectangular(*ballpark)
+
+    def distance_point_lineseg(p, l, par=None):
+        dim = list(range(len(p)))
+        p_l0 = [p[i] - l[0][i] for i in dim]
+        l1_l0 = [l[1][i] - l[0][i] for i in dim]
+        dot = sum(a * b for a, b in zip(p_l0, l1_l0))
+        lsq = sum(a * a for a in l1_l0)
+        if par is None:
+            par = max(0, min(1, lsq and dot / lsq))
+        ref = [l[0][i] + par * l1_l0[i] for i in dim]
+        p_ref = [p[i] - ref[i] for i in dim]
+        return sum(p_ref[i]**2 for i in dim)**.5
+
+    def linedist(p0, p1, p2):
+        m0, m1, m2 = (
+            projector.d2m(*json.loads(x['geojson'])['coordinates'])
+            for x in (p0, p1, p2))
+        return distance_point_lineseg(m1, (m0, m2))
+
+    def timedist(p0, p1, p2):
+        m0, m1, m2 = (
+            projector.d2m(*json.loads(x['geojson'])['coordinates'])
+            for x in (p0, p1, p2))
+        fraction = (common_helpers.point_interval(p0, p1)
+            / common_helpers.point_interval(p0, p2))
+        return distance_point_lineseg(m1, (m0, m2), fraction)
+
+    dist = interpolate and timedist or linedist
+
+    def keeping_activity(p0, p1, p2):
+        changes = p1["activity"] != p2["activity"]
+        moved = common_helpers.point_distance(p0, p1) > mindist
+        return (changes and moved, dist(p0, p1, p2))
+
+    metric = keep_activity and keeping_activity or dist
+    minmetric = keep_activity and (False, mindist) or mindist
+
+    return simplify_heapify(points, metric, maxpts, minmetric)
+
+
+def synthetic_hfp(nvehicles=1500, seconds=120, seed=0):
+    """HFP v2 messages of vehicles reporting each second, with occasional
+    resends, as (seconds, topic, payload) in time order."""
+    random.seed(seed)
+    modes = ("bus", "tram", "train", "metro")
+    vehicles = [
+        (random.choice(modes), random.randrange(10, 60), i,
+            str(random.randrange(1, 600)), 24.6 + .8 * random.random(),
+            60.1 + .3 * random.random())
+        for i in range(nvehicles)]
+    tsi0 = 1534101301
+    messages = []
+    for second in range(seconds):
+        for mode, oper, veh, desi, lon, lat in vehicles:
+            topic = "/hfp/v2/journey/ongoing/vp/%s/%04d/%05d/x/1/x/x/x/3/x" % (
+                mode, oper, veh)
+            payload = json.dumps({"VP": {
+                "desi": desi, "dir": "1", "oper": oper, "veh": veh,
+                "tsi": tsi0 + second, "lat": lat, "long": lon}}).encode("utf8")
+            messages.append((second, topic, payload))
+            if random.random() < .03:
+                messages.append((second, topic, payload))
+    return messages
+
+
+def read_hfp(path):
+    """Recorded HFP messages as (seconds, topic, payload)."""
+    messages = []
+    with open(path, "rb") as f:
+        for line in f:
+            topic, _, payload = line.rstrip(b"\n").partition(b" ")
+            try:
+                tsi = json.loads(payload.decode("utf8"))["VP"]["tsi"]
+            except (ValueError, KeyError, TypeError):
+                continue
+            messages.append((tsi, topic.decode("utf8"), payload))
+    messages.sort(key=lambda x: x[0])
+    return messages
+
+
+class ListScanBuffer:
+    """The list and linear duplicate scan of scheduler.handle_mass_transit,
+    for reference."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = []
+
+    def add(self, row):
+        for old in self.rows:
+            if (old['time'] == row['time']
+                    and old['vehicle_ref'] == row['vehicle_ref']):
+                return False
+        with self.lock:
+            self.rows.append(row)
+        return True
+
+    def take(self):
+        with self.lock:
+            rows = self.rows
+            self.rows = []
+        return rows
+
+
+def replay_hfp(messages, buf, speed=10, interval=15):
+    """Feed messages to buffer paced at speed times real time, taking rows
+    every interval seconds of feed time on another thread as
+    retrieve_hsl_data does. Returns handling seconds, worst single message
+    seconds, lag behind schedule at end, and rows taken."""
+
+    taken = []
+    done = threading.Event()
+    def flusher():
+        while not done.wait(interval / speed):
+            taken.append(len(buf.take()))
+    thread = threading.Thread(target=flusher)
+    thread.start()
+
+    t0 = messages[0][0]
+    start = time.time()
+    busy = worst = 0
+    for second, topic, payload in messages:
+        delay = start + (second - t0) / speed - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        m0 = time.time()
+        row = hfp_vehicle_row(topic, payload)
+        if row is not None:
+            buf.add(row)
+        m1 = time.time()
+        busy += m1 - m0
+        worst = max(worst, m1 - m0)
+    lag = time.time() - (start + (messages[-1][0] - t0) / speed)
+
+    done.set()
+    thread.join()
+    taken.append(len(buf.take()))
+    return busy, worst, lag, sum(taken)
+
+
+def timed(fun, *args):
+    t0 = time.time()
+    rv = fun(*args)
+    return rv, time.time() - t0
+
+
+def bench_cluster(n):
+    def visits(groups):
+        return sorted(sorted(v["time_start"] for v in g["visits"]) for g in groups)
+
+    stops = synthetic_stops(n)
+    for indexed in (True, False):
+        common_helpers.CLUSTER_INDEXED = indexed
+        groups, seconds = timed(common_helpers.stop_clusters, stops, 200)
+        print("stop_clusters %d stops, %s: %d clusters in %.2fs" % (
+            n, indexed and "grid index" or "exhaustive", len(groups), seconds))
+        if indexed:
+            reference = visits(groups)
+        elif visits(groups) != reference:
+            print("MISMATCH")
+
+    def route_merge(*routes):
+        total = 0
+        weights = Counter()
+        for route in routes:
+            trips = len(route["trips"])
+            total += trips
+            for point, prob in route["probs"].items():
+                weights[point] += trips * prob
+        return {
+            "probs": {p: 1.0*c/total for p, c in weights.items()},
+            "trips": sum((x["trips"] for x in routes), [])}
+
+    def proto_distance(p0, p1):
+        p0, p1 = p0["probs"], p1["probs"]
+        keys = set(list(p0.keys()) + list(p1.keys()))
+        union = sum(max(p0.get(x, 0), p1.get(x, 0)) for x in keys)
+        intersection = sum(min(p0.get(x, 0), p1.get(x, 0)) for x in keys)
+        return 1.0 - 1.0 * intersection / union if union else 1
+
+    nroutes = max(n // 10, 2)
+    routes = synthetic_routes(nroutes)
+    for index in (common_helpers.InvertedIndex(lambda x: x["probs"], .5), None):
+        groups, seconds = timed(
+            common_helpers.do_cluster,
+            routes, route_merge, proto_distance, .5, index)
+        print("do_cluster %d routes, %s: %d clusters in %.2fs" % (
+            nroutes, index and "inverted index" or "exhaustive", len(groups),
+            seconds))
+        if index:
+            reference = sorted(sorted(g["trips"]) for g in groups)
+        elif sorted(sorted(g["trips"]) for g in groups) != reference:
+            print("MISMATCH")
+
+
+def bench_simplify(n):
+    rows = synthetic_trace(n)
+    cases = [
+        ("maxpts=1000", {"maxpts": 1000}),
+        ("mindist=10", {"mindist": 10}),
+        ("interpolate", {"maxpts": 1000, "interpolate": True}),
+        ("keep_activity", {"mindist": 10, "keep_activity": True})]
+
+    for name, kwargs in cases:
+        new, seconds = timed(
+            lambda: common_helpers.simplify_geometry(rows, **kwargs))
+        old, oldseconds = timed(
+            lambda: simplify_geometry_parsing(rows, **kwargs))
+        print("simplify_geometry %d points, %s: %d kept, %.2fs, "
+            "originally %.2fs%s" % (
+                n, name, len(new), seconds, oldseconds,
+                "" if new == old else ", MISMATCH"))
+
+
+def bench_hfp(path=None):
+    messages = read_hfp(path) if path else synthetic_hfp()
+    seconds = messages[-1][0] - messages[0][0] + 1
+    print("hfp %d messages over %ds, replayed at 10x" % (len(messages), seconds))
+    for name, buf in (
+            ("vehicle buffer", VehicleBuffer()),
+            ("list scan", ListScanBuffer())):
+        busy, worst, lag, rows = replay_hfp(messages, buf)
+        print("%s: %d rows, handling %.2fs, %.1fus per message, worst %.1fms, "
+            "%.2fs behind at end" % (
+                name, rows, busy, 1e6 * busy / len(messages), 1e3 * worst,
+                max(lag, 0)))
+
+
+device_data_columns = (
+    "id", "device_id", "coordinate", "accuracy", "time",
+    "activity_1", "activity_1_conf", "activity_2", "activity_2_conf",
+    "activity_3", "activity_3_conf", "waypoint_id")
+
+
+def synthetic_device_data(n, size=10000, seed=0):
+    """Batches of device_data rows of one device, as fetched for export,
+    coordinate as EWKB hex."""
+    random.seed(seed)
+    t = datetime(2015, 1, 1)
+    for start in range(0, n, size):
+        rows = []
+        for i in range(start, min(n, start + size)):
+            t += timedelta(seconds=random.randint(1, 30))
+            rows.append((
+                i, 7,
+                "0101000020E6100000%016X%016X" % (
+                    random.getrandbits(64), random.getrandbits(64)),
+                random.randint(3, 60), t,
+                "IN_VEHICLE", random.randint(0, 100),
+                "STILL", random.randint(0, 100),
+                "UNKNOWN", random.randint(0, 100),
+                random.getrandbits(40)))
+        yield rows
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def bench_zip(n):
+    # Streamed first, as peak memory only grows
+    rss0 = max_rss_mb()
+    t0 = time.time()
+    size = 0
+    for chunk in zip_stream([("device_data.csv", csv_chunks(
+            device_data_columns, synthetic_device_data(n)))]):
+        size += len(chunk)
+    seconds = time.time() - t0
+    print("streamed: %d rows, %.1f MB zip in %.1fs, %.0f rows/s, "
+        "peak memory +%.0f MB" % (
+            n, size / 1e6, seconds, n / seconds, max_rss_mb() - rss0))
+
+    n = min(n, 500000)
+    rss0 = max_rss_mb()
+    t0 = time.time()
+    rows = [
+        dict(zip(device_data_columns, r))
+        for b in synthetic_device_data(n) for r in b]
+    buf = StringIO()
+    csv = DictWriter(buf, device_data_columns)
+    csv.writeheader()
+    for r in rows:
+        csv.writerow(r)
+    with tempfile.SpooledTemporaryFile() as tmp:
+        with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('device_data.csv', buf.getvalue())
+        tmp.seek(0)
+        body = tmp.read()
+    seconds = time.time() - t0
+    print("in memory: %d rows, %.1f MB zip in %.1fs, %.0f rows/s, "
+        "peak memory +%.0f MB" % (
+            n, len(body) / 1e6, seconds, n / seconds, max_rss_mb() - rss0))
+
+
+def bench_places(n):
+    coordinates = [x["coordinates"] for x in synthetic_stops(n)]
+    (labels, centroids), seconds = timed(
+        cluster_places,
+        [x for x, _ in coordinates], [y for _, y in coordinates], 200)
+    print("cluster_places %d leg ends: %d places in %.2fs" % (
+        n, len(centroids), seconds))
+    if n > 20000:
+        coordinates = coordinates[:20000]
+        labels, centroids = cluster_places(
+            [x for x, _ in coordinates], [y for _, y in coordinates], 200)
+        print("cluster_places %d leg ends: %d places" % (
+            len(coordinates), len(centroids)))
+
+    # Link one by one as the places triggers do, the same steps as leg_ends
+    def incremental():
+        clusterer = LegEndsClusterer({}, {}, 200, coordinates)
+        for key, coordinate in enumerate(coordinates):
+            clusterer.link(key, coordinate)
+        return clusterer
+    clusterer, seconds = timed(incremental)
+    places = [clusterer.cluster_of[key] for key in range(len(coordinates))]
+    kept = match_places(labels.tolist(), places)
+    changed = sum(
+        1 for label, place in zip(labels.tolist(), places)
+        if kept.get(label) != place)
+    print("incremental %d leg ends: %d places in %.2fs, %d leg ends "
+        "(%.1f%%) in a different place" % (
+            len(coordinates), len(clusterer.coordinates), seconds, changed,
+            100. * changed / len(coordinates)))
+
+
+def counter_best_activities(points, window):
+    """Best activity per point as window_best_activities, incrementally
+    tallying a Counter, as before vectorizing."""
+
+    def activities(point):
+        return {
+            point["activity_1"]: point["activity_1_conf"] or 0,
+            point["activity_2"]: point["activity_2_conf"] or 0,
+            point["activity_3"]: point["activity_3_conf"] or 0}
+
+    def dseconds(p0, p1):
+        return (p1["time"] - p0["time"]).total_seconds()
+
+    def best_activity(activities):
+        on_foot = False
+        for activity, cconf in activities.most_common():
+            if activity == "ON_FOOT":
+                on_foot = True
+            elif on_foot and activity not in ON_FOOT_ACTIVITIES:
+                pass
+            elif activity in GOOD_ACTIVITIES:
+                return activity
+        if on_foot:
+            return "WALKING"
+        return NOT_SET
+
+    probs = Counter()
+    head = tail = 0
+    halfwin = window / 2
+    n = len(points)
+    for i in range(n):
+        while head < n and dseconds(points[i], points[head]) < halfwin:
+            probs.update(activities(points[head]))
+            head += 1
+        while tail < n and dseconds(points[tail], points[i]) > halfwin:
+            probs.subtract(activities(points[tail]))
+            tail += 1
+        yield best_activity(probs)
+
+
+def bench_stabilizer(n):
+    random.seed(0)
+    names = (
+        'IN_VEHICLE', 'ON_BICYCLE', 'ON_FOOT', 'RUNNING', 'STILL', 'TILTING',
+        'UNKNOWN', 'WALKING', None)
+    now = datetime(2017, 1, 1)
+    points = []
+    for i in range(n):
+        now += timedelta(
+            seconds=random.choice((1, 1, 2, 5, 10, 30, 60, 600)),
+            microseconds=random.randrange(1000000))
+        point = {
+            "time": now, "lon": 24.9, "lat": 60.2, "accuracy": 10.0,
+            "device_id": 1}
+        for acol, ccol in zip(ACTIVITY_COLUMNS, CONF_COLUMNS):
+            point[acol] = random.choice(names)
+            point[ccol] = random.choice((None, 0, 10, 30, 50, 75, 100))
+        points.append(point)
+
+    trace = list(Trace(points))
+
+    reference, t_counter = timed(
+        lambda: list(counter_best_activities(points, ACTIVITY_WIN)))
+    vectorized, t_trace = timed(window_best_activities, trace, ACTIVITY_WIN)
+    fromrows, t_rows = timed(window_best_activities, points, ACTIVITY_WIN)
+
+    print("%d points: counter %.2fs, vectorized %.2fs (%.1fx), "
+        "from rows %.2fs (%.1fx)" % (
+            n, t_counter, t_trace, t_counter / t_trace,
+            t_rows, t_counter / t_rows))
+    mismatches = sum(
+        a != b or a != c for a, b, c in zip(reference, vectorized, fromrows))
+    print("identical" if not mismatches else "%d mismatches" % mismatches)
+
+
+def synthetic_roads(n, seed=0):
+    """Lines, waypoints and links of n random walk roads in the Helsinki
+    region, as taken by RoadSnapper, with a waypoint at each vertex."""
+    random.seed(seed)
+    lines, waypoints, links = [], [], []
+    for road in range(n):
+        lon, lat = 24.6 + .8 * random.random(), 60.1 + .3 * random.random()
+        vertices = []
+        for _ in range(random.randint(1, 8)):
+            vertices.append((lon, lat))
+            waypoints.append((len(waypoints) + 1, lon, lat))
+            links.append((road, len(waypoints)))
+            lon += random.gauss(0, .004)
+            lat += random.gauss(0, .002)
+        lines.append((road, vertices))
+    return lines, list(zip(*waypoints)), list(zip(*links))
+
+
+def bench_snapping(n):
+    lines, waypoints, links = synthetic_roads(20000)
+    snapper, seconds = timed(RoadSnapper, lines, waypoints, links)
+    print("RoadSnapper of %d roads built in %.2fs" % (len(lines), seconds))
+
+    random.seed(1)
+    points = [
+        (24.6 + .8 * random.random(), 60.1 + .3 * random.random())
+        for _ in range(n)]
+    snapped, seconds = timed(
+        snapper.snap, [x for x, _ in points], [y for _, y in points])
+    print("snap %d points: %d snapped in %.2fs, %.0f points/s" % (
+        n, sum(x is not None for x in snapped), seconds, n / seconds))
+
+    # Same local distances as RoadSnapper, over all roads and waypoints
+    def distance(proj, a, b=None):
+        ax, ay = proj.d2m(*a)
+        bx, by = proj.d2m(*(b or a))
+        dx, dy = bx - ax, by - ay
+        dd = dx * dx + dy * dy
+        t = min(1, max(0, -(ax * dx + ay * dy) / dd)) if dd else 0
+        return ((ax + t * dx)**2 + (ay + t * dy)**2)**.5
+
+    road_waypoints = {}
+    for road, waypoint in zip(*links):
+        road_waypoints.setdefault(road, []).append(waypoint)
+    coordinates = {i: (x, y) for i, x, y in zip(*waypoints)}
+    mismatches = 0
+    for point, waypoint in zip(points[:200], snapped):
+        proj = common_helpers.Equirectangular(*point)
+        best = min(
+            (distance(proj, a, b), road)
+            for road, vertices in lines
+            for a, b in zip(vertices, vertices[1:] or vertices))
+        expected = None if best[0] > 100 else min(
+            road_waypoints[best[1]],
+            key=lambda x: distance(proj, coordinates[x]))
+        mismatches += expected != waypoint
+    print("%d of %d points snapped differently than exhaustively" % (
+        mismatches, min(n, 200)))
+
+
+if __name__ == "__main__":
+    benchmarks = {
+        "cluster": (bench_cluster, 10000),
+        "simplify": (bench_simplify, 35000),
+        "hfp": (bench_hfp, None),
+        "zip": (bench_zip, 5000000),
+        "places": (bench_places, 100000),
+        "snapping": (bench_snapping, 1000000),
+        "stabilizer": (bench_stabilizer, 100000)}
+    name = sys.argv[1] if len(sys.argv) > 1 else None
+    if name not in benchmarks:
+        sys.exit("usage: python -m pyfiles.benchmark {%s} [n]" % (
+            ",".join(sorted(benchmarks))))
+    fun, default = benchmarks[name]
+    if name == "hfp":
+        fun(sys.argv[2] if len(sys.argv) > 2 else default)
+    else:
+        fun(int(sys.argv[2]) if len(sys.argv) > 2 else default)
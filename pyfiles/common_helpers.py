@@ -2,9 +2,10 @@ import json
 
 from datetime import timedelta
 from heapq import heapify, heappop, heappush
-from itertools import tee
-from math import cos, pi
+from itertools import count, tee
+from math import cos, floor, pi
 from pyfiles.constants import *
+from pyfiles.trace import TracePoint
 
 
 def get_distance_between_coordinates(coord1, coord2):
@@ -42,18 +43,55 @@ class Equirectangular:
 
 
 def point_coordinates(p):
+    if isinstance(p, TracePoint):
+        return p.coordinates
     return json.loads(p["geojson"])["coordinates"]
 
 
 def point_distance(p0, p1):
+    if isinstance(p0, TracePoint) and isinstance(p1, TracePoint):
+        # get_distance_between_coordinates with cosine cached in the trace
+        x_diff = (p0.coordinates[0] - p1.coordinates[0]) * 110320 * p1.coslat
+        y_diff = (p0.coordinates[1] - p1.coordinates[1]) * 110574
+        return (x_diff * x_diff + y_diff * y_diff)**0.5
     return get_distance_between_coordinates(
         point_coordinates(p0), point_coordinates(p1))
 
 
 def point_interval(p0, p1):
+    if isinstance(p0, TracePoint) and isinstance(p1, TracePoint):
+        return (p1.us - p0.us) / 10**6 # as timedelta.total_seconds
     return (p1["time"] - p0["time"]).total_seconds()
 
 
+def path_length(points):
+    """Sum of point_distance between consecutive points, vectorized for
+    points of one Trace."""
+    if (points and isinstance(points[0], TracePoint)
+            and all(p.trace is points[0].trace for p in points)):
+        return points[0].trace.path_length(points)
+    return sum(point_distance(p0, p1) for p0, p1 in pairwise(points))
+
+
+def daily_distances(points):
+    """Distance in km between consecutive points by day, as sorted list of
+    (midnight, km), at least the day of the first point if any. Steps over
+    MAX_POINT_TIME_DIFFERENCE are not counted, and steps over midnight count
+    on the later day, as in travelled_distances."""
+    days = {}
+    if points:
+        day = points[0]["time"].replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        days[day] = 0.0
+    for p0, p1 in pairwise(points):
+        day = p1["time"].replace(hour=0, minute=0, second=0, microsecond=0)
+        km = 0.0
+        if point_interval(p0, p1) <= MAX_POINT_TIME_DIFFERENCE:
+            km = point_distance(p0, p1) / 1000.0
+        days[day] = days.get(day, 0.0) + km
+    return sorted(days.items())
+
+
 def simplify_geometry(
         points,
         maxpts=None,
@@ -76,8 +114,10 @@ def simplify_geometry(
     if (not points or not mindist and (not maxpts or len(points) <= maxpts)):
         return points
 
-    ballpark = json.loads(points[0]['geojson'])['coordinates']
-    projector = Equirectangular(*ballpark)
+    # Parse and project coordinates once, then simplify point indices
+    coordinates = [point_coordinates(x) for x in points]
+    projector = Equirectangular(*coordinates[0])
+    projected = [projector.d2m(*x) for x in coordinates]
 
     def distance_point_lineseg(p, l, par=None):
         """Distance of point p from line segment l.
@@ -102,83 +142,76 @@ def simplify_geometry(
         p_ref = [p[i] - ref[i] for i in dim]
         return sum(p_ref[i]**2 for i in dim)**.5
 
-    def linedist(p0, p1, p2):
+    def linedist(i0, i1, i2):
         """Distance of p1 from line segment between p0 and p2."""
-        m0, m1, m2 = (
-            projector.d2m(*json.loads(x['geojson'])['coordinates'])
-            for x in (p0, p1, p2))
-        return distance_point_lineseg(m1, (m0, m2))
+        return distance_point_lineseg(
+            projected[i1], (projected[i0], projected[i2]))
 
-    def timedist(p0, p1, p2):
+    def timedist(i0, i1, i2):
         """Distance of p1 from its time interpolation between p0 and p2."""
-        m0, m1, m2 = (
-            projector.d2m(*json.loads(x['geojson'])['coordinates'])
-            for x in (p0, p1, p2))
-        fraction = point_interval(p0, p1) / point_interval(p0, p2)
-        return distance_point_lineseg(m1, (m0, m2), fraction)
+        fraction = (point_interval(points[i0], points[i1])
+            / point_interval(points[i0], points[i2]))
+        return distance_point_lineseg(
+            projected[i1], (projected[i0], projected[i2]), fraction)
 
     dist = interpolate and timedist or linedist
 
-    def keeping_activity(p0, p1, p2):
+    def keeping_activity(i0, i1, i2):
         """Sortable (bool, dist) metric"""
-        changes = p1["activity"] != p2["activity"]
-        moved = point_distance(p0, p1) > mindist
-        return (changes and moved, dist(p0, p1, p2))
+        changes = points[i1]["activity"] != points[i2]["activity"]
+        moved = get_distance_between_coordinates(
+            coordinates[i0], coordinates[i1]) > mindist
+        return (changes and moved, dist(i0, i1, i2))
 
     metric = keep_activity and keeping_activity or dist
     minmetric = keep_activity and (False, mindist) or mindist
 
-    return simplify(points, metric, maxpts, minmetric)
+    kept = simplify(list(range(len(points))), metric, maxpts, minmetric)
+    return [points[i] for i in kept]
 
 
 def simplify(points, metric, maxpts=None, minmetric=None):
     """Remove points in order of lowest metric(predecessor, point, successor)
     until it reaches minmetric, and number of points is no greater than
-    maxpts."""
-
-    class Dll:
-        def __init__(self, value, before=None, after=None):
-            self.value = value
-            self.before = before
-            self.after = after
-        def unlink(self):
-            if self.before:
-                self.before.after = self.after
-            if self.after:
-                self.after.before = self.before
-
-    def node_metric(node):
-        return metric(node.before.value, node.value, node.after.value)
-
-    linked = [Dll(x) for x in points]
-    for i in range(1, len(linked)):
-        linked[i].before = linked[i-1]
-    for i in range(len(linked) - 1):
-        linked[i].after = linked[i+1]
-
-    heap = [[node_metric(node), node] for node in linked[1:-1]]
-    for node, heap_entry in zip(linked[1:-1], heap):
-        node.heap_entry = heap_entry
+    maxpts.
+
+    Metrics are kept in a heap where updating a point's metric pushes a new
+    entry, and entries of removed points or older versions are skipped when
+    popped. Equal metrics are removed in trace order."""
+
+    n = len(points)
+    before = list(range(-1, n - 1))
+    after = list(range(1, n + 1))
+    version = [0] * n
+    removed = [False] * n
+
+    def node_metric(i):
+        return metric(points[before[i]], points[i], points[after[i]])
+
+    heap = [(node_metric(i), i, 0) for i in range(1, n - 1)]
     heapify(heap)
+    remaining = len(heap) # interior points not removed
 
     while heap:
-        m, node = heappop(heap)
+        m, i, v = heappop(heap)
+        if removed[i] or v != version[i]:
+            continue # stale
+        remaining -= 1
         # 3 == the endpoints not in heap, plus the one item popped above
-        if ((not maxpts or len(heap) <= maxpts - 3)
+        if ((not maxpts or remaining <= maxpts - 3)
                 and (not minmetric or m > minmetric)):
             break
-        node.unlink()
-        for neighbor in node.before, node.after:
-            if hasattr(neighbor, "heap_entry"):
-                neighbor.heap_entry[0] = node_metric(neighbor)
-        heapify(heap)
+        removed[i] = True
+        b, a = before[i], after[i]
+        after[b] = a
+        before[a] = b
+        for neighbor in b, a:
+            if 0 < neighbor < n - 1:
+                version[neighbor] += 1
+                heappush(
+                    heap, (node_metric(neighbor), neighbor, version[neighbor]))
 
-    node = linked[0]
-    rv = []
-    while node:
-        rv.append(node.value)
-        node = node.after
-    return rv
+    return [x for i, x in enumerate(points) if not removed[i]]
 
 
 def dict_groups(dicts, keys):
@@ -437,7 +470,8 @@ def trace_discard_single_sidesteps(points, factor=2):
         # typically has movement, or at least greater noise. This is why if
         # both p1 and p2 look bad, we want to keep the one that looks worse,
         # due to getting a narrower neighbor base from the false side.
-        if (d(buf[0], buf[1]) > dict(buf[1]).get("accuracy", 0)
+        accuracy = buf[1]["accuracy"] if "accuracy" in buf[1] else 0
+        if (d(buf[0], buf[1]) > accuracy
                 and badness1 > factor
                 and (badness2 <= factor or badness1 <= badness2)):
             buf.pop(1)
@@ -621,7 +655,9 @@ def stop_clusters(stops, cluster_distance):
                 "time_end": x["time_end"]}]}
         for x in stops]
 
-    groups = do_cluster(dests, dest_merge, dest_dist, cluster_distance)
+    index = CLUSTER_INDEXED and GridIndex(
+        lambda d: d["coordinates"], cluster_distance, dests) or None
+    groups = do_cluster(dests, dest_merge, dest_dist, cluster_distance, index)
 
     for g in groups:
         g["total_time"] = sum(
@@ -664,14 +700,19 @@ class Sort0List(list):
         return self[0] < other[0]
 
 
-def do_cluster(items, mergefun, distfun, distlim):
+def do_cluster(items, mergefun, distfun, distlim, index=None):
     """Pairwise nearest merging clusterer.
     items -- list of dicts
     mergefun -- merge two items
     distfun -- distance function
     distlim -- stop merging when distance above this limit
+    index -- GridIndex or InvertedIndex for finding merge candidates, else
+             search exhaustively
     """
 
+    if index is not None:
+        return do_cluster_indexed(items, mergefun, distfun, distlim, index)
+
     def heapitem(d0, dests):
         """Find nearest neighbor for d0 as sortable [distance, nearest, d0]"""
         dists = (
@@ -714,6 +755,138 @@ def do_cluster(items, mergefun, distfun, distlim):
     return [x[2] for x in heap]
 
 
+class GridIndex:
+    """Uniform grid of items by coordinates, for finding those that may be
+    within distlim by get_distance_between_coordinates. Cells are sized for
+    the highest latitude among the given items."""
+
+    def __init__(self, coordfun, distlim, items):
+        self.coordfun = coordfun
+        maxlat = max([abs(coordfun(x)[1]) for x in items] or [0])
+        distlim = max(distlim, 1e-6)
+        self.ysize = distlim / 110574.
+        self.xsize = distlim / (110320 * max(cos(maxlat / 180 * pi), 1e-6))
+        self.cells = {}
+
+    def _cell(self, item):
+        x, y = self.coordfun(item)
+        return int(floor(x / self.xsize)), int(floor(y / self.ysize))
+
+    def add(self, key, item):
+        self.cells.setdefault(self._cell(item), set()).add(key)
+
+    def remove(self, key, item):
+        self.cells[self._cell(item)].discard(key)
+
+    def near(self, item):
+        cx, cy = self._cell(item)
+        for x in (cx - 1, cx, cx + 1):
+            for y in (cy - 1, cy, cy + 1):
+                for key in self.cells.get((x, y), ()):
+                    yield key
+
+
+class InvertedIndex:
+    """Index of items by keys, for finding those that may be within distlim
+    by a Jaccard style distance, which is 1 for items sharing no keys."""
+
+    def __init__(self, keysfun, distlim):
+        self.keysfun = keysfun
+        self.exhaustive = distlim >= 1
+        self.postings = {}
+        self.keys = set()
+
+    def add(self, key, item):
+        self.keys.add(key)
+        for k in self.keysfun(item):
+            self.postings.setdefault(k, set()).add(key)
+
+    def remove(self, key, item):
+        self.keys.discard(key)
+        for k in self.keysfun(item):
+            self.postings[k].discard(key)
+
+    def near(self, item):
+        if self.exhaustive:
+            return set(self.keys)
+        return set().union(*(self.postings.get(k, ()) for k in self.keysfun(item)))
+
+
+def do_cluster_indexed(items, mergefun, distfun, distlim, index):
+    """do_cluster using index to limit nearest neighbor searches to candidates
+    within reach. Each item's nearest neighbor edge is kept in a heap, where
+    edges gone stale by merges are skipped on pop. Merges follow the same
+    order as do_cluster, apart from the order of exactly equal distances."""
+
+    live = {}
+    nearest = {}    # key -> (distance, nearest key)
+    nearest_of = {} # key -> keys having it as nearest
+    heap = []
+    seq = count()
+
+    def rescan(key):
+        """Find nearest for key among candidates, push edge."""
+        item = live[key]
+        best = None
+        for other in sorted(index.near(item)):
+            if other == key or other not in live:
+                continue
+            distance = distfun(item, live[other])
+            if best is None or distance < best[0]:
+                best = distance, other
+        set_nearest(key, best)
+
+    def set_nearest(key, best):
+        old = nearest.pop(key, None)
+        if old is not None:
+            nearest_of.get(old[1], set()).discard(key)
+        if best is None:
+            return
+        nearest[key] = best
+        nearest_of.setdefault(best[1], set()).add(key)
+        heappush(heap, (best[0], next(seq), key, best[1]))
+
+    for key, item in enumerate(items):
+        live[key] = item
+        index.add(key, item)
+    for key in list(live):
+        rescan(key)
+
+    newkey = len(items)
+    while heap:
+        distance, _, k0, k1 = heappop(heap)
+        if k0 not in live or nearest.get(k0) != (distance, k1):
+            continue # stale
+        if distance > distlim:
+            break
+
+        d0, d1 = live.pop(k0), live.pop(k1)
+        index.remove(k0, d0)
+        index.remove(k1, d1)
+        set_nearest(k0, None)
+        set_nearest(k1, None)
+        orphans = nearest_of.pop(k0, set()) | nearest_of.pop(k1, set())
+
+        merged = mergefun(d0, d1)
+        mkey = newkey
+        newkey += 1
+        live[mkey] = merged
+        index.add(mkey, merged)
+
+        # Rescan those whose nearest was merged away, offer merged to others
+        for key in sorted(orphans - {k0, k1}):
+            rescan(key)
+        for key in sorted(index.near(merged)):
+            if key == mkey or key not in live or key in orphans:
+                continue
+            distance = distfun(live[key], merged)
+            if key not in nearest or nearest[key][0] > distance:
+                set_nearest(key, (distance, mkey))
+        rescan(mkey)
+
+    return list(live.values())
+
+
 def group_unsorted(iterable, keyfunc):
     r = dict()
     for x in iterable:
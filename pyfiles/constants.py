@@ -75,6 +75,10 @@ jore_tram_replace_regex = re.compile("^.0*")
 jore_bus_replace_regex = re.compile("^.0*")
 
 
+# Find merge candidates in stop and route clustering through a spatial grid or
+# inverted index, rather than exhaustively. Same clusters either way.
+CLUSTER_INDEXED = True
+
 # Maximum distance (m) and minimum duration (s) for detecting a stopover.
 DEST_DURATION_MIN = 300
 DEST_RADIUS_MAX = 100
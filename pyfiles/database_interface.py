@@ -2,8 +2,12 @@
 
 import datetime
 from datetime import timedelta
+from itertools import groupby
 
 import json
+import struct
+import threading
+import time
 
 import geoalchemy2 as ga2
 from flask import abort
@@ -14,19 +18,26 @@ from sqlalchemy import (
     UniqueConstraint)
 
 from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION, TIMESTAMP, UUID
-from sqlalchemy.exc import DataError, ProgrammingError
+from sqlalchemy.exc import (
+    DataError, IntegrityError, OperationalError, ProgrammingError)
 
 from sqlalchemy.sql import (
     and_, between, column, exists, func, or_, select, text)
 
-from csv import DictWriter
+from csv import writer
 from io import StringIO
 
 from pyfiles.energy_rating import EnergyRating
+from pyfiles.leg_ends_clusterer import LegEndsClusterer
+from pyfiles.response_cache import ResponseCache
+from pyfiles.road_snapper import RoadSnapper, wkb_vertices
 from pyfiles.config_helper import get_config
 
 from pyfiles.common_helpers import (
-    get_distance_between_coordinates, trace_discard_sidesteps)
+    daily_distances,
+    get_distance_between_coordinates,
+    trace_discard_inaccurate,
+    trace_discard_sidesteps)
 
 from pyfiles.constants import (
     ALERT_RADIUS,
@@ -37,6 +48,7 @@ from pyfiles.constants import (
     MAX_POINT_TIME_DIFFERENCE)
 
 from pyfiles.svg_generation import generate_energy_rating_svg
+from pyfiles.zip_stream import csv_chunks
 
 
 # from simplekv.memory import DictStore
@@ -76,10 +88,22 @@ travelled_distances_table = None
 mass_transit_data_table = None
 global_statistics_table = None
 
+# Rendered certificates by user and window, see get_svg
+svg_cache = None
+
+# Roads and waypoints loaded on first use, see get_road_snapper
+road_snapper = None
+road_snapper_lock = threading.Lock()
+
 def init_db(app):
     global db
     db = SQLAlchemy(app)
 
+    global svg_cache
+    svg_cache = ResponseCache(
+        app.config.get("SVG_CACHE_SIZE", 256),
+        app.config.get("SVG_CACHE_DIR"))
+
     # chicken, meet egg
     metadata = db.metadata
     metadata.bind = db.engine
@@ -147,7 +171,7 @@ def init_db(app):
                               Column('waypoint_id', BigInteger),
                               Column('snapping_time', TIMESTAMP),
                               Index('idx_device_data_time', 'time'),
-                              Index('idx_device_data_device_id_time', 'device_id', 'time'))
+                              Index('idx_device_data_device_id_time', 'device_id', 'time', unique=True))
 
     Index('idx_device_data_snapping_time_null', device_data_table.c.snapping_time, postgresql_where=device_data_table.c.snapping_time == None)
 
@@ -270,6 +294,79 @@ def init_db(app):
         Column('line', String),
         UniqueConstraint('leg', 'source'))
 
+    # Distance travelled in each moving leg by day, for aggregating into
+    # travelled_distances without rereading points, see update_user_distances
+    Table('leg_distances', metadata,
+        Column(
+            'leg',
+            ForeignKey('legs.id', ondelete="CASCADE"),
+            primary_key=True),
+        Column('time', TIMESTAMP, primary_key=True),
+        Column('km', Float, nullable=False),
+        Index('idx_leg_distances_time', 'time'))
+
+    # Certificate rankings of all users in seven day windows, generated
+    # nightly for the default window and on first view for others,
+    # regenerated as days in them are summarized, and pruned when old
+    Table('certificate_rankings', metadata,
+        Column('firstday', TIMESTAMP, primary_key=True),
+        Column('lastday', TIMESTAMP, primary_key=True),
+        Column(
+            'user_id',
+            ForeignKey('users.id', ondelete="CASCADE"),
+            primary_key=True),
+        Column('ranking', Integer, nullable=False),
+        Column('max_ranking', Integer, nullable=False))
+
+    # Change count of each user's legs, modes, and points within legs,
+    # maintained by triggers in sql/legs_revisions.sql, for validating cached
+    # path responses
+    Table('legs_revisions', metadata,
+        Column(
+            'user_id',
+            ForeignKey('users.id', ondelete="CASCADE"),
+            primary_key=True),
+        Column('revision', BigInteger, nullable=False))
+
+    # Reverse geocoded place labels by rounded coordinate cell, so that
+    # nearby and shifted places reuse them, see pyfiles/reverse_geocoder.py
+    Table('reverse_geocoding_cache', metadata,
+        Column('cell', String, primary_key=True),
+        Column('label', String, nullable=False),
+        Column('created', TIMESTAMP, nullable=False, server_default=func.now()))
+
+    # Progress of removing duplicate device_data points in id order, until
+    # idx_device_data_device_id_time can be made unique, see
+    # device_data_delete_duplicates
+    Table('device_data_dedupe', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('watermark', BigInteger, nullable=False))
+
+    # Legs changed while leg end clustering is deferred, old and new, queued
+    # by triggers in sql/legends.sql for recluster_leg_ends
+    Table('leg_ends_queue', metadata,
+        Column('id', BigInteger, primary_key=True),
+        Column('leg', Integer, nullable=False, index=True),
+        Column('old_user_id', Integer),
+        Column('old_coordinate_start',
+            ga2.Geography('point', 4326, spatial_index=False)),
+        Column('old_coordinate_end',
+            ga2.Geography('point', 4326, spatial_index=False)),
+        Column('cluster_start', Integer),
+        Column('cluster_end', Integer),
+        Column('user_id', Integer),
+        Column('coordinate_start',
+            ga2.Geography('point', 4326, spatial_index=False)),
+        Column('coordinate_end',
+            ga2.Geography('point', 4326, spatial_index=False)))
+
+    # Journey planner responses by rounded query, so that generating legs
+    # again does not repeat queries, see pyfiles/journey_planner.py
+    Table('journey_planner_cache', metadata,
+        Column('query', String, primary_key=True),
+        Column('response', String, nullable=False),
+        Column('created', TIMESTAMP, nullable=False, server_default=func.now()))
+
     Table('waypoints', metadata, autoload=True)
 
     Table('leg_waypoints', metadata,
@@ -298,20 +395,12 @@ def init_db(app):
                               UniqueConstraint('time', 'user_id', name="unique_user_id_and_time_on_travelled_distances"),
                               Index('idx_travelled_distances_time', 'time'),
                               Index('idx_travelled_distances_device_id_time', 'user_id', 'time'))
-    if not travelled_distances_table.exists():
-        travelled_distances_table.create(checkfirst=True)
-        db.engine.execute(text('''
-            CREATE RULE "travelled_distances_table_duplicate_update" AS ON INSERT TO "travelled_distances"
-            WHERE EXISTS(SELECT 1 FROM travelled_distances
-                        WHERE (user_id, time)=(NEW.user_id, NEW.time))
-            DO INSTEAD UPDATE travelled_distances
-                SET ranking = NEW.ranking
-                WHERE user_id = NEW.user_id
-                AND time = NEW.time;
-            '''))
-
-
-    # HSL mass transit vehicle locations.
+    # Rankings are upserted with ON CONFLICT, see generate_rankings;
+    # databases before version 3 have an insert rule for it instead.
+
+
+    # HSL mass transit vehicle locations. Actually created partitioned by
+    # day, with the unique constraint and indexes on each partition.
     global mass_transit_data_table
     mass_transit_data_table = Table('mass_transit_data', metadata,
                               Column('id', Integer, primary_key=True),
@@ -326,14 +415,13 @@ def init_db(app):
                               Index('idx_mass_transit_data_time_coordinate', 'time', 'coordinate'))
 
 
+    # Stored in daily partitions created on insert, see mass_transit_data_copy
+    with open("sql/mass_transit_partitions.sql") as f, db.engine.begin() as t:
+        t.execute(text(f.read()))
     if not mass_transit_data_table.exists():
-        mass_transit_data_table.create(checkfirst=True)
-        db.engine.execute(text('''
-            CREATE RULE "mass_transit_data_table_duplicate_ignore" AS ON INSERT TO "mass_transit_data"
-            WHERE EXISTS(SELECT 1 FROM mass_transit_data
-                        WHERE (vehicle_ref, time)=(NEW.vehicle_ref, NEW.time))
-            DO INSTEAD NOTHING;
-            '''))
+        mass_transit_type_enum.create(db.engine, checkfirst=True)
+        with db.engine.begin() as t:
+            create_mass_transit_data_partitioned(t)
 
     # Public transport service alerts
     global hsl_alerts_table
@@ -447,7 +535,7 @@ def init_db(app):
                               Column('average_co2_usage', Float), #Daily co2 usage
                               Column('past_week_certificates_number', Integer, nullable=False),
                               Column('total_distance', Float, nullable=False), #Daily amount of distance
-                              Index('idx_global_statistics_time', 'time'),)
+                              Index('idx_global_statistics_time', 'time', unique=True),)
 
     # log activity from both mobile and web clients
     # Note: Web client doesn't have a device_id: Using the latest one for the user
@@ -482,7 +570,7 @@ def init_db(app):
     metadata.create_all(checkfirst=True)
 
     # Database upgrade operations
-    code_db_version = 1
+    code_db_version = 3
     db_version = get_database_version()
     if db_version is None:
         db_version = init_database_version(code_db_version)
@@ -490,6 +578,12 @@ def init_db(app):
     if db_version < 1:
         db_upgraded = True
         db.engine.execute(text('ALTER TABLE mass_transit_data ADD COLUMN direction integer;'))
+    if db_version < 2:
+        db_upgraded = True
+        partition_mass_transit_data(app.config.get("MASS_TRANSIT_LIVE_KEEP_DAYS"))
+    if db_version < 3:
+        db_upgraded = True
+        upgrade_statistics_upserts()
     if db_upgraded:
         upgrade_database_version(code_db_version)
 
@@ -571,19 +665,31 @@ CREATE OR REPLACE VIEW leg_modes AS SELECT
         Column("trip", ForeignKey(trips_table.c.id)),
         autoload=True)
 
-    # Functions and triggers that maintain the leg_ends table
+    # Functions and triggers that maintain the leg_ends table, live or
+    # deferred to recluster_leg_ends
+    deferred = bool(app.config.get("LEG_ENDS_DEFERRED"))
     with open("sql/legends.sql") as f, db.engine.begin() as t:
         # Server restarts can result in this being run concurrently, leading to
         # tuple concurrently updated and other racing on function and trigger
         # updates. Lock something vaguely relevant to serialize access.
         t.execute(text("lock leg_ends in access exclusive mode"))
-        t.execute(text(f.read()), clustdist=2*DEST_RADIUS_MAX)
+        t.execute(
+            text(f.read()), clustdist=2*DEST_RADIUS_MAX, deferred=deferred)
+
+        # Leaving deferred mode, catch up before the live triggers take over
+        if not deferred:
+            recluster_leg_ends(t)
 
     # Functions and triggers that maintain the places table
     with open("sql/places.sql") as f, db.engine.begin() as t:
         t.execute(text("lock places in access exclusive mode"))
         t.execute(text(f.read()), clustdist=2*DEST_RADIUS_MAX)
 
+    # Triggers that count changes to legs and their points per user
+    with open("sql/legs_revisions.sql") as f, db.engine.begin() as t:
+        t.execute(text("lock legs_revisions in access exclusive mode"))
+        t.execute(text(f.read()))
+
 
     return db, store
 
@@ -611,6 +717,11 @@ def get_rating(user_id, start_date, end_date):
 
 
 def get_svg(user_id, firstday=None, lastday=None):
+    """Energy certificate of the user over the days from firstday to lastday,
+    by default the seven days through the last summarized day. Rankings of
+    seven day windows come from certificate_rankings, and rendered
+    certificates are cached until their rating or ranking changes."""
+
     if lastday is None:
         if firstday is None:
             # No params, end on last summarized user day, typically yesterday
@@ -631,66 +742,471 @@ def get_svg(user_id, firstday=None, lastday=None):
     rating, ranking = get_rating(user_id, firstday, end_time)
 
     # get_rating returns stored 7 day ranking regardless of window length;
-    # calculate true ranking in window
+    # use true ranking in window
+    ranking, max_ranking = get_certificate_ranking(user_id, firstday, lastday)
+
+    key = (int(user_id), firstday, lastday)
+    revision = (
+        sorted(rating.get_data_dict().items()), ranking, max_ranking)
+    body = svg_cache.get(key, revision)
+    if body is not None:
+        return body.decode("utf8")
+
+    svg = generate_energy_rating_svg(
+        rating, firstday, end_time, ranking, max_ranking)
+    svg_cache.put(key, revision, svg.encode("utf8"))
+    return svg
+
+
+# Ranks of all users by distance weighted average co2 over the window
+certificate_ranking_query = """
+    WITH totals AS (SELECT
+            user_id,
+            sum(total_distance * average_co2) / sum(total_distance) co2
+        FROM travelled_distances
+        WHERE time >= :firstday AND time <= :lastday
+        GROUP BY user_id),
+    ranked AS (SELECT *, rank() OVER (ORDER BY co2) FROM totals)
+    SELECT user_id, rank, max(rank) OVER () max_rank FROM ranked"""
+
+
+def get_certificate_ranking(user_id, firstday, lastday):
+    """(ranking, max_ranking) of user in the window, (0, 0) if not ranked.
+    Seven day windows are generated into certificate_rankings on first use,
+    others are ranked on each call."""
+
+    if lastday - firstday != timedelta(days=6):
+        return db.engine.execute(text("""
+            SELECT rank, max_rank FROM ({}) r WHERE user_id = :user
+            """.format(certificate_ranking_query)),
+            firstday=firstday, lastday=lastday, user=user_id).first() \
+            or (0, 0)
+
+    # Any row of the window tells it is generated, the user's row if ranked
     query = text("""
-        WITH totals AS (SELECT
-                user_id,
-                sum(total_distance * average_co2) / sum(total_distance) co2
-            FROM travelled_distances
-            WHERE time >= :firstday AND time <= :lastday
-            GROUP BY user_id ORDER BY co2),
-        ranked AS (SELECT *, rank() OVER (order by co2) FROM totals),
-        maxed AS (SELECT *, last_value(rank) OVER () FROM ranked)
-        SELECT rank, last_value FROM maxed WHERE user_id = :user""")
-    ranks = db.engine.execute(
+        SELECT user_id = :user, ranking, max_ranking
+        FROM certificate_rankings
+        WHERE firstday = :firstday AND lastday = :lastday
+        ORDER BY user_id = :user DESC LIMIT 1""")
+    row = db.engine.execute(
         query, firstday=firstday, lastday=lastday, user=user_id).first()
-    ranking, max_ranking = ranks or (0, 0)
+    if row is None:
+        generate_certificate_rankings(firstday, lastday)
+        row = db.engine.execute(
+            query, firstday=firstday, lastday=lastday, user=user_id).first()
+    if row is None or not row[0]:
+        return 0, 0
+    return row[1], row[2]
 
-    return generate_energy_rating_svg(
-        rating, firstday, end_time, ranking, max_ranking)
+
+def generate_certificate_rankings(firstday=None, lastday=None):
+    """Store rankings of all users in window, by default the seven days
+    through the last summarized day."""
+
+    if lastday is None:
+        lastday = db.engine.execute(
+            text('SELECT max(time) FROM travelled_distances')).scalar()
+        if lastday is None:
+            return
+    if firstday is None:
+        firstday = lastday - timedelta(days=6)
+
+    with db.engine.begin() as t:
+        t.execute(text("""
+            DELETE FROM certificate_rankings
+            WHERE firstday = :firstday AND lastday = :lastday"""),
+            firstday=firstday, lastday=lastday)
+        t.execute(text("""
+            INSERT INTO certificate_rankings
+                (firstday, lastday, user_id, ranking, max_ranking)
+            SELECT :firstday, :lastday, user_id, rank, max_rank FROM ({}) r
+            ON CONFLICT (firstday, lastday, user_id) DO UPDATE SET
+                ranking = EXCLUDED.ranking,
+                max_ranking = EXCLUDED.max_ranking
+            """.format(certificate_ranking_query)),
+            firstday=firstday, lastday=lastday)
+
+
+def refresh_certificate_rankings(start, end):
+    """Regenerate stored rankings of windows overlapping days from start
+    until end."""
+    for firstday, lastday in db.engine.execute(text("""
+            SELECT DISTINCT firstday, lastday FROM certificate_rankings
+            WHERE firstday < :end AND lastday >= :start"""),
+            start=start, end=end).fetchall():
+        generate_certificate_rankings(firstday, lastday)
+
+
+def prune_certificate_rankings(keep_days):
+    """Delete stored rankings of windows ending over keep_days ago; viewing
+    one again generates it anew."""
+    db.engine.execute(text("""
+        DELETE FROM certificate_rankings
+        WHERE lastday < now() - make_interval(days => :days)"""),
+        days=keep_days)
+
+
+def get_legs_revision(user):
+    """Change count of the user's legs, zero if never changed."""
+    return db.engine.execute(text(
+        "SELECT revision FROM legs_revisions WHERE user_id = :user"),
+        user=user).scalar() or 0
+
+
+def journey_planner_cache_get(queries):
+    """Cached journey planner responses of given query keys, as dict of JSON
+    strings by key."""
+    if not queries:
+        return {}
+    return dict(db.engine.execute(text("""
+        SELECT query, response FROM journey_planner_cache
+        WHERE query = ANY(CAST(:queries AS text[]))"""),
+        queries=list(queries)).fetchall())
+
+
+def journey_planner_cache_put(responses):
+    """Store dict of JSON response strings by query key, keeping any
+    already stored by another process."""
+    if not responses:
+        return
+    db.engine.execute(text("""
+        INSERT INTO journey_planner_cache (query, response)
+        SELECT * FROM unnest(
+            CAST(:queries AS text[]), CAST(:responses AS text[]))
+        ON CONFLICT DO NOTHING"""),
+        queries=list(responses.keys()),
+        responses=list(responses.values()))
+
+
+def reverse_geocoding_cache_get(cells):
+    """Cached place labels of given cell keys, as dict by key."""
+    if not cells:
+        return {}
+    return dict(db.engine.execute(text("""
+        SELECT cell, label FROM reverse_geocoding_cache
+        WHERE cell = ANY(CAST(:cells AS text[]))"""),
+        cells=list(cells)).fetchall())
+
+
+def reverse_geocoding_cache_put(labels):
+    """Store dict of place labels by cell key, keeping any already stored by
+    another process."""
+    if not labels:
+        return
+    db.engine.execute(text("""
+        INSERT INTO reverse_geocoding_cache (cell, label)
+        SELECT * FROM unnest(
+            CAST(:cells AS text[]), CAST(:labels AS text[]))
+        ON CONFLICT DO NOTHING"""),
+        cells=list(labels.keys()),
+        labels=list(labels.values()))
 
 
 def update_user_distances(user, start, end, update_only=True):
     """Update travelled_distances for given user, based on changes to data
     between given start and end. If update_only, disallow writing stats on a
-    new day, do update global stats."""
+    new day, do update global stats. Returns the days written."""
 
     # Snap to whole days
     start = start.replace(hour=0, minute=0, second=0, microsecond=0)
     end += timedelta(days=1, microseconds=-1)
     end = end.replace(hour=0, minute=0, second=0, microsecond=0)
 
-    data_rows = get_filtered_device_data_points(user, start, end)
+    fill_leg_distances(user, start, end)
 
-    # discard suspiciously sharp movement from bogus location jumps
-    data_rows = trace_discard_sidesteps(data_rows, BAD_LOCATION_RADIUS)
+    # Sum leg distances by day and mode
+    ratings = {}
+    for day, activity, line_type, km in db.engine.execute(text("""
+            SELECT d.time, m.activity, m.line_type, sum(d.km)
+            FROM leg_distances d JOIN leg_modes m ON m.id = d.leg
+            WHERE m.user_id = :user AND d.time >= :start AND d.time < :end
+            GROUP BY d.time, m.activity, m.line_type"""),
+            user=user, start=start, end=end):
+        if day not in ratings:
+            ratings[day] = EnergyRating(user, date=day)
+        add_rating_distance(ratings[day], activity, line_type, km)
 
     dists = db.metadata.tables["travelled_distances"]
-    for rating in get_ratings_from_rows(data_rows, user):
+    written = []
+    for day, rating in sorted(ratings.items()):
+        rating.calculate_rating()
+        if rating.is_empty():
+            continue
+        rating = rating.get_data_dict()
         where = and_(*(dists.c[x] == rating[x] for x in ["user_id", "time"]))
         ex = db.engine.execute(dists.select(where)).first() # no upsert yet
         if ex:
             db.engine.execute(dists.update(where, rating))
+            written.append(day)
         elif not update_only:
             # Refrain from writing partial stats for today that daily batch
             # then wouldn't update
             db.engine.execute(dists.insert([rating]))
+            written.append(day)
 
     # Batch updates may want to defer generating derived sums and rankings
     if not update_only:
-        return
+        return written
 
     # Update unused weekly rankings based on ratings
-    query = text("""
-        SELECT DISTINCT time FROM travelled_distances
-        WHERE time >= :start AND time < :end + interval '6 days'
-            AND total_distance IS NOT NULL""")
-    for row in db.engine.execute(query, start=start, end=end):
-        generate_rankings(row[0])
+    generate_rankings(start, end + timedelta(days=6))
+
+    # Update certificate rankings viewed already
+    refresh_certificate_rankings(start, end)
 
     # Update unused global distance, co2 average, active users in last 13 days
     update_global_statistics(start, end)
 
+    return written
+
+
+def fill_leg_distances(user, start, end):
+    """Compute leg_distances of the user's moving legs overlapping the range
+    that have none, such as legs recorded before they were kept, or stops the
+    user relabeled as moving, from the points that leg generation would have
+    used. Moving is by the activity including user corrections."""
+
+    query = text("""
+        SELECT l.id, l.time_start, l.time_end,
+            ST_AsGeoJSON(dd.coordinate) geojson, dd.accuracy, dd.time
+        FROM leg_modes l JOIN device_data dd
+        ON  dd.device_id = l.device_id
+        AND dd.time BETWEEN l.time_start AND l.time_end
+        WHERE l.user_id = :user
+        AND l.activity IN ('IN_VEHICLE', 'ON_BICYCLE', 'RUNNING', 'WALKING')
+        AND l.time_start < :end AND l.time_end >= :start
+        AND NOT EXISTS (SELECT 1 FROM leg_distances d WHERE d.leg = l.id)
+        ORDER BY l.id, dd.time""")
+
+    rows = []
+    for legid, group in groupby(
+            db.engine.execute(query, user=user, start=start, end=end),
+            lambda x: x.id):
+        points = trace_discard_sidesteps(
+            trace_discard_inaccurate(group, DEST_RADIUS_MAX / 2),
+            BAD_LOCATION_RADIUS)
+        rows += [
+            {"leg": legid, "time": day, "km": km}
+            for day, km in daily_distances(list(points))]
+    if rows:
+        db.engine.execute(db.metadata.tables["leg_distances"].insert(), rows)
+
+
+def recluster_leg_ends(t=None):
+    """Cluster the leg ends of legs queued in deferred mode, one user at a
+    time, each in a transaction of its own unless given one."""
+
+    query = text("""
+        SELECT old_user_id FROM leg_ends_queue WHERE old_user_id IS NOT NULL
+        UNION
+        SELECT user_id FROM leg_ends_queue WHERE user_id IS NOT NULL
+        ORDER BY 1""")
+
+    if t is not None:
+        for user, in t.execute(query).fetchall():
+            recluster_user_leg_ends(t, user)
+        return
+
+    users = [x for x, in db.engine.execute(query)]
+    if users:
+        print("recluster_leg_ends of %d users" % len(users))
+    for user in users:
+        with db.engine.begin() as t:
+            recluster_user_leg_ends(t, user)
+
+
+def recluster_user_leg_ends(t, user):
+    """Replay the queued leg changes concerning the user's leg ends in order,
+    and write the resulting clusters in bulk. Queue entries are removed once
+    processed for both their old and new user."""
+
+    # Hold off writers queueing more, and read coordinates exactly
+    t.execute(text("LOCK TABLE leg_ends_queue IN SHARE ROW EXCLUSIVE MODE"))
+    t.execute(text("SET LOCAL extra_float_digits = 3"))
+
+    queue = t.execute(text("""
+        SELECT id, leg, old_user_id, user_id, cluster_start, cluster_end,
+            ST_X(old_coordinate_start::geometry) old_start_x,
+            ST_Y(old_coordinate_start::geometry) old_start_y,
+            ST_X(old_coordinate_end::geometry) old_end_x,
+            ST_Y(old_coordinate_end::geometry) old_end_y,
+            ST_X(coordinate_start::geometry) start_x,
+            ST_Y(coordinate_start::geometry) start_y,
+            ST_X(coordinate_end::geometry) end_x,
+            ST_Y(coordinate_end::geometry) end_y,
+            old_coordinate_start IS DISTINCT FROM coordinate_start
+                start_changed,
+            old_coordinate_end IS DISTINCT FROM coordinate_end end_changed
+        FROM leg_ends_queue
+        WHERE old_user_id = :user OR user_id = :user
+        ORDER BY id"""), user=user).fetchall()
+    if not queue:
+        return
+
+    def point(x, y):
+        return None if x is None else (x, y)
+
+    # Unlink and link steps as taken by legs_changed, as (key, unlink, old
+    # cluster, old coordinate, link, new coordinate)
+    steps = []
+    for r in queue:
+        old = [
+            ((r.leg, False), r.cluster_start,
+                point(r.old_start_x, r.old_start_y)),
+            ((r.leg, True), r.cluster_end, point(r.old_end_x, r.old_end_y))]
+        new = [point(r.start_x, r.start_y), point(r.end_x, r.end_y)]
+        if r.old_user_id != r.user_id:
+            if r.old_user_id == user:
+                steps += [(k, True, c, x, False, None) for k, c, x in old]
+            if r.user_id == user:
+                steps += [
+                    (k, False, None, None, True, x)
+                    for (k, _, _), x in zip(old, new)]
+        else:
+            for (k, c, x), y, changed in zip(
+                    old, new, (r.start_changed, r.end_changed)):
+                if changed:
+                    steps.append((k, True, c, x, True, y))
+
+    # Ends clustered before the queued changes, from the first step of each
+    # end queued, else the legs table
+    clusters = {
+        cid: point(x, y) for cid, x, y in t.execute(text("""
+            SELECT id, ST_X(coordinate::geometry), ST_Y(coordinate::geometry)
+            FROM leg_ends WHERE user_id = :user"""), user=user)}
+    ends = {}
+    queued = set()
+    for key, unlink, cluster, coordinate, _, _ in steps:
+        if key in queued:
+            continue
+        queued.add(key)
+        if unlink and cluster is not None:
+            ends[key] = cluster, coordinate
+    for leg, at_end, cid, x, y in t.execute(text("""
+            SELECT l.id, false, l.cluster_start,
+                ST_X(l.coordinate_start::geometry),
+                ST_Y(l.coordinate_start::geometry)
+            FROM legs l JOIN leg_ends e ON e.id = l.cluster_start
+            WHERE e.user_id = :user
+            UNION ALL
+            SELECT l.id, true, l.cluster_end,
+                ST_X(l.coordinate_end::geometry),
+                ST_Y(l.coordinate_end::geometry)
+            FROM legs l JOIN leg_ends e ON e.id = l.cluster_end
+            WHERE e.user_id = :user"""), user=user):
+        if (leg, at_end) not in queued:
+            ends[(leg, at_end)] = cid, point(x, y)
+
+    clusterer = LegEndsClusterer(
+        clusters, ends, 2*DEST_RADIUS_MAX,
+        [s[5] for s in steps if s[5] is not None])
+    for key, unlink, _, _, link, coordinate in steps:
+        if unlink:
+            clusterer.unlink(key)
+        if link:
+            clusterer.link(key, coordinate)
+    created, moved, deleted, relinked = clusterer.changes()
+
+    # Number new clusters from the sequence in order of creation
+    ids = {}
+    if created:
+        ids = dict(zip(sorted(created), (x for x, in t.execute(text("""
+            SELECT nextval(pg_get_serial_sequence('leg_ends', 'id'))
+            FROM generate_series(1, :n)"""), n=len(created)))))
+        t.execute(text("""
+            INSERT INTO leg_ends (id, user_id, coordinate)
+            SELECT id, :user,
+                ST_SetSRID(ST_MakePoint(x, y), 4326)::geography
+            FROM unnest(
+                CAST(:ids AS integer[]),
+                CAST(:xs AS double precision[]),
+                CAST(:ys AS double precision[])) v (id, x, y)
+            ORDER BY id"""),
+            user=user,
+            ids=[ids[c] for c in sorted(created)],
+            xs=[created[c][0] for c in sorted(created)],
+            ys=[created[c][1] for c in sorted(created)])
+
+    # Leave ends alone that meanwhile got clustered for another user
+    for at_end, column in ((False, "cluster_start"), (True, "cluster_end")):
+        changed = sorted(
+            (k[0], ids.get(c, c)) for k, c in relinked.items()
+            if k[1] == at_end)
+        if not changed:
+            continue
+        t.execute(text("""
+            UPDATE legs SET {0} = v.cluster
+            FROM unnest(
+                CAST(:legs AS integer[]), CAST(:clusters AS integer[]))
+                v (leg, cluster)
+            WHERE legs.id = v.leg
+            AND (legs.{0} IS NULL
+                OR legs.{0} = ANY(CAST(:owned AS integer[])))
+            """.format(column)),
+            legs=[x[0] for x in changed],
+            clusters=[x[1] for x in changed],
+            owned=sorted(clusters))
+
+    if moved:
+        t.execute(text("""
+            UPDATE leg_ends
+            SET coordinate =
+                ST_SetSRID(ST_MakePoint(v.x, v.y), 4326)::geography
+            FROM unnest(
+                CAST(:ids AS integer[]),
+                CAST(:xs AS double precision[]),
+                CAST(:ys AS double precision[])) v (id, x, y)
+            WHERE leg_ends.id = v.id"""),
+            ids=sorted(moved),
+            xs=[moved[c][0] for c in sorted(moved)],
+            ys=[moved[c][1] for c in sorted(moved)])
+
+    if deleted:
+        for column in ("cluster_start", "cluster_end"):
+            t.execute(text("""
+                UPDATE legs SET {0} = NULL
+                WHERE {0} = ANY(CAST(:ids AS integer[]))""".format(column)),
+                ids=deleted)
+        t.execute(text(
+            "DELETE FROM leg_ends WHERE id = ANY(CAST(:ids AS integer[]))"),
+            ids=deleted)
+
+    ids = [r.id for r in queue]
+    t.execute(text("""
+        UPDATE leg_ends_queue SET old_user_id = NULL
+        WHERE id = ANY(CAST(:ids AS bigint[])) AND old_user_id = :user"""),
+        ids=ids, user=user)
+    t.execute(text("""
+        UPDATE leg_ends_queue SET user_id = NULL
+        WHERE id = ANY(CAST(:ids AS bigint[])) AND user_id = :user"""),
+        ids=ids, user=user)
+    t.execute(text("""
+        DELETE FROM leg_ends_queue
+        WHERE id = ANY(CAST(:ids AS bigint[]))
+        AND old_user_id IS NULL AND user_id IS NULL"""),
+        ids=ids)
+
+
+def add_rating_distance(rating, activity, line_type, distance):
+    """Add km travelled with given activity and mass transit line type into
+    the matching category of EnergyRating."""
+    if activity == "IN_VEHICLE":
+        #TODO: handle FERRY somehow.
+        if line_type == "TRAIN":
+            rating.add_in_mass_transit_A_distance(distance)
+        elif line_type in ("TRAM", "SUBWAY"):
+            rating.add_in_mass_transit_B_distance(distance)
+        elif line_type == "BUS":
+            rating.add_in_mass_transit_C_distance(distance)
+        else:
+            rating.add_in_vehicle_distance(distance)
+    elif activity == "ON_BICYCLE":
+        rating.add_on_bicycle_distance(distance)
+    elif activity == "RUNNING":
+        rating.add_running_distance(distance)
+    elif activity == "WALKING":
+        rating.add_walking_distance(distance)
+
 
 def get_ratings_from_rows(filtered_data_rows, user_id):
     ratings = []
@@ -722,22 +1238,8 @@ def get_ratings_from_rows(filtered_data_rows, user_id):
 
         previous_location = current_location
 
-        if current_activity == "IN_VEHICLE":
-            #TODO: handle FERRY somehow.
-            if row["line_type"] == "TRAIN":
-                rating.add_in_mass_transit_A_distance(distance)
-            elif row["line_type"] in ("TRAM", "SUBWAY"):
-                rating.add_in_mass_transit_B_distance(distance)
-            elif row["line_type"] == "BUS":
-                rating.add_in_mass_transit_C_distance(distance)
-            else:
-                rating.add_in_vehicle_distance(distance)
-        elif current_activity == "ON_BICYCLE":
-            rating.add_on_bicycle_distance(distance)
-        elif current_activity == "RUNNING":
-            rating.add_running_distance(distance)
-        elif current_activity == "WALKING":
-            rating.add_walking_distance(distance)
+        add_rating_distance(
+            rating, current_activity, row["line_type"], distance)
 
     rating.calculate_rating()
     if not rating.is_empty():
@@ -745,88 +1247,73 @@ def get_ratings_from_rows(filtered_data_rows, user_id):
     return ratings
 
 
-def generate_rankings(time):
-    time_end = time + timedelta(days=1)
-    time_start = time_end - timedelta(days=7)
-    query = '''
-        SELECT user_id, total_distance, average_co2
-        FROM travelled_distances
-        WHERE time < :time_end
-        AND time >= :time_start
-    '''
-    travelled_distances_rows = db.engine.execute(text(query), time_start=time_start, time_end=time_end)
-
-    total_distances = {}
-    total_co2 = {}
-    totals = []
-    for row in travelled_distances_rows:
-        if row["total_distance"] is not None:
-            if row["user_id"] in total_distances:
-                total_distances[row["user_id"]] += row["total_distance"]
-                total_co2[row["user_id"]] += row["average_co2"] * row["total_distance"]
-            else:
-                total_distances[row["user_id"]] = row["total_distance"]
-                total_co2[row["user_id"]] = row["average_co2"] * row["total_distance"]
-    for user_id in total_distances:
-        totals.append((user_id, total_co2[user_id] / total_distances[user_id]))
-    totals_sorted = sorted(totals, key=lambda average_co2: average_co2[1])
-    batch = [
-        {   "user_id": totals_sorted[i][0],
-            "time": time,
-            "ranking": i + 1 }
-        for i in range(len(totals_sorted))]
-    if batch:
-        db.engine.execute(travelled_distances_table.insert(batch))
+def generate_rankings(start=None, end=None, unranked=False):
+    """Rank users by average co2 of the seven days up to each day between
+    start and end that has distances, weighted by distance, in one statement.
+    If unranked, only days that have unranked distances are ranked. Ranks of
+    users without distances on a ranked day are stored in a row of their own,
+    so as not to be taken for distances."""
+
+    db.engine.execute(text("""
+        WITH days AS (
+            SELECT DISTINCT time FROM travelled_distances
+            WHERE total_distance IS NOT NULL
+            AND (CAST(:start AS timestamp) IS NULL OR time >= :start)
+            AND (CAST(:end AS timestamp) IS NULL OR time < :end)
+            AND (NOT :unranked OR ranking IS NULL)),
+        weekly AS (
+            SELECT d.time, t.user_id,
+                sum(t.average_co2 * t.total_distance) / sum(t.total_distance)
+                    AS average_co2
+            FROM days d JOIN travelled_distances t
+            ON  t.time >= d.time - interval '6 days'
+            AND t.time < d.time + interval '1 day'
+            AND t.total_distance IS NOT NULL
+            GROUP BY d.time, t.user_id
+            HAVING sum(t.total_distance) > 0)
+        INSERT INTO travelled_distances (user_id, time, ranking)
+        SELECT user_id, time, row_number() OVER (
+            PARTITION BY time ORDER BY average_co2, user_id)
+        FROM weekly
+        ON CONFLICT (time, user_id) DO UPDATE SET ranking = EXCLUDED.ranking
+        """), start=start, end=end, unranked=unranked)
 
 
 def update_global_statistics(time_start, the_end):
-    while (time_start < the_end):
-        time_end = time_start + timedelta(days=1)
-        query = '''
-            SELECT total_distance, average_co2
-            FROM travelled_distances
-            WHERE time >= :time_start
-            AND time < :time_end
-        '''
-        travelled_distances_rows = db.engine.execute(text(query), time_start=time_start, time_end=time_end)
-        new = get_global_statistics_for_day(travelled_distances_rows, time_start)
-        time_start += timedelta(days=1)
-
-        # Manual upsert for older db
-        where = global_statistics_table.c.time == new["time"]
-        ex = db.engine.execute(global_statistics_table.select(where)).first()
-        if ex:
-            db.engine.execute(global_statistics_table.update(where, new))
-        else:
-            db.engine.execute(global_statistics_table.insert(new))
-
-
-def get_global_statistics_for_day(travelled_distances_rows, time):
-    time_end = time + timedelta(days=1)
-    time_start = time_end - timedelta(days=7)
-    query = '''
-        SELECT COUNT(DISTINCT user_id)
-        FROM travelled_distances
-        WHERE time < :time_end
-        AND time >= :time_start
-    '''
-    user_id_count_row = db.engine.execute(text(query), time_start=time_start, time_end=time_end).fetchone()
-    id_count = user_id_count_row["count"]
-
-    distance_sum = 0
-    total_co2 = 0
-    for row in travelled_distances_rows:
-        if row["total_distance"]:
-            distance_sum += row["total_distance"]
-            total_co2 += row["total_distance"] * row["average_co2"]
-    if distance_sum == 0:
-        average_co2 = 0
-    else:
-        average_co2 = total_co2 / distance_sum
-    return {'time':time,
-            'average_co2_usage':average_co2,
-            'past_week_certificates_number':id_count,
-            'total_distance':distance_sum}
+    """Upsert global_statistics of each day from time_start until the_end in
+    one statement: the distance weighted average co2 and total distance of
+    the day, and the count of users with distances in the seven days up to
+    it."""
+
+    db.engine.execute(text("""
+        INSERT INTO global_statistics (
+            time, average_co2_usage, past_week_certificates_number,
+            total_distance)
+        SELECT d.time,
+            coalesce(
+                sum(t.total_distance * t.average_co2)
+                    / nullif(sum(t.total_distance), 0),
+                0),
+            (   SELECT count(DISTINCT user_id) FROM travelled_distances w
+                WHERE w.time >= d.time - interval '6 days'
+                AND w.time < d.time + interval '1 day'),
+            coalesce(sum(t.total_distance), 0)
+        FROM generate_series(
+            CAST(:time_start AS timestamp),
+            CAST(:the_end AS timestamp),
+            interval '1 day') d(time)
+        LEFT JOIN travelled_distances t
+        ON  t.time >= d.time
+        AND t.time < d.time + interval '1 day'
+        AND t.total_distance <> 0
+        WHERE d.time < :the_end
+        GROUP BY d.time
+        ON CONFLICT (time) DO UPDATE SET
+            average_co2_usage = EXCLUDED.average_co2_usage,
+            past_week_certificates_number =
+                EXCLUDED.past_week_certificates_number,
+            total_distance = EXCLUDED.total_distance
+        """), time_start=time_start, the_end=the_end)
 
 
 def generate_csv(rows):
@@ -962,33 +1449,16 @@ def data_points_snapping(device_id, datetime_start, datetime_end):
     return points
 
 
-def get_waypoint_id_from_coordinate(coordinate):
-    """Return the identifier of the waypoint closest to a given coordinate.
-    :param: coordinate (geography(Point,4326))
-    :return: waypoint_id (bigint)
+def get_waypoint_ids_from_coordinates(coordinates):
+    """Return the identifiers of the waypoints closest to given coordinates
+    on the nearest road within 100m, or None if there is no such road.
+    :param: coordinates (list of (lon, lat))
+    :return: waypoint_ids (list of bigint or None)
     """
-    try:
-        row = db.engine.execute(text("""
-          SELECT id
-          FROM roads_waypoints
-          JOIN waypoints
-          ON waypoint_id = waypoints.id
-          LEFT JOIN LATERAL (
-            SELECT osm_id
-            FROM roads
-            WHERE ST_DWithin(roads.geo, :coordinate, 100)
-            ORDER BY ST_Distance(roads.geo, :coordinate) ASC
-            LIMIT 1
-          ) AS road ON true
-          WHERE road_id = road.osm_id
-          ORDER BY ST_Distance(waypoints.geo, :coordinate) ASC
-          LIMIT 1 ;"""), coordinate=coordinate).first()
-        if not row:
-            return None
-        return int(row[0])
-    except DataError as e:
-        print('Exception in get_waypoint_id_from_coordinate: ' + e.message)
-    return None
+    if not coordinates:
+        return []
+    return get_road_snapper().snap(
+        [x for x, _ in coordinates], [y for _, y in coordinates])
 
 
 def match_mass_transit_legs(device, tstart, tend, activity):
@@ -1150,6 +1620,143 @@ nearest AS (
         nsamples=nsamples)
 
 
+def match_mass_transit_live_batch(
+        device, legs, tradius, dradius, nsamples, chunk=100):
+    """Find mass transit vehicles near user during each of many trip legs of
+    a device, scored as by match_mass_transit_live.
+
+    Arguments:
+    legs -- sequence of (tstart, tend) of the legs
+    chunk -- number of legs matched per query
+
+    Returns a list with for each leg the result rows of match_mass_transit_live
+    in the same order, followed by the leg index column n, or None if no mass
+    transit vehicle data exists prior to tstart.
+    """
+
+    legs = list(legs)
+    results = [None] * len(legs)
+
+    # Find out how far back mass_transit_data extends.
+    first = db.engine.execute(select(
+        [func.min(mass_transit_data_table.c.time)])).scalar()
+    if first is None:
+        return results
+    indices = [i for i, (tstart, tend) in enumerate(legs) if first <= tstart]
+
+    query = text("""
+
+-- the legs, numbered by position in the batch
+WITH legs AS (
+    SELECT n, tstart, tend
+    FROM unnest(
+        CAST(:tstarts AS timestamp[]),
+        CAST(:tends AS timestamp[]),
+        CAST(:ns AS integer[])) AS l(tstart, tend, n)),
+
+-- find the relevant device data points
+fulltrace AS (
+    SELECT
+        l.n, d.coordinate, d.id, d.time,
+        row_number() OVER (PARTITION BY l.n ORDER BY d.time) rn
+    FROM legs l JOIN device_data d
+    ON d.device_id = :device AND d.time >= l.tstart AND d.time <= l.tend),
+
+-- sample from full trace to limit quadratic matching; uses integer sampling
+-- interval so will end up with between [n/2, n] samples
+trace AS (
+    SELECT f.*
+    FROM fulltrace f JOIN (
+        SELECT n, ceil((1 + max(rn)) / (1.0 + :nsamples)) step
+        FROM fulltrace GROUP BY n) s
+    ON s.n = f.n
+    WHERE f.rn % s.step = 0),
+
+tracecount AS (
+    SELECT n, count(*) c FROM trace GROUP BY n),
+
+-- rough bbox margin meters to degrees of lon at lat, so overshoots on latitude
+m2lon AS (
+    SELECT n, :dradius
+        / cos(pi() * max(abs(ST_Y(coordinate::geometry))) / 180)
+        / 110574 AS x
+    FROM trace GROUP BY n),
+
+-- bounding box for mass transit data, expand not symmetric in m but that's ok
+bbox AS (
+    SELECT t.n, ST_Expand(ST_Extent(t.coordinate::geometry), m.x) x
+    FROM trace t JOIN m2lon m ON m.n = t.n
+    GROUP BY t.n, m.x),
+
+-- bound the mass transit data in time and space
+boxed AS (
+    SELECT l.n, m.coordinate, m.vehicle_ref, m.line_type, m.line_name, m.time
+    FROM legs l
+        JOIN bbox b ON b.n = l.n
+        JOIN mass_transit_data m
+        ON m.time > l.tstart - interval ':tradius seconds'
+            AND m.time < l.tend + interval ':tradius seconds'
+            AND m.coordinate::geometry @ b.x),
+
+-- Join device points with linestrings of the trace of each vehicle around that
+-- time. The line_name changes randomly on some vehicles, pick most frequent.
+linetraces AS (
+    SELECT
+        d.n,
+        d.id,
+        d.coordinate,
+        m.vehicle_ref,
+        ST_MakeLine(m.coordinate::geometry ORDER BY m.time) line_trace,
+        mode() WITHIN GROUP (ORDER BY m.line_type) line_type,
+        mode() WITHIN GROUP (ORDER BY m.line_name) line_name
+    FROM boxed m JOIN trace d
+    ON m.n = d.n AND abs(extract(epoch from (m.time - d.time))) <= :tradius
+    GROUP BY d.n, d.id, d.coordinate, m.vehicle_ref),
+
+-- Score matches by the distance inward of the match radius.
+nearest AS (
+    SELECT
+        n,
+        id,
+        vehicle_ref,
+        line_type,
+        line_name,
+        :dradius - ST_Distance(line_trace, coordinate) revdist
+    FROM linetraces
+    WHERE ST_Distance(line_trace, coordinate) <= :dradius)
+
+-- Sum scores and count matches over user location trace. Some vehicles'
+-- line_name and other fields flip randomly, pick most frequent.
+    SELECT
+        sum(revdist) revsum,
+        1.0 * count(*) / t.c hitrate,
+        vehicle_ref,
+        mode() WITHIN GROUP (ORDER BY line_type) line_type,
+        mode() WITHIN GROUP (ORDER BY line_name) line_name,
+        e.n
+    FROM nearest e JOIN tracecount t ON t.n = e.n
+    GROUP BY e.n, t.c, vehicle_ref
+    ORDER BY e.n, hitrate desc, revsum desc""")
+
+    for i in range(0, len(indices), chunk):
+        ns = indices[i:i + chunk]
+        for n in ns:
+            results[n] = []
+        rows = db.engine.execute(
+            query,
+            device=device,
+            tstarts=[legs[n][0] for n in ns],
+            tends=[legs[n][1] for n in ns],
+            ns=ns,
+            tradius=tradius,
+            dradius=dradius,
+            nsamples=nsamples)
+        for row in rows:
+            results[row.n].append(row)
+
+    return results
+
+
 def hsl_alerts_insert(alerts):
     if alerts:
         db.engine.execute(hsl_alerts_table.insert(alerts))
@@ -1640,6 +2247,200 @@ def device_data_table_insert(batch):
     db.engine.execute(device_data_table.insert(batch))
 
 
+def point_ewkb_hex(lon, lat):
+    """Hex EWKB of a WGS 84 point, as PostGIS takes for geography input
+    without parsing WKT."""
+    # little endian, point type with SRID flag, SRID 4326, x, y
+    return (b"\x01" + struct.pack("<IIdd", 0x20000001, 4326, lon, lat)).hex()
+
+
+def copy_cursor(cursor, table_name, columns, rows):
+    """COPY rows, tuples of given columns, into table on a DBAPI cursor.
+    Returns the row count."""
+
+    buf = StringIO()
+    out = writer(buf)
+    count = 0
+    for row in rows:
+        out.writerow(row) # None is written as unquoted empty, NULL in COPY
+        count += 1
+    buf.seek(0)
+
+    cursor.copy_expert(
+        "COPY %s (%s) FROM STDIN WITH (FORMAT csv)" % (
+            table_name, ", ".join(columns)),
+        buf)
+    return count
+
+
+device_data_copy_columns = (
+    'device_id', 'coordinate', 'accuracy', 'time',
+    'activity_1', 'activity_1_conf',
+    'activity_2', 'activity_2_conf',
+    'activity_3', 'activity_3_conf')
+
+
+def device_data_table_copy(batch):
+    """Insert dicts of device_data_copy_columns, coordinate as from
+    point_ewkb_hex, missing activities as null."""
+    return device_data_copy(
+        tuple(x.get(c) for c in device_data_copy_columns) for x in batch)
+
+
+def device_data_copy(rows):
+    """Insert rows, tuples of device_data_copy_columns, in one transaction,
+    skipping ones of an existing device_id and time. Rows are copied into a
+    staging table, from which they are inserted. Returns count inserted."""
+
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        # Kept for the life of the pooled connection, emptied on commit, to
+        # spare each upload creating and dropping a table
+        cursor.execute("""
+            CREATE TEMPORARY TABLE IF NOT EXISTS device_data_staging
+            ON COMMIT DELETE ROWS AS
+            SELECT {0} FROM device_data WITH NO DATA""".format(
+                ", ".join(device_data_copy_columns)))
+        copy_cursor(
+            cursor, "device_data_staging", device_data_copy_columns, rows)
+        # Skipped only once idx_device_data_device_id_time is unique, see
+        # device_data_delete_duplicates
+        cursor.execute("""
+            INSERT INTO device_data ({0})
+            SELECT {0} FROM device_data_staging
+            ON CONFLICT DO NOTHING""".format(
+                ", ".join(device_data_copy_columns)))
+        count = cursor.rowcount
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return count
+
+
+mass_transit_data_copy_columns = (
+    'coordinate', 'time', 'line_type', 'line_name', 'direction', 'vehicle_ref')
+
+# Live vehicle positions are accepted from the day before until the end of the
+# day after, as mass_transit_cleanup would delete others from the future
+MASS_TRANSIT_DATA_WINDOW = """
+    time >= current_date - 1 AND time < current_date + 2"""
+
+
+def create_mass_transit_data_partitioned(t):
+    t.execute(text("""
+        CREATE TABLE mass_transit_data (
+            id serial NOT NULL,
+            coordinate geography(point, 4326) NOT NULL,
+            time timestamp NOT NULL,
+            line_type mass_transit_type_enum NOT NULL,
+            line_name varchar NOT NULL,
+            direction integer,
+            vehicle_ref varchar NOT NULL)
+        PARTITION BY RANGE (time)"""))
+
+
+def partition_mass_transit_data(keep_days=None):
+    """Upgrade plain mass_transit_data table to daily partitions, moving over
+    rows within keep_days."""
+
+    with db.engine.begin() as t:
+        kind = t.execute(text(
+            "SELECT relkind FROM pg_class "
+            "WHERE oid = to_regclass('mass_transit_data')")).scalar()
+        if kind != "r":
+            return
+
+        print("Partitioning mass_transit_data...")
+        keep = keep_days and "time >= current_date - %d" % keep_days or "true"
+        t.execute(text(
+            "ALTER TABLE mass_transit_data RENAME TO mass_transit_data_plain"))
+        create_mass_transit_data_partitioned(t)
+        t.execute(text("""
+            SELECT mass_transit_data_partition(d) FROM (
+                SELECT DISTINCT time::date d FROM mass_transit_data_plain
+                WHERE {0} AND time < current_date + 2) days""".format(keep)))
+        moved = t.execute(text("""
+            INSERT INTO mass_transit_data ({1})
+            SELECT {1} FROM mass_transit_data_plain
+            WHERE {0} AND time < current_date + 2
+            ON CONFLICT DO NOTHING""".format(
+                keep, ", ".join(mass_transit_data_copy_columns)))).rowcount
+        t.execute(text("DROP TABLE mass_transit_data_plain"))
+        print("Moved %d rows into mass_transit_data partitions." % moved)
+
+
+def upgrade_statistics_upserts():
+    """Replace the travelled_distances insert rule and the non-unique
+    global_statistics time index, which INSERT ... ON CONFLICT needs
+    unique, keeping the latest of duplicate days."""
+
+    with db.engine.begin() as t:
+        t.execute(text("""
+            DROP RULE IF EXISTS travelled_distances_table_duplicate_update
+            ON travelled_distances"""))
+        t.execute(text("""
+            DELETE FROM global_statistics g USING global_statistics h
+            WHERE h.time = g.time AND h.id > g.id"""))
+        t.execute(text("DROP INDEX IF EXISTS idx_global_statistics_time"))
+        t.execute(text("""
+            CREATE UNIQUE INDEX idx_global_statistics_time
+            ON global_statistics (time)"""))
+
+
+def mass_transit_data_copy(rows):
+    """Insert dicts of mass_transit_data_copy_columns, skipping existing
+    (time, vehicle_ref) and ones outside MASS_TRANSIT_DATA_WINDOW. Rows are
+    copied into a staging table, from which they are inserted into daily
+    partitions, creating those as needed. Returns count inserted."""
+
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TEMPORARY TABLE mass_transit_staging ON COMMIT DROP AS
+            SELECT {0} FROM mass_transit_data WITH NO DATA""".format(
+                ", ".join(mass_transit_data_copy_columns)))
+        copy_cursor(
+            cursor, "mass_transit_staging", mass_transit_data_copy_columns,
+            (tuple(x.get(c) for c in mass_transit_data_copy_columns)
+                for x in rows))
+        cursor.execute("""
+            SELECT mass_transit_data_partition(d) FROM (
+                SELECT DISTINCT time::date d FROM mass_transit_staging
+                WHERE {0}) days""".format(MASS_TRANSIT_DATA_WINDOW))
+        # Partitioned tables take no conflict target in PostgreSQL 10, the
+        # unique index of the partition applies
+        cursor.execute("""
+            INSERT INTO mass_transit_data ({1})
+            SELECT {1} FROM mass_transit_staging WHERE {0}
+            ON CONFLICT DO NOTHING""".format(
+                MASS_TRANSIT_DATA_WINDOW,
+                ", ".join(mass_transit_data_copy_columns)))
+        count = cursor.rowcount
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return count
+
+
+def mass_transit_data_partitions():
+    """Names and days of partitions of mass_transit_data."""
+    rows = db.engine.execute(text("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass('mass_transit_data')"""))
+    prefix = "mass_transit_data_p"
+    return sorted(
+        (r[0], datetime.datetime.strptime(r[0][len(prefix):], "%Y%m%d").date())
+        for r in rows if r[0].startswith(prefix))
+
+
 def device_location_table_insert(batch):
     db.engine.execute(device_location_table.insert(batch))
 
@@ -1664,14 +2465,194 @@ def db_engine_execute(query):
     return db.engine.execute(query)
 
 
-def device_data_delete_duplicates():
-    with open('sql/delete_duplicate_device_data.sql', 'r') as sql_file:
-        return db_engine_execute(text(sql_file.read())).rowcount
-
-
-def device_data_waypoint_snapping():
-    with open('sql/snapping.sql') as sql_file:
-        return db.engine.execute(text(sql_file.read())).rowcount
+def device_data_delete_duplicates(step=1000000, max_seconds=600):
+    """Delete device_data points repeating the device_id and time of one with
+    a lower id, walking ids in ranges of step from the watermark kept in
+    device_data_dedupe, each range in a transaction of its own, for up to
+    about max_seconds a run. Once caught up, idx_device_data_device_id_time
+    is made unique, after which duplicates are skipped on insert and this
+    does nothing. Returns the number of points deleted."""
+
+    if device_data_unique():
+        return 0
+
+    delete = text("""
+        DELETE FROM device_data d
+        WHERE d.id > :lo AND d.id <= :hi
+        AND EXISTS (
+            SELECT 1 FROM device_data e
+            WHERE e.device_id = d.device_id AND e.time = d.time
+            AND e.id < d.id)""")
+
+    t0 = time.time()
+    count = 0
+    watermark = db.engine.execute(text(
+        "SELECT watermark FROM device_data_dedupe")).scalar() or 0
+    last = db.engine.execute(text(
+        "SELECT coalesce(max(id), 0) FROM device_data")).scalar()
+    while watermark < last:
+        if time.time() - t0 > max_seconds:
+            print("device_data_delete_duplicates: at id %d of %d" % (
+                watermark, last))
+            return count
+        hi = min(watermark + step, last)
+        with db.engine.begin() as t:
+            count += t.execute(delete, lo=watermark, hi=hi).rowcount
+            set_device_data_dedupe_watermark(t, hi)
+        watermark = hi
+
+    # Catch up with points committed meanwhile, some possibly with ids below
+    # the watermark
+    with db.engine.begin() as t:
+        last = t.execute(text(
+            "SELECT coalesce(max(id), 0) FROM device_data")).scalar()
+        count += t.execute(
+            delete, lo=max(0, watermark - step), hi=last).rowcount
+        set_device_data_dedupe_watermark(t, last)
+
+    # Build the unique index beside the old one without blocking writers,
+    # unless a previous run did already. Points inserted meanwhile may fail
+    # the build, leaving an invalid index behind; drop it, and retry on a
+    # later run after deleting those too.
+    if not device_data_unique_built():
+        conn = db.engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT")
+        try:
+            conn.execute(text("""
+                DROP INDEX CONCURRENTLY IF EXISTS
+                idx_device_data_device_id_time_unique"""))
+            conn.execute(text("""
+                CREATE UNIQUE INDEX CONCURRENTLY
+                idx_device_data_device_id_time_unique
+                ON device_data (device_id, time)"""))
+        except IntegrityError as e:
+            print("device_data_delete_duplicates: unique index failed:", e)
+            conn.execute(text("""
+                DROP INDEX CONCURRENTLY IF EXISTS
+                idx_device_data_device_id_time_unique"""))
+            return count
+        finally:
+            conn.close()
+
+    # Swap names, giving up to retry on a later run rather than queue
+    # writers behind a long wait for the exclusive lock
+    try:
+        with db.engine.begin() as t:
+            t.execute(text("SET LOCAL lock_timeout = '10s'"))
+            t.execute(text(
+                "DROP INDEX IF EXISTS idx_device_data_device_id_time"))
+            t.execute(text("""
+                ALTER INDEX idx_device_data_device_id_time_unique
+                RENAME TO idx_device_data_device_id_time"""))
+    except OperationalError as e:
+        print("device_data_delete_duplicates: index swap failed:", e)
+        return count
+    print("device_data_delete_duplicates: done, device_id, time unique")
+    return count
+
+
+def set_device_data_dedupe_watermark(t, watermark):
+    t.execute(text("DELETE FROM device_data_dedupe"))
+    t.execute(text(
+        "INSERT INTO device_data_dedupe (watermark) VALUES (:watermark)"),
+        watermark=watermark)
+
+
+def device_data_unique_built():
+    """Whether idx_device_data_device_id_time_unique is built and valid,
+    awaiting the swap in device_data_delete_duplicates."""
+    return bool(db.engine.execute(text("""
+        SELECT indisvalid FROM pg_index
+        WHERE indexrelid = to_regclass('idx_device_data_device_id_time_unique')
+        """)).scalar())
+
+
+def device_data_unique():
+    """Whether idx_device_data_device_id_time is unique, as created on new
+    databases, or once device_data_delete_duplicates is done."""
+    return bool(db.engine.execute(text("""
+        SELECT indisunique FROM pg_index
+        WHERE indexrelid = to_regclass('idx_device_data_device_id_time')
+        """)).scalar())
+
+
+def get_road_snapper():
+    """RoadSnapper of the roads and roads_waypoints tables, loaded once per
+    process; restart to pick up changes to them."""
+
+    global road_snapper
+    with road_snapper_lock:
+        if road_snapper is None:
+            road_snapper = load_road_snapper()
+        return road_snapper
+
+
+def load_road_snapper():
+    # Road parts as binary, parsed faster than coordinates as rows
+    rows = db.engine.execute(text("""
+        SELECT roads.osm_id, ST_AsBinary(ST_Force2D(part.geom), 'NDR')
+        FROM roads, ST_Dump(roads.geo::geometry) AS part
+        WHERE GeometryType(part.geom) IN ('LINESTRING', 'POINT')"""))
+    lines = [(osm_id, wkb_vertices(bytes(wkb))) for osm_id, wkb in rows]
+
+    waypoints = db.engine.execute(text("""
+        SELECT
+            array_agg(id),
+            array_agg(ST_X(geo::geometry)),
+            array_agg(ST_Y(geo::geometry))
+        FROM waypoints
+        WHERE id IN (SELECT waypoint_id FROM roads_waypoints)""")).first()
+    links = db.engine.execute(text("""
+        SELECT array_agg(road_id), array_agg(waypoint_id)
+        FROM roads_waypoints""")).first()
+
+    print("load_road_snapper: %d road parts, %d waypoints" % (
+        len(lines), len(waypoints[0] or [])))
+    return RoadSnapper(
+        lines,
+        [x or [] for x in waypoints],
+        [x or [] for x in links],
+        radius=100)
+
+
+def device_data_waypoint_snapping(chunk_size=100000):
+    """Snap device_data points not snapped yet to the nearest waypoint of the
+    nearest road, in order of id, committing chunk_size points at a time.
+    Points added meanwhile are left for the next run. Returns the number of
+    points snapped."""
+
+    first, last = db.engine.execute(text("""
+        SELECT min(id), max(id) FROM device_data
+        WHERE snapping_time IS NULL""")).first()
+    if first is None:
+        return 0
+
+    snapper = get_road_snapper()
+    count = 0
+    while first <= last:
+        with db.engine.begin() as t:
+            rows = t.execute(text("""
+                SELECT id,
+                    ST_X(coordinate::geometry) x, ST_Y(coordinate::geometry) y
+                FROM device_data
+                WHERE snapping_time IS NULL AND id BETWEEN :first AND :last
+                ORDER BY id
+                LIMIT :n"""), first=first, last=last, n=chunk_size).fetchall()
+            if not rows:
+                break
+            waypoints = snapper.snap(
+                [r.x for r in rows], [r.y for r in rows])
+            t.execute(text("""
+                UPDATE device_data
+                SET waypoint_id = v.waypoint_id, snapping_time = now()
+                FROM unnest(
+                    CAST(:ids AS integer[]), CAST(:waypoints AS bigint[]))
+                    v (id, waypoint_id)
+                WHERE device_data.id = v.id"""),
+                ids=[r.id for r in rows], waypoints=waypoints)
+        count += len(rows)
+        first = rows[-1].id + 1
+    return count
 
 # Database version helper functions
 
@@ -1701,13 +2682,14 @@ def upgrade_database_version(new_db_version):
 # Query for CSV-strings
 
 
-def get_csv(query):
-    rows = db.engine.execute(query)
-    buf = StringIO()
-    csv = DictWriter(buf, list(rows.keys()))
-    csv.writeheader()
-    for r in rows:
-        r = {k: v.encode("utf8") if isinstance(v, str) else v
-             for k, v in list(r.items())}
-        csv.writerow(r)
-    return buf.getvalue()
+def get_csv_chunks(query, size=10000):
+    """CSV of query results as encoded chunks of up to size rows, read
+    through a server side cursor so that memory use does not grow with the
+    result."""
+    with db.engine.connect() as conn:
+        rows = conn.execution_options(stream_results=True).execute(
+            text(query))
+        for chunk in csv_chunks(
+                rows.keys(), iter(lambda: rows.fetchmany(size), [])):
+            yield chunk
+
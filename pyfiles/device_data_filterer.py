@@ -3,9 +3,11 @@ import json
 from itertools import chain
 
 from pyfiles.common_helpers import (
+    daily_distances,
     get_distance_between_coordinates,
     pairwise,
-    point_distance,
+    path_length,
+    point_coordinates,
     point_interval,
     trace_center,
     trace_discard_inaccurate,
@@ -26,22 +28,33 @@ from pyfiles.constants import (
     NUMBER_OF_MASS_TRANSIT_MATCH_SAMPLES,
     STOP_BREAK_INTERVAL)
 
+from pyfiles.activity_stabilizer import window_best_activities
+
 from pyfiles.database_interface import (
     device_data_filtered_table_insert,
     match_mass_transit_filtered,
     match_mass_transit_legs,
-    match_mass_transit_live)
+    match_mass_transit_live,
+    match_mass_transit_live_batch)
+
+from pyfiles.journey_planner import ERROR_DATE_TOO_FAR
 
 from pyfiles.mass_transit_match_planner import (
     find_same_journey_time_this_week, match_tripleg_with_publictransport,
-    minSpeeds, TripMatchedWithPlannerResult)
+    minSpeeds, planner_query, TripMatchedWithPlannerResult)
 
 # if enabled, records matching results of each user in a separate csv file
 DUMP_CSV_FILES = False
 
 class DeviceDataFilterer:
 
-    def __init__(self):
+    def __init__(self, vehicle_index=None, planner=None):
+        """Legs are matched against vehicle positions of the optional
+        VehicleTraceIndex where it covers them, else in the database. The
+        journey planner is queried through JourneyPlannerClient planner if
+        given, else directly."""
+        self.vehicle_index = vehicle_index
+        self.planner = planner
         self.previous_activity_1 = "NOT_SET"
         self.previous_activity_2 = "NOT_SET"
         self.previous_activity_3 = "NOT_SET"
@@ -53,17 +66,18 @@ class DeviceDataFilterer:
         self.file_triplegs = None
         self.file_finalstats = None
 
+        # Results of batched queries made ahead for the legs being generated,
+        # by device, start and end time, consumed by the per leg matching
+        self.prefetched_legs = {}
+        self.prefetched_live = {}
+
 	# mehrdad: note: works on one trip-leg with specific activity of specific userid (trip-legs found by analyze_unfiltered_data())
     def _match_mass_transit(self, device_data_queue, activity, user_id):
 
         """Find mass transit match for leg in device_data_queue, using legacy
         filtered data, live vehicle locations, and trip planner."""
 
-        # Use only relatively accurate points for mass transit matching, also
-        # necessary so that matching previously recorded legs works...
-        if device_data_queue and "accuracy" in device_data_queue[0]:
-            device_data_queue = list(trace_discard_inaccurate(
-                device_data_queue, DEST_RADIUS_MAX / 2))
+        device_data_queue = self._matching_points(device_data_queue)
 
         if len(device_data_queue) < 2:
             return {}
@@ -98,10 +112,117 @@ class DeviceDataFilterer:
         return matches
 
 
+    def _matching_points(self, device_data_queue):
+        # Use only relatively accurate points for mass transit matching, also
+        # necessary so that matching previously recorded legs works...
+        if device_data_queue and "accuracy" in device_data_queue[0]:
+            device_data_queue = list(trace_discard_inaccurate(
+                device_data_queue, DEST_RADIUS_MAX / 2))
+        return device_data_queue
+
+
+    def _prefetch_live_matches(self, legs):
+        """Match all IN_VEHICLE legs, given as (points, activity), that have
+        no recorded matches to reuse against live vehicle data in batch."""
+
+        queues = []
+        for legpts, legact in legs:
+            if legact != "IN_VEHICLE":
+                continue
+            queue = self._matching_points(legpts)
+            if len(queue) < 2:
+                continue
+            key = (queue[0]["device_id"], queue[0]["time"], queue[-1]["time"])
+            reuse = match_mass_transit_legs(*(key + (legact,)))
+            self.prefetched_legs[key + (legact,)] = reuse
+            if reuse is None and not self._vehicle_index_covers(queue):
+                queues.append(queue)
+
+        if not queues:
+            return
+
+        results = match_mass_transit_live_batch(
+            queues[0][0]["device_id"],
+            [(x[0]["time"], x[-1]["time"]) for x in queues],
+            MAX_MASS_TRANSIT_TIME_DIFFERENCE,
+            MAX_MASS_TRANSIT_DISTANCE_DIFFERENCE,
+            NUMBER_OF_MASS_TRANSIT_MATCH_SAMPLES)
+        for queue, result in zip(queues, results):
+            key = (queue[0]["device_id"], queue[0]["time"], queue[-1]["time"])
+            self.prefetched_live[key] = result
+
+
+    def _prefetch_planner(self, legs):
+        """Query journey planner in parallel for the IN_VEHICLE legs, given
+        as (points, activity), that have no recorded matches to reuse, so
+        that matching them one by one is answered from its cache."""
+
+        if self.planner is None:
+            return
+
+        queries = []
+        starts = []
+        for legpts, legact in legs:
+            if legact != "IN_VEHICLE":
+                continue
+            queue = self._matching_points(legpts)
+            if len(queue) < 2:
+                continue
+            key = (queue[0]["device_id"], queue[0]["time"], queue[-1]["time"])
+            if self.prefetched_legs.get(key + (legact,)) is not None:
+                continue
+            start_location = point_coordinates(queue[0])
+            end_location = point_coordinates(queue[-1])
+            if get_distance_between_coordinates(
+                    start_location, end_location) <= 200:
+                continue # not queried, see _match_mass_transit_planner
+            queries.append(planner_query(
+                '{1},{0}'.format(*start_location),
+                '{1},{0}'.format(*end_location),
+                queue[0]["time"]))
+            starts.append(queue[0]["time"])
+
+        # Retry of _match_mass_transit_planner with current week
+        retries = [
+            planner_query(q[0], q[1], find_same_journey_time_this_week(t))
+            for q, t, r in zip(
+                queries, starts, self.planner.prefetch(queries))
+            if r.get("error", {}).get("id") == ERROR_DATE_TOO_FAR]
+        self.planner.prefetch(retries)
+
+
+    def _vehicle_index_covers(self, device_data_queue):
+        return self.vehicle_index is not None and self.vehicle_index.covers(
+            device_data_queue[0]["time"], MAX_MASS_TRANSIT_TIME_DIFFERENCE)
+
+
     def generate_device_legs(self, points, start=None):
         """Generate sequence of stationary and moving segments of same activity
-        from the raw trace of one device. Legs found in points before the start
-        time, if given, are not emitted."""
+        from the raw trace of one device, given as device data rows or Trace.
+        Legs found in points before the start time, if given, are not
+        emitted. Mass transit matching is done for all legs at once, after
+        detecting them."""
+
+        self.prefetched_legs = {}
+        self.prefetched_live = {}
+        legs = list(self._detect_device_legs(points, start))
+        moving = [(legpts, legact) for leg, legpts, legact in legs if legpts]
+        self._prefetch_live_matches(moving)
+        self._prefetch_planner(moving)
+        try:
+            for leg, legpts, legact in legs:
+                if legpts is None:
+                    yield leg, {}
+                else:
+                    yield leg, self._match_mass_transit(legpts, legact, None)
+        finally:
+            self.prefetched_legs = {}
+            self.prefetched_live = {}
+
+
+    def _detect_device_legs(self, points, start=None):
+        """Generate stationary and moving legs, as (leg, points, activity) with
+        points None for stationary legs."""
 
         # Filter out bogus location points.
         points = trace_discard_sidesteps(points, BAD_LOCATION_RADIUS)
@@ -137,7 +258,7 @@ class DeviceDataFilterer:
                         "type": "Point",
                         "coordinates": trace_center(trace_discard_inaccurate(
                             seg, DEST_RADIUS_MAX / 2))}),
-                    "activity": "STILL"}, {}
+                    "activity": "STILL"}, None, None
                 continue
 
             # Join move segment to subsequent stop if it comes soon enough
@@ -167,8 +288,7 @@ class DeviceDataFilterer:
                 if start and legpts[0]["time"] < start:
                     continue
 
-                km = .001 * sum(
-                    point_distance(p0, p1) for p0, p1 in pairwise(legpts))
+                km = .001 * path_length(legpts)
 
                 leg = {
                     "time_start": legpts[0]["time"],
@@ -176,9 +296,10 @@ class DeviceDataFilterer:
                     "geojson_start": legpts[0]["geojson"],
                     "geojson_end": legpts[-1]["geojson"],
                     "activity": legact,
-                    "km": km}
+                    "km": km,
+                    "distances": daily_distances(legpts)}
 
-                yield leg, self._match_mass_transit(legpts, legact, None)
+                yield leg, legpts, legact
 
 
     def generate_filtered_data(self, device_data_rows, user_id):
@@ -216,8 +337,8 @@ class DeviceDataFilterer:
             end_row = device_data_queue[trip_leg_points-1]
 
             # do the rest ...:
-            start_location = json.loads(start_row["geojson"])["coordinates"]
-            end_location = json.loads(end_row["geojson"])["coordinates"]
+            start_location = point_coordinates(start_row)
+            end_location = point_coordinates(end_row)
             start_time  = start_row['time']
             end_time  = end_row['time']
             distance = get_distance_between_coordinates(start_location, end_location) # TODO: should get 'distance' value from the calculated more realistic traveled distances
@@ -237,14 +358,14 @@ class DeviceDataFilterer:
             if distance > 200:
                 # try to match this trip-leg with a public transport ride (using hsl query)
                 # print "we're sending this to match function:", start_location_str, end_location_str, start_time, end_time
-                res, matchres = match_tripleg_with_publictransport(start_location_str, end_location_str, start_time, end_time, device_data_queue)
+                res, matchres = match_tripleg_with_publictransport(start_location_str, end_location_str, start_time, end_time, device_data_queue, self.planner)
                 
                 if res == HSL_ERROR_CODE_DATE_TOO_FAR: # second try (adjust the old weekday to current week)
                     print("")
                     print("failed because: HSL_ERROR_CODE_DATE_TOO_FAR !, trying second time with current week...")
                     starttime_thisweek = find_same_journey_time_this_week(start_time)
                     endtime_thisweek = find_same_journey_time_this_week(end_time)
-                    res, matchres = match_tripleg_with_publictransport(start_location_str, end_location_str, starttime_thisweek, endtime_thisweek, device_data_queue)
+                    res, matchres = match_tripleg_with_publictransport(start_location_str, end_location_str, starttime_thisweek, endtime_thisweek, device_data_queue, self.planner)
                                                 
                 # if managed to match the trip-leg with one public transport ride using HSL query                                                
                 if res == 1 and matchres.matchcount > 0: 
@@ -295,7 +416,7 @@ class DeviceDataFilterer:
         filtered_device_data = []
 
         for device_data_row in device_data_queue:
-            current_location = json.loads(device_data_row["geojson"])["coordinates"]
+            current_location = point_coordinates(device_data_row)
             filtered_device_data.append({"activity" : activity,
                                          "user_id" : user_id,
                                          'coordinate': 'POINT(%f %f)' % (float(current_location[0]), float(current_location[1])),
@@ -308,11 +429,14 @@ class DeviceDataFilterer:
 
 
     def _match_mass_transit_legs(self, activity, device_data_queue):
-        return match_mass_transit_legs(
+        key = (
             device_data_queue[0]["device_id"],
             device_data_queue[0]["time"],
             device_data_queue[-1]["time"],
             activity)
+        if key in self.prefetched_legs:
+            return self.prefetched_legs.pop(key)
+        return match_mass_transit_legs(*key)
 
 
     def _match_mass_transit_filtered(self, device_data_queue):
@@ -327,21 +451,31 @@ class DeviceDataFilterer:
         tstart = device_data_queue[0]["time"]
         tend = device_data_queue[-1]["time"]
 
-        matches = match_mass_transit_live(
-            device, tstart, tend,
-            MAX_MASS_TRANSIT_TIME_DIFFERENCE,
-            MAX_MASS_TRANSIT_DISTANCE_DIFFERENCE,
-            NUMBER_OF_MASS_TRANSIT_MATCH_SAMPLES)
+        key = (device, tstart, tend)
+        if self._vehicle_index_covers(device_data_queue):
+            matches = self.vehicle_index.match(
+                device_data_queue,
+                MAX_MASS_TRANSIT_TIME_DIFFERENCE,
+                MAX_MASS_TRANSIT_DISTANCE_DIFFERENCE,
+                NUMBER_OF_MASS_TRANSIT_MATCH_SAMPLES)
+        elif key in self.prefetched_live:
+            matches = self.prefetched_live.pop(key)
+        else:
+            matches = match_mass_transit_live(
+                device, tstart, tend,
+                MAX_MASS_TRANSIT_TIME_DIFFERENCE,
+                MAX_MASS_TRANSIT_DISTANCE_DIFFERENCE,
+                NUMBER_OF_MASS_TRANSIT_MATCH_SAMPLES)
+            if matches is not None:
+                matches = matches.fetchall()
 
         if matches is None:
             print("no vehicle data available")
             return None
 
-        matches = matches.fetchall()
-
         print("d"+str(device), str(tstart)[:16], str(tend)[11:16], \
             str(len(device_data_queue))+"p:", ", ".join("%.2f %i %s" % (
-                x[1], x[0], " ".join(x[2:])) for x in matches) \
+                x[1], x[0], " ".join(x[2:5])) for x in matches) \
             or "no nearby vehicles")
 
         hitreq = ((1.0*
@@ -349,52 +483,17 @@ class DeviceDataFilterer:
               - MAXIMUM_MASS_TRANSIT_MISSES)
           / NUMBER_OF_MASS_TRANSIT_MATCH_SAMPLES)
 
-        if matches and matches[0]["hitrate"] >= hitreq:
-            return matches[0]["line_type"], matches[0]["line_name"]
+        if matches and matches[0].hitrate >= hitreq:
+            return matches[0].line_type, matches[0].line_name
 
         return None, None
 
 
     def _analyse_activities(self, points):
-
-        def activities(point):
-            return {
-                point["activity_1"]: point["activity_1_conf"] or 0,
-                point["activity_2"]: point["activity_2_conf"] or 0,
-                point["activity_3"]: point["activity_3_conf"] or 0}
-
-        def dseconds(p0, p1):
-            return (p1["time"] - p0["time"]).total_seconds()
-
-        good_activities = ('IN_VEHICLE', 'ON_BICYCLE', 'RUNNING', 'WALKING')
-        on_foot_activities = ('RUNNING', 'WALKING')
-
-        def best_activity(activities):
-            on_foot = False
-            for activity, cconf in activities.most_common():
-                if activity == "ON_FOOT":
-                    on_foot = True
-                elif on_foot and activity not in on_foot_activities:
-                    pass
-                elif activity in good_activities:
-                    return activity
-            if on_foot:
-                return "WALKING"
-            return "NOT_SET"
-
-        from collections import Counter
-        probs = Counter()
-        head = tail = 0
-        halfwin = ACTIVITY_WIN / 2
-        np = len(points)
-        for i in range(np):
-            while head < np and dseconds(points[i], points[head]) < halfwin:
-                probs.update(activities(points[head]))
-                head += 1
-            while tail < np and dseconds(points[tail], points[i]) > halfwin:
-                probs.subtract(activities(points[tail]))
-                tail += 1
-            yield points[i], best_activity(probs)
+        """Pair time-sorted points with best activity in the ACTIVITY_WIN
+        window around each."""
+        points = list(points)
+        return zip(points, window_best_activities(points, ACTIVITY_WIN))
 
 
     def _dump_csv_file_open(self, user_id):
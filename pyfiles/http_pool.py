@@ -0,0 +1,94 @@
+"""Pacing and connection pooling shared by the clients of external HTTP
+services, and a stub JSON server for testing them without the real ones."""
+
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl, urlparse
+
+import requests
+
+
+class TokenBucket:
+    """Pace takers to rate per second on average, allowing bursts of up to
+    burst at once."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def after_fork(self):
+        """Replace lock that may have been held when forked."""
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Consume a token, waiting for it if none left. Takers reserve
+        tokens in turn, so waiting ones are served in order."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class PooledSession:
+    """requests.Session keeping up to size connections alive, made on first
+    use."""
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.session = None
+
+    def after_fork(self):
+        """Replace lock and connections shared with the parent process."""
+        self.lock = threading.Lock()
+        self.session = None
+
+    def get(self):
+        with self.lock:
+            if self.session is None:
+                self.session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.size)
+                self.session.mount("http://", adapter)
+                self.session.mount("https://", adapter)
+            return self.session
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_json_stub(port, respond, error):
+    """Serve GET requests with the JSON of respond(query params), or with
+    status 400 and the JSON of error(exception) if it raises KeyError or
+    ValueError."""
+
+    class StubHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            try:
+                body = respond(dict(parse_qsl(urlparse(self.path).query)))
+                status = 200
+            except (KeyError, ValueError) as e:
+                body = error(e)
+                status = 400
+            body = json.dumps(body).encode("utf8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    StubServer(("", port), StubHandler).serve_forever()
@@ -18,7 +18,7 @@ from google.transit import gtfs_realtime_pb2
 from owslib.wfs import WebFeatureService
 
 from pyfiles.common_helpers import interpret_jore
-from pyfiles.database_interface import hsl_alerts_get_max, traffic_disorder_max_creation, get_waypoint_id_from_coordinate
+from pyfiles.database_interface import hsl_alerts_get_max, traffic_disorder_max_creation, get_waypoint_ids_from_coordinates
 from pyfiles.constants import gtfs_route_types, gtfs_effects
 from pyfiles.config_helper import get_config
 
@@ -342,6 +342,7 @@ def traffic_disorder_request():
             print("Traffic disorder fetch exception: ", e)
 
     new_disorders = []
+    located = [] # (row, (lng, lat)) to snap to waypoints in one go
     max_creation_time = traffic_disorder_max_creation()
     # print "Max creation time: ", max_creation_time
 
@@ -351,7 +352,7 @@ def traffic_disorder_request():
         sv_description = None
         en_description = None
         coordinate = None
-        waypoint = None
+        point = None
         try:
             disorder_id = record.get('id')
             record_creation_time = dateutil.parser.parse(record.find('pp:situationRecordCreationTime', ns).text)
@@ -415,7 +416,7 @@ def traffic_disorder_request():
                             lat, lng = getAlertC(table_version, loc)
                             if lat is not None:
                                 coordinate = 'POINT(%f %f)' % (float(lng), float(lat))
-                                waypoint = get_waypoint_id_from_coordinate(coordinate)
+                                point = (float(lng), float(lat))
 
 
                                 # Note: Calculating based on multiple points seems to displace the final point from the
@@ -445,17 +446,20 @@ def traffic_disorder_request():
 
             except:
                 "Common issue - no coordinates in traffic alert."
-            return {
+            row = {
                 'record_creation_time': record_creation_time,
                 'disorder_id': disorder_id,
                 'start_time': start_time,
                 'end_time': end_time,
                 'coordinate': coordinate,
-                'waypoint_id': waypoint,
+                'waypoint_id': None,
                 'fi_description': fi_description,
                 'sv_description': sv_description,
                 'en_description': en_description
             }
+            if point is not None:
+                located.append((row, point))
+            return row
         except Exception as e:
             print("Traffic disorder row build exception: ", e)
             return None
@@ -467,6 +471,9 @@ def traffic_disorder_request():
                                        .find('pp:situation', ns)
                                        .find('pp:situationRecord', ns))
             if row: new_disorders.append(row)
+        waypoints = get_waypoint_ids_from_coordinates([p for _, p in located])
+        for (row, _), waypoint in zip(located, waypoints):
+            row['waypoint_id'] = waypoint
     except Exception as e:
         print("Traffic disorder loop exception: ", e)
         new_disorders = []
@@ -0,0 +1,212 @@
+"""Write-behind spool for uploaded device data.
+
+Uploads are appended to a segment file of the receiving process and synced
+to disk before being acknowledged. A flusher thread in each process closes the
+active segment every interval and copies all closed segments into device_data
+in one transaction, then removes them.
+
+Segments are claimed with an exclusive flock. The writing process locks its
+active segment before giving it the segment name, so any unlocked segment is
+closed, or left over by a process that died, and is replayed by whichever flusher gets it first.
+A crash between the commit and the removal replays the segment again; rows
+are never lost, and ones already inserted are skipped as duplicates.
+
+Each line of a segment is the JSON list of one upload's rows, in the order of
+database_interface.device_data_copy_columns. An incomplete last line is from
+an append interrupted before acknowledgement, and is dropped."""
+
+import fcntl
+import json
+import os
+import threading
+import time
+
+import psycopg2
+
+from pyfiles.database_interface import device_data_copy
+
+
+SEGMENT_SUFFIX = ".seg"
+
+
+class SpoolFull(Exception):
+    """Spool is over its size limit; write synchronously or retry later."""
+
+
+class IngestSpool:
+
+    def __init__(self, directory, max_bytes=1 << 30, interval=2.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pid = None
+        self.segment = None
+        self.serial = 0
+
+        # Metrics of this process, see stats
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flush_seconds = 0.0
+        self.last_flush_seconds = None
+        self.oldest_wait = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def append(self, rows):
+        """Durably spool rows of device_data_copy_columns values. Raises
+        SpoolFull when backlog exceeds max_bytes."""
+
+        line = (json.dumps(rows, default=str) + "\n").encode("utf8")
+        with self.lock:
+            self.start()
+            if self.backlog()[1] + len(line) > self.max_bytes:
+                raise SpoolFull()
+            if self.segment is None:
+                self._open_segment()
+            self.segment.write(line)
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+
+    def backlog(self):
+        """Count and total bytes of spooled segments, of all processes."""
+        count = size = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(SEGMENT_SUFFIX):
+                count += 1
+                size += entry.stat().st_size
+        return count, size
+
+    def stats(self):
+        segments, size = self.backlog()
+        return {
+            "segments": segments,
+            "bytes": size,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "flush_seconds": self.flush_seconds,
+            "last_flush_seconds": self.last_flush_seconds,
+            "oldest_wait_seconds": self.oldest_wait}
+
+    def start(self):
+        """Start the flusher of this process if not running."""
+        # Threads do not survive forking, so start one per worker process
+        # rather than at import.
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.segment = None
+        thread = threading.Thread(target=self._run, name="ingest-spool")
+        thread.daemon = True
+        thread.start()
+
+    def _open_segment(self):
+        self.serial += 1
+        path = os.path.join(self.directory, "%d-%d-%d%s" % (
+            self.pid, int(time.time() * 1000), self.serial, SEGMENT_SUFFIX))
+        # Lock under a name flushers ignore, lest one claims and removes the
+        # new segment before it is locked
+        self.segment = open(path + ".new", "ab")
+        fcntl.flock(self.segment, fcntl.LOCK_EX)
+        os.rename(self.segment.name, path)
+
+    def _rotate(self):
+        with self.lock:
+            if self.segment is not None:
+                self.segment.close() # releases the lock
+                self.segment = None
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self._rotate()
+                self.flush()
+            except Exception as e:
+                print("ingest spool: flush failed:", e)
+
+    def flush(self):
+        """Copy all unlocked segments into device_data, removing them after
+        commit."""
+
+        claimed = []
+        try:
+            for name in sorted(os.listdir(self.directory)):
+                if name.endswith(SEGMENT_SUFFIX):
+                    f = self._claim(os.path.join(self.directory, name))
+                    if f is not None:
+                        claimed.append(f)
+            if not claimed:
+                return
+
+            t0 = time.time()
+            rows = []
+            oldest = t0
+            for f in claimed:
+                oldest = min(oldest, self._created(f.name))
+                rows += read_segment(f)
+
+            try:
+                count = device_data_copy(rows)
+                for f in claimed:
+                    os.unlink(f.name)
+            except (psycopg2.DataError, psycopg2.IntegrityError):
+                # Set aside the segments failing on their own, keep others
+                count = 0
+                for f in claimed:
+                    f.seek(0)
+                    try:
+                        count += device_data_copy(read_segment(f))
+                        os.unlink(f.name)
+                    except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+                        print("ingest spool: set aside %s: %s" % (f.name, e))
+                        os.rename(f.name, f.name + ".failed")
+
+            seconds = time.time() - t0
+            self.flushes += 1
+            self.flushed_rows += count
+            self.flush_seconds += seconds
+            self.last_flush_seconds = seconds
+            self.oldest_wait = time.time() - oldest
+            segments, size = self.backlog()
+            print("ingest spool: flushed %d rows from %d segments in %.3fs, "
+                "oldest waited %.1fs, %d segments %d bytes remain" % (
+                    count, len(claimed), seconds, self.oldest_wait,
+                    segments, size))
+        finally:
+            for f in claimed:
+                f.close()
+
+    @staticmethod
+    def _claim(path):
+        """Open and lock segment if not active, else None."""
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # Another flusher may have removed it between open and lock
+            if os.fstat(f.fileno()).st_ino != os.stat(path).st_ino:
+                raise FileNotFoundError(path)
+        except (BlockingIOError, FileNotFoundError):
+            f.close()
+            return None
+        return f
+
+    @staticmethod
+    def _created(path):
+        try:
+            return int(os.path.basename(path).split("-")[1]) / 1000.0
+        except (IndexError, ValueError):
+            return time.time()
+
+
+def read_segment(f):
+    rows = []
+    for line in f:
+        if not line.endswith(b"\n"):
+            break # interrupted append, never acknowledged
+        rows += [tuple(x) for x in json.loads(line.decode("utf8"))]
+    return rows
@@ -0,0 +1,212 @@
+"""Journey planner client for matching legs to planned mass transit.
+
+Requests share a keep-alive connection pool and are paced by a token bucket
+common to the threads of the process. Coordinates and departure time are
+rounded before querying, and responses are stored by the rounded query in the
+journey_planner_cache table, so that generating legs again does not query the
+planner for legs already seen. JourneyPlannerClient.prefetch resolves the
+queries of many legs in parallel ahead of matching them one by one.
+
+Running the module serves canned plans, for testing without the real planner:
+
+    python -m pyfiles.journey_planner [port]
+
+with JOURNEY_PLANNER_URL = 'http://localhost:port/plan'. The canned plan rides
+a bus along the straight line between the places, and departures more than a
+week from today get the planner's date too far error."""
+
+import json
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+import polyline
+
+from pyfiles.common_helpers import get_distance_between_coordinates
+from pyfiles.database_interface import (
+    journey_planner_cache_get, journey_planner_cache_put)
+from pyfiles.http_pool import PooledSession, TokenBucket, serve_json_stub
+
+
+DEFAULT_URL = 'http://api.digitransit.fi/routing/v1/routers/hsl/plan'
+
+# Planner error id for dates outside its timetable period
+ERROR_DATE_TOO_FAR = 406
+
+
+class JourneyPlannerClient:
+    """Queries are (fromPlace, toPlace, departure, params) tuples, places as
+    "lat,lon" strings and params a dict of other query parameters, as made by
+    mass_transit_match_planner.planner_query."""
+
+    def __init__(
+            self, url=DEFAULT_URL, rate=10, workers=4, timeout=50, places=4,
+            memo_size=10000):
+        self.url = url
+        self.workers = workers
+        self.timeout = timeout
+        self.places = places
+        self.bucket = TokenBucket(rate, workers)
+        self.pool = PooledSession(workers)
+        self.memo_size = memo_size
+        self.memo = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Counters since start
+        self.queries = 0
+        self.fetched = 0
+        self.failures = 0
+
+    def after_fork(self):
+        """Replace locks and connections shared with the parent process."""
+        self.lock = threading.Lock()
+        self.bucket.after_fork()
+        self.pool.after_fork()
+
+    def key(self, query):
+        """Cache key and request parameters of rounded query."""
+
+        fromPlace, toPlace, departure, params = query
+        departure = (departure + timedelta(seconds=30)).replace(
+            second=0, microsecond=0)
+        params = dict(
+            params,
+            fromPlace=self._round_place(fromPlace),
+            toPlace=self._round_place(toPlace),
+            date=departure.strftime("%Y-%m-%d"),
+            time=departure.strftime("%H:%M:%S"))
+        key = self.url + "?" + "&".join(
+            "%s=%s" % x for x in sorted(params.items()))
+        return key, params
+
+    def _round_place(self, place):
+        return ",".join(
+            "%.*f" % (self.places, float(x)) for x in place.split(","))
+
+    def plan(self, query):
+        """Planner response of query as dict, {} if the request failed."""
+        return self.prefetch([query])[0]
+
+    def prefetch(self, queries):
+        """Responses of list of queries, fetching those not cached in
+        parallel. Failed ones are {} and not cached."""
+
+        t0 = time.time()
+        keys = [self.key(q) for q in queries]
+        with self.lock:
+            found = {k: self.memo[k] for k, _ in keys if k in self.memo}
+        missing = OrderedDict((k, p) for k, p in keys if k not in found)
+        if missing:
+            stored = journey_planner_cache_get(list(missing))
+            found.update((k, json.loads(v)) for k, v in stored.items())
+        fetch = [(k, p) for k, p in missing.items() if k not in found]
+
+        if fetch:
+            session = self.pool.get()
+            if len(fetch) == 1:
+                responses = [self._get(session, fetch[0][1])]
+            else:
+                with ThreadPoolExecutor(min(self.workers, len(fetch))) as ex:
+                    responses = list(ex.map(
+                        lambda x: self._get(session, x[1]), fetch))
+            new = {
+                k: r for (k, _), r in zip(fetch, responses) if r is not None}
+            journey_planner_cache_put(
+                {k: json.dumps(r) for k, r in new.items()})
+            found.update(new)
+
+        self._remember(found)
+        self.queries += len(queries)
+        self.fetched += len(fetch)
+        if len(queries) > 1 or fetch:
+            print("journey planner: %d queries, %d fetched in %.2fs" % (
+                len(queries), len(fetch), time.time() - t0))
+        return [found.get(k, {}) for k, _ in keys]
+
+    def _get(self, session, params):
+        """Response dict, or None if the request failed."""
+        self.bucket.take()
+        try:
+            response = session.get(
+                self.url, params=params, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            print("journey planner: request failed:", e)
+            self.failures += 1
+            return None
+
+    def _remember(self, responses):
+        with self.lock:
+            for k, r in responses.items():
+                self.memo[k] = r
+                self.memo.move_to_end(k)
+            while len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+
+    def stats(self):
+        return {
+            "queries": self.queries,
+            "fetched": self.fetched,
+            "failures": self.failures}
+
+
+def stub_plan(params):
+    """Canned planner response to query params: walk, ride a bus along the
+    straight line between the places, walk."""
+
+    departure = datetime.strptime(
+        params["date"] + " " + params["time"], "%Y-%m-%d %H:%M:%S")
+    if abs((departure.date() - date.today()).days) > 7:
+        return {"error": {
+            "id": ERROR_DATE_TOO_FAR, "msg": "DATE_TOO_FAR",
+            "message": "Date is outside the timetable period."}}
+
+    flat, flon = (float(x) for x in params["fromPlace"].split(","))
+    tlat, tlon = (float(x) for x in params["toPlace"].split(","))
+    distance = get_distance_between_coordinates((flon, flat), (tlon, tlat))
+
+    # Points every 50m so that recorded points along the line match
+    n = max(1, int(distance / 50))
+    geometry = [
+        (flat + (tlat - flat) * i / n, flon + (tlon - flon) * i / n)
+        for i in range(n + 1)]
+
+    def leg(mode, start, duration, points, route=""):
+        return {
+            "mode": mode,
+            "route": route,
+            "transitLeg": mode != "WALK",
+            "startTime": int(start * 1000),
+            "endTime": int((start + duration) * 1000),
+            "duration": duration,
+            "distance": get_distance_between_coordinates(
+                points[0][::-1], points[-1][::-1]),
+            "legGeometry": {"points": polyline.encode(points)},
+            "intermediateStops": []}
+
+    start = time.mktime(departure.timetuple())
+    ride = int(distance / 8) + 1
+    legs = [
+        leg("WALK", start, 120, geometry[:1] * 2),
+        leg("BUS", start + 120, ride, geometry, "550"),
+        leg("WALK", start + 120 + ride, 120, geometry[-1:] * 2)]
+    return {"plan": {"itineraries": [{
+        "duration": ride + 240,
+        "startTime": legs[0]["startTime"],
+        "endTime": legs[-1]["endTime"],
+        "legs": legs}]}}
+
+
+def serve_stub(port=8642):
+    print("journey planner stub on http://localhost:%d/plan" % port)
+    serve_json_stub(
+        port, stub_plan, lambda e: {"error": {"id": 400, "msg": str(e)}})
+
+
+if __name__ == "__main__":
+    serve_stub(*(int(x) for x in sys.argv[1:2]))
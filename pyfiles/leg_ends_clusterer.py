@@ -0,0 +1,148 @@
+"""Batch leg end clustering for changes queued in deferred mode.
+
+The row triggers of sql/legends.sql put each changed leg end into a cluster of
+its own and fix it up at once: recentre the cluster on its ends, merge it with
+the nearest cluster of the user within clustdist, the one with fewer ends into
+the one with more, and repeat on the merged cluster. LegEndsClusterer takes
+the same steps on a user's clusters held in memory, finding neighbours
+through a GridIndex, so that a queue of changes is processed in order without
+a query per step, and the outcome written back in bulk.
+
+Distances are geodesic on WGS 84, as those of geography in PostGIS. Ties in
+distance or end count, which the triggers break arbitrarily, go to the lower
+cluster id."""
+
+from geopy.distance import geodesic
+
+from pyfiles.common_helpers import GridIndex
+
+
+class LegEndsClusterer:
+    """Clusters of one user's leg ends. Ends are keyed by (leg, at_end) and
+    clusters by id, with the ones created numbered on from the existing."""
+
+    def __init__(self, clusters, ends, clustdist, coordinates=()):
+        """clusters -- {id: (lon, lat) or None} of existing clusters
+        ends -- {(leg, at_end): (id, (lon, lat) or None)} of clustered ends
+        clustdist -- merge distance in metres
+        coordinates -- of ends to be linked, for sizing the grid"""
+
+        self.clustdist = clustdist
+        self.coordinates = dict(clusters)
+        self.members = {cid: set() for cid in clusters}
+        self.ends = {}
+        self.cluster_of = {}
+        for key, (cid, coordinate) in ends.items():
+            if cid in self.members:
+                self.ends[key] = coordinate
+                self._assign(key, cid)
+        self.initial = dict(self.coordinates)
+        self.initial_ends = dict(self.cluster_of)
+        self.nextid = max(clusters, default=0) + 1
+
+        # Grid cells are sized by an approximate distance, so leave a margin
+        self.grid = GridIndex(
+            lambda x: x,
+            clustdist * 1.01,
+            [x for x in list(clusters.values()) + list(coordinates) if x])
+        for cid, coordinate in self.coordinates.items():
+            if coordinate is not None:
+                self.grid.add(cid, coordinate)
+
+    def link(self, key, coordinate):
+        """Cluster leg end at coordinate, as legs_link_start/end."""
+        cid = self.nextid
+        self.nextid += 1
+        self.coordinates[cid] = None
+        self.members[cid] = set()
+        self.ends[key] = coordinate
+        self._assign(key, cid)
+        self.fixup(cid)
+
+    def unlink(self, key):
+        """Uncluster leg end, as legs_unlink_start/end."""
+        cid = self.cluster_of.get(key)
+        self._assign(key, None)
+        self.fixup(cid)
+
+    def fixup(self, cid):
+        """Recentre cluster, merge with nearest neighbour and repeat on the
+        merged cluster, as leg_ends_fixup."""
+
+        while cid in self.coordinates:
+            points = [
+                self.ends[k] for k in self.members[cid]
+                if self.ends[k] is not None]
+            if not points:
+                self._delete(cid)
+                return
+            self._move(cid, (
+                sum(x for x, _ in points) / len(points),
+                sum(y for _, y in points) / len(points)))
+
+            neighbor = self._nearest(cid)
+            if neighbor is None:
+                return
+            if (len(self.members[neighbor]), -neighbor) \
+                    > (len(self.members[cid]), -cid):
+                eater, eaten = neighbor, cid
+            else:
+                eater, eaten = cid, neighbor
+            for key in list(self.members[eaten]):
+                self._assign(key, eater)
+            self._delete(eaten)
+            cid = eater
+
+    def _nearest(self, cid):
+        here = self.coordinates[cid]
+        best = None
+        for other in self.grid.near(here):
+            if other == cid:
+                continue
+            there = self.coordinates[other]
+            distance = geodesic(here[::-1], there[::-1]).meters
+            if distance <= self.clustdist and (
+                    best is None or (distance, other) < best):
+                best = distance, other
+        return None if best is None else best[1]
+
+    def _assign(self, key, cid):
+        old = self.cluster_of.pop(key, None)
+        if old is not None:
+            self.members[old].discard(key)
+        if cid is not None:
+            self.cluster_of[key] = cid
+            self.members[cid].add(key)
+
+    def _move(self, cid, coordinate):
+        old = self.coordinates[cid]
+        if old is not None:
+            self.grid.remove(cid, old)
+        self.coordinates[cid] = coordinate
+        if coordinate is not None:
+            self.grid.add(cid, coordinate)
+
+    def _delete(self, cid):
+        for key in list(self.members[cid]):
+            self._assign(key, None)
+        self._move(cid, None)
+        del self.coordinates[cid], self.members[cid]
+
+    def changes(self):
+        """Outcome as (created, moved, deleted, ends): coordinates of new
+        clusters and of existing ones moved as {id: (lon, lat)}, ids of
+        existing clusters deleted, and {(leg, at_end): id or None} of ends
+        whose cluster changed."""
+
+        created = {
+            cid: x for cid, x in self.coordinates.items()
+            if cid not in self.initial}
+        moved = {
+            cid: x for cid, x in self.coordinates.items()
+            if cid in self.initial and x != self.initial[cid]}
+        deleted = sorted(set(self.initial) - set(self.coordinates))
+        ends = {
+            key: self.cluster_of.get(key)
+            for key in set(self.initial_ends) | set(self.cluster_of)
+            if self.cluster_of.get(key) != self.initial_ends.get(key)}
+        return created, moved, deleted, ends
@@ -14,6 +14,8 @@ import requests
 # import urllib.request, urllib.error, urllib.parse
 import polyline
 
+import numpy as np
+
 from pyfiles.common_helpers import (get_distance_between_coordinates, point_distance, point_coordinates)
 
 # generate extensive logs!
@@ -57,6 +59,28 @@ def HSLDurationToNormalDuration(hsl_duration):
 
 # -------- matching trip-legs with results from journey planner --------------------------
 
+def match_points_to_plan(points, plannedpoints, maxdistance):
+    """Match recorded points to decoded (lat, lon) planned points. Returns the
+    index of the nearest planned point within maxdistance of each recorded
+    point, the last of equally near ones, or -1 if none is, and the distance
+    to the nearest one. Distances are get_distance_between_coordinates of all
+    pairs computed at once."""
+
+    coords = np.array([point_coordinates(p) for p in points], np.float64).reshape(-1, 2)
+    plan = np.array(plannedpoints, np.float64).reshape(-1, 2)
+    if not len(plan):
+        return np.full(len(coords), -1), np.full(len(coords), np.inf)
+
+    # x_diff scaled at planned point latitude as in get_distance_between_coordinates
+    x_diff = (coords[:, :1] - plan[:, 1]) * 110320 * np.cos(plan[:, 0] / 180 * np.pi)
+    y_diff = (coords[:, 1:] - plan[:, 0]) * 110574
+    deltas = (x_diff * x_diff + y_diff * y_diff)**0.5
+
+    last = plan.shape[0] - 1 - np.argmin(deltas[:, ::-1], axis=1)
+    mindeltas = deltas[np.arange(len(coords)), last]
+    return np.where(mindeltas <= maxdistance, last, -1), mindeltas
+
+
 def find_same_journey_time_this_week(starttime):
     # find date of the same weekday, but for current week (to avoid querying old dates that results in error from HSL)
     date_thisweek = datetime.today() + timedelta(days = (starttime.weekday() - datetime.today().weekday()))
@@ -90,8 +114,31 @@ class TripMatchedWithPlannerResult:
 
 minSpeeds = {"walk":1.34112, "bus": 3.0, "tram":2.5, "train":5.0, "ferry":5.0} # walk speed default: 3 MPH (1.34112 m/s) (~ 5.0 km/h)
 
+MAX_MODE_DETECTION_DELAY = 500 # (meters) we have latency in making sure of the mode change
+
+
+def planner_query(fromPlace, toPlace, trip_starttime):
+    """Journey planner query for a trip-leg, as (fromPlace, toPlace, departure,
+    params) for JourneyPlannerClient."""
+    #MAX_GPS_ERROR = 1000 # meters (somehow maxWalkDistance is equal to GPS error threshold for our system)
+    # or maybe not... this could be also max_distance_between_busstops / 2 !!  (if we have a detection between two bus stops)
+    # 1000 m (e.g. 500 m walkking at each trip end) gives good results for user id 13
+    maxWalkDistance = MAX_MODE_DETECTION_DELAY * 2 # e.g. 500m walk to start bus stop ... 500m walk to end bus stop
+    numItineraries = 3 # default is 3
+    showIntermediateStops = "True"
+    # TODO: is there a param 'max waiting time' too?
+
+    legstartshift = timedelta(seconds = round(MAX_MODE_DETECTION_DELAY/minSpeeds['walk']))  # default: 4 minutes (*) or CALC: e.g: MAX_MODE_DETECTION_DELAY/minSpeeds['walk']
+    trip_starttime_earlier = trip_starttime.replace(microsecond = 0) - legstartshift
+    return fromPlace, toPlace, trip_starttime_earlier, {
+        "numItineraries": numItineraries,
+        "maxWalkDistance": maxWalkDistance,
+        "showIntermediateStops": showIntermediateStops}
 
-def match_tripleg_with_publictransport(fromPlace, toPlace, trip_starttime, trip_endtime, all_recorded_trip_points):
+
+def match_tripleg_with_publictransport(fromPlace, toPlace, trip_starttime, trip_endtime, all_recorded_trip_points, planner=None):
+    """Match trip-leg with journey planner itineraries, queried through
+    JourneyPlannerClient planner if given."""
     print("Input Trip ...:")
     print("trip_starttime:", trip_starttime)
     print("trip_endtime:", trip_endtime)
@@ -116,18 +163,10 @@ def match_tripleg_with_publictransport(fromPlace, toPlace, trip_starttime, trip_
     trip_duration = trip_endtime - trip_starttime
 
     # assumptions, constants, adjusting parameters, related cals, some kinematics, etc. -----------------:
-    MAX_MODE_DETECTION_DELAY = 500 # (meters) we have latency in making sure of the mode change
     MAX_GPS_ERROR = 50 # (in meters) if error marger than this, we've discarded that point TODO ???
     MAX_VEHICLE_LENGTH = 50 # TODO
     MAX_DISTANCE_FOR_POINT_MATCH = MAX_GPS_ERROR + MAX_VEHICLE_LENGTH
-    #MAX_GPS_ERROR = 1000 # meters (somehow maxWalkDistance is equal to GPS error threshold for our system)
-    # or maybe not... this could be also max_distance_between_busstops / 2 !!  (if we have a detection between two bus stops)
-    # 1000 m (e.g. 500 m walkking at each trip end) gives good results for user id 13
-    maxWalkDistance = MAX_MODE_DETECTION_DELAY * 2 # e.g. 500m walk to start bus stop ... 500m walk to end bus stop
-    numItineraries = 3 # default is 3
     maxTransfers = 2  # seems like this param didn't have any effect!
-    showIntermediateStops = "True"
-    # TODO: is there a param 'max waiting time' too?
 
     maxIntervals = {"bus":60, "tram":30, "train":60, "ferry":60} # max arrival interval of each public transport mode during working hours (minutes)
     maxSlowness = {"bus":3, "tram":3, "train":3, "ferry":5} # maximum slowness (a bit different concept than 'being late') of public transport (minutes)
@@ -135,9 +174,9 @@ def match_tripleg_with_publictransport(fromPlace, toPlace, trip_starttime, trip_
     # TODO! depends also on the city! in Helsinki it's sharp! :) ... in Rome, maybe not
     maxDError = MAX_MODE_DETECTION_DELAY * 2 # maximum Distance error (e.g: one deltaD at each end of the trip)
 
-    legstartshift = timedelta(seconds = round(MAX_MODE_DETECTION_DELAY/minSpeeds['walk']))  # default: 4 minutes (*) or CALC: e.g: MAX_MODE_DETECTION_DELAY/minSpeeds['walk']        
-    trip_starttime_earlier = trip_starttime - legstartshift
-    print("legstartshift:",legstartshift)
+    query = planner_query(fromPlace, toPlace, trip_starttime)
+    trip_starttime_earlier = query[2]
+    print("legstartshift:",trip_starttime - trip_starttime_earlier)
     print("trip_starttime_earlier:", trip_starttime_earlier , " (note: WE'LL GIVE THIS TO JOURNEY PLANNER QUERY *)")
     print("")
 
@@ -147,12 +186,16 @@ def match_tripleg_with_publictransport(fromPlace, toPlace, trip_starttime, trip_
     #   later planner match for the whole finland*: https://api.digitransit.fi/routing/v1/routers/finland/
     #   later plannermatch for all possible countries: ??? OTP API interfance	
     # ex: apiurl = IOTPServer.GetOTPAPIUrl() # shuld give the suitable instance, based on city/coutnry or user settings ...
-    apiurl = 'http://api.digitransit.fi/routing/v1/routers/hsl/plan'
-    querystr = "fromPlace={0}&toPlace={1}&date={2}&time={3}&numItineraries={4}&maxWalkDistance={5}&showIntermediateStops={6}" \
-        .format(fromPlace, toPlace, datetime.date(trip_starttime_earlier), datetime.time(trip_starttime_earlier), \
-                numItineraries, maxWalkDistance, showIntermediateStops);
-    #ex: querystr = "fromPlace=60.170718,24.930221&toPlace=60.250214,25.009566&date=2016/4/22&time=17:18:00&numItineraries=3&maxTransfers=3&maxWalkDistance=1500" # ******
-    json_data = HttpRequestWithGet(apiurl, querystr)
+    if planner is not None:
+        json_data = planner.plan(query)
+    else:
+        params = query[3]
+        apiurl = 'http://api.digitransit.fi/routing/v1/routers/hsl/plan'
+        querystr = "fromPlace={0}&toPlace={1}&date={2}&time={3}&numItineraries={4}&maxWalkDistance={5}&showIntermediateStops={6}" \
+            .format(fromPlace, toPlace, datetime.date(trip_starttime_earlier), datetime.time(trip_starttime_earlier), \
+                    params["numItineraries"], params["maxWalkDistance"], params["showIntermediateStops"]);
+        #ex: querystr = "fromPlace=60.170718,24.930221&toPlace=60.250214,25.009566&date=2016/4/22&time=17:18:00&numItineraries=3&maxTransfers=3&maxWalkDistance=1500" # ******
+        json_data = HttpRequestWithGet(apiurl, querystr)
 
     if 'plan' not in json_data or 'itineraries' not in json_data['plan']:
         #itineraries_count = len (json_data['plan']['itineraries'])
@@ -394,32 +437,14 @@ def match_tripleg_with_publictransport(fromPlace, toPlace, trip_starttime, trip_
                     if hasgoodpoints:
                         serialunmatchcount = 0 # number of consecutive goodpoints with no match in planned points
                         print("Matching goodpoints n=",len(goodpoints)," with plannedpoints m=",len(plannedpoints), "...")
-                        # TODO make more efficient, make less than O(n^2)                  
-                        # traverse goodpoints and try to match each with a planpoint:      
-                        for point in goodpoints:
-                            point_location = json.loads(point["geojson"])["coordinates"]
-                            point_location_str='{1},{0}'.format(point_location[0],point_location[1])
-                            point_time  = point['time']
-
-                            # search for its match in planned points
-                            matchfound = False
-                            deltas = []
-                            mindelta = MAX_DISTANCE_FOR_POINT_MATCH
-                            matchpair = PointMatchPair()
-
-                            for planpoint in plannedpoints: # traverse plannedpoints to find a match
-                                planpoint_reverse = planpoint[1],planpoint[0]
-                                delta = get_distance_between_coordinates(json.loads(point["geojson"])["coordinates"], planpoint_reverse)
-                                deltas.append(delta)
-                                if delta <= MAX_DISTANCE_FOR_POINT_MATCH: #found a match
-                                    matchfound = True
-                                    if delta <= mindelta:
-                                        mindelta = delta
-                                        matchpair.point1 = point
-                                        matchpair.point2 = planpoint
-
-                            print("min delta for this goodpoint:", min(deltas))
-                            if matchfound:
+                        # match all goodpoints with plannedpoints in one pass
+                        nearest, mindeltas = match_points_to_plan(goodpoints, plannedpoints, MAX_DISTANCE_FOR_POINT_MATCH)
+                        for point, planindex, mindelta in zip(goodpoints, nearest, mindeltas):
+                            print("min delta for this goodpoint:", mindelta)
+                            if planindex >= 0:
+                                matchpair = PointMatchPair()
+                                matchpair.point1 = point
+                                matchpair.point2 = plannedpoints[planindex]
                                 matchedpointpairs.append(matchpair)
                                 if serialunmatchcount > 0:
                                     serialunmatches.append(serialunmatchcount)
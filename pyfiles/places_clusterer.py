@@ -0,0 +1,178 @@
+"""Batch clustering of leg end coordinates into places.
+
+The triggers of sql/places.sql keep places clustered as leg ends change: each
+changed leg end gets a place of its own, recentred and merged with the
+nearest place within the cluster distance, recursively. Rebuilding all places
+that way, as after changing DEST_RADIUS_MAX, takes a handful of queries per
+leg end. cluster_places clusters all coordinates in memory instead:
+
+1. Points are binned into grid cells narrow enough that the points of a cell
+   are within the distance of each other, and cells having points within the
+   distance of each other are joined by union-find.
+2. A group so joined whose points all lie within the distance of its centroid
+   becomes a place.
+3. Other groups are split by merging the nearest centroids of their cells
+   while within the distance, as places_fixup merges places, then refined by
+   moving each point to its nearest centroid in the group.
+
+Distances are those of get_distance_between_coordinates."""
+
+from collections import Counter
+from math import ceil, cos, pi
+
+import numpy as np
+
+from pyfiles.common_helpers import (
+    GridIndex, do_cluster, get_distance_between_coordinates)
+
+
+def distances(lon0, lat0, lon1, lat1):
+    """get_distance_between_coordinates of broadcast arrays."""
+    x = (lon0 - lon1) * 110320 * np.cos(lat1 / 180 * np.pi)
+    y = (lat0 - lat1) * 110574
+    return np.hypot(x, y)
+
+
+class UnionFind:
+
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            self.parent[max(i, j)] = min(i, j)
+
+
+def groups_of(keys):
+    """Indices of equal keys, as list of arrays in order of key."""
+    order = np.argsort(keys, kind="stable")
+    bounds = np.searchsorted(keys[order], np.arange(keys.max() + 2))
+    return [order[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def nearest(lon, lat, centroids, chunk=1 << 22):
+    """Index of the nearest centroid to each point."""
+    out = np.empty(len(lon), np.int64)
+    step = max(1, chunk // len(centroids))
+    for i in range(0, len(lon), step):
+        out[i:i + step] = distances(
+            lon[i:i + step, None], lat[i:i + step, None],
+            centroids[None, :, 0], centroids[None, :, 1]).argmin(1)
+    return out
+
+
+def cluster_places(lon, lat, distance):
+    """Cluster points given as arrays of longitude and latitude. Returns the
+    place number of each point as array, and place centroids as array of
+    (lon, lat) rows."""
+
+    lon = np.asarray(lon, np.float64)
+    lat = np.asarray(lat, np.float64)
+    labels = np.zeros(len(lon), np.int64)
+    if not len(lon):
+        return labels, np.zeros((0, 2))
+
+    # Cells half the distance across where widest, so that their diagonal is
+    # within it; points within the distance are up to two rows away, and as
+    # many columns as half distances fit the distance where cells are
+    # narrowest.
+    abslat = np.minimum(np.abs(lat), 85)
+    dy = distance / 2 / 110574
+    dx = distance / 2 / (110320 * cos(abslat.min() / 180 * pi))
+    kx = int(ceil(distance / (110320 * cos(abslat.max() / 180 * pi)) / dx))
+    ky = 2
+
+    cells, cell_of = np.unique(
+        np.stack([np.floor(lon / dx), np.floor(lat / dy)], 1).astype(np.int64),
+        axis=0, return_inverse=True)
+    cell_of = cell_of.reshape(-1)
+    members = groups_of(cell_of)
+    index = {(x, y): c for c, (x, y) in enumerate(cells.tolist())}
+
+    uf = UnionFind(len(cells))
+    offsets = [
+        (ox, oy) for oy in range(ky + 1) for ox in range(-kx, kx + 1)
+        if oy > 0 or ox > 0]
+    for c, (x, y) in enumerate(cells.tolist()):
+        pc = members[c]
+        for ox, oy in offsets:
+            d = index.get((x + ox, y + oy))
+            if d is None or uf.find(c) == uf.find(d):
+                continue
+            pd = members[d]
+            if (distances(
+                    lon[pc, None], lat[pc, None],
+                    lon[None, pd], lat[None, pd]) <= distance).any():
+                uf.union(c, d)
+
+    def cell_merge(c0, c1):
+        n = c0["n"] + c1["n"]
+        return {
+            "n": n,
+            "coordinates": tuple(
+                (a * c0["n"] + b * c1["n"]) / n
+                for a, b in zip(c0["coordinates"], c1["coordinates"]))}
+
+    def cell_distance(c0, c1):
+        return get_distance_between_coordinates(
+            c0["coordinates"], c1["coordinates"])
+
+    roots = np.array([uf.find(c) for c in range(len(cells))])
+    _, group_of = np.unique(roots, return_inverse=True)
+    centroids = []
+    for points in groups_of(group_of.reshape(-1)[cell_of]):
+        glon, glat = lon[points], lat[points]
+        centroid = glon.mean(), glat.mean()
+        if distances(glon, glat, *centroid).max() <= distance:
+            labels[points] = len(centroids)
+            centroids.append(centroid)
+            continue
+
+        items = [
+            {   "n": len(members[c]),
+                "coordinates": (
+                    lon[members[c]].mean(), lat[members[c]].mean())}
+            for c in np.unique(cell_of[points]).tolist()]
+        merged = do_cluster(
+            items, cell_merge, cell_distance, distance,
+            GridIndex(lambda x: x["coordinates"], distance, items))
+        near = nearest(
+            glon, glat, np.array([x["coordinates"] for x in merged]))
+
+        # Centroids of the points moved to each, dropping any left empty
+        _, near = np.unique(near, return_inverse=True)
+        near = near.reshape(-1)
+        counts = np.bincount(near)
+        labels[points] = len(centroids) + near
+        centroids += zip(
+            (np.bincount(near, glon) / counts).tolist(),
+            (np.bincount(near, glat) / counts).tolist())
+
+    return labels, np.array(centroids, np.float64).reshape(-1, 2)
+
+
+def match_places(labels, places):
+    """Map place numbers of cluster_places to previous place ids given per
+    point, or None, each previous place going to the place that has most of
+    its points. Returns {number: id} of the places matched."""
+
+    overlap = Counter(
+        (label, place) for label, place in zip(labels, places)
+        if place is not None)
+    kept = {}
+    taken = set()
+    for (label, place), _ in sorted(
+            overlap.items(), key=lambda x: (-x[1], x[0][1], x[0][0])):
+        if label not in kept and place not in taken:
+            kept[label] = place
+            taken.add(place)
+    return kept
@@ -0,0 +1,88 @@
+"""Cache of rendered responses, validated by a revision number.
+
+Entries are looked up by key and are only valid for the revision they were
+stored with, so bumping the revision of whatever the response was rendered
+from invalidates without having to find the entries. A bounded LRU in memory
+is backed by an optional directory shared by processes and restarts."""
+
+import hashlib
+import os
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+
+class ResponseCache:
+
+    def __init__(self, size, directory=None):
+        self.size = size
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key, revision):
+        """Cached bytes for key at revision, or None."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] == revision:
+                    self.entries.move_to_end(key)
+                    return entry[1]
+                del self.entries[key]
+
+        body = self._read(key, revision)
+        if body is not None:
+            self._remember(key, revision, body)
+        return body
+
+    def put(self, key, revision, body):
+        self._remember(key, revision, body)
+        self._write(key, revision, body)
+
+    def _remember(self, key, revision, body):
+        if not self.size:
+            return
+        with self.lock:
+            self.entries[key] = (revision, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def _path(self, key):
+        name = hashlib.sha1(repr(key).encode("utf8")).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def _read(self, key, revision):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                header = f.readline()
+                if header != self._header(key, revision):
+                    return None
+                return f.read()
+        except OSError:
+            return None
+
+    def _write(self, key, revision, body):
+        if not self.directory:
+            return
+        # Write aside and rename, so readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._header(key, revision))
+                f.write(body)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    @staticmethod
+    def _header(key, revision):
+        # Key included in case of hash collision
+        return ("%r %r\n" % (revision, key)).encode("utf8")
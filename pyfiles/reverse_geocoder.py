@@ -0,0 +1,140 @@
+"""Reverse geocoding client for labeling places.
+
+Coordinates are rounded to a grid of cells, and the label of each cell is
+stored in the reverse_geocoding_cache table, so that places near each other,
+or shifted into a cell seen before, reuse the earlier answer. Cells not
+cached are queried at their centre in parallel over a keep-alive connection
+pool, paced by a token bucket.
+
+Running the module serves canned answers, for testing without the real
+geocoder:
+
+    python -m pyfiles.reverse_geocoder [port]
+
+with REVERSE_GEOCODING_URI_TEMPLATE =
+'http://localhost:port/reverse?point.lat={lat}&point.lon={lon}'. Its
+features are named after the coordinates queried."""
+
+import re
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pyfiles.database_interface import (
+    reverse_geocoding_cache_get, reverse_geocoding_cache_put)
+from pyfiles.http_pool import PooledSession, TokenBucket, serve_json_stub
+
+
+def feature_label(response):
+    """Label of the first two distinct street or other names of the features
+    of a reverse geocoding response, empty if none."""
+
+    names, nameslower = [], set()
+    for prop in ["street", "name"]:
+        for feat in response.get("features", []):
+            name = feat["properties"].get(prop)
+            name = name and re.split(",", name)[0]
+            if name and name.lower() not in nameslower:
+                names.append(name)
+                nameslower.add(name.lower())
+    return " / ".join(names[:2])
+
+
+class ReverseGeocoderClient:
+    """Labels of (lon, lat) coordinates by url_template, which takes the lat
+    and lon of a cell centre."""
+
+    def __init__(
+            self, url_template, rate=6, workers=4, timeout=10, places=3):
+        self.url_template = url_template
+        self.workers = workers
+        self.timeout = timeout
+        self.places = places
+        self.bucket = TokenBucket(rate, workers)
+        self.pool = PooledSession(workers)
+
+        # Counters since start
+        self.queries = 0
+        self.fetched = 0
+        self.failures = 0
+
+    def cell(self, lon, lat):
+        """Cache key of the cell of coordinate, "lat,lon" of its centre."""
+        return "%.*f,%.*f" % (self.places, lat, self.places, lon)
+
+    def labels(self, cells, deadline=None):
+        """Labels of cells by key, fetching those not cached in parallel.
+        Cells are fetched in the order given, and those not started by
+        deadline, in epoch seconds, are skipped; skipped and failed ones are
+        left out, and not cached."""
+
+        t0 = time.time()
+        cells = list(dict.fromkeys(cells))
+        found = reverse_geocoding_cache_get(cells)
+        fetch = [x for x in cells if x not in found]
+
+        new = {}
+        if fetch:
+            session = self.pool.get()
+            with ThreadPoolExecutor(min(self.workers, len(fetch))) as ex:
+                responses = list(ex.map(
+                    lambda x: self._get(session, x, deadline), fetch))
+            new = {
+                k: feature_label(r)
+                for k, r in zip(fetch, responses) if r is not None}
+            reverse_geocoding_cache_put(new)
+            found.update(new)
+
+        self.queries += len(cells)
+        self.fetched += len(new)
+        print("reverse geocoder: %d cells, %d fetched in %.2fs" % (
+            len(cells), len(new), time.time() - t0))
+        return found
+
+    def _get(self, session, cell, deadline):
+        """Response dict, or None if skipped or the request failed."""
+        if deadline is not None and time.time() >= deadline:
+            return None
+        self.bucket.take()
+        if deadline is not None and time.time() >= deadline:
+            return None
+        lat, lon = cell.split(",")
+        try:
+            response = session.get(
+                self.url_template.format(lat=lat, lon=lon),
+                timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            print("reverse geocoder: request failed:", e)
+            self.failures += 1
+            return None
+
+    def stats(self):
+        return {
+            "queries": self.queries,
+            "fetched": self.fetched,
+            "failures": self.failures}
+
+
+def stub_reverse(params):
+    """Canned reverse geocoding response to query params: a street and a
+    venue named after the coordinates."""
+    lat = float(params["point.lat"])
+    lon = float(params["point.lon"])
+    return {"type": "FeatureCollection", "features": [
+        {   "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [lon, lat]},
+            "properties": {
+                "street": "Street %.3f" % lat,
+                "name": "Place %.3f, %.3f" % (lat, lon)}}]}
+
+
+def serve_stub(port=8643):
+    print("reverse geocoder stub on http://localhost:%d/reverse" % port)
+    serve_json_stub(port, stub_reverse, lambda e: {"error": str(e)})
+
+
+if __name__ == "__main__":
+    serve_stub(*(int(x) for x in sys.argv[1:2]))
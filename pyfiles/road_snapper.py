@@ -0,0 +1,206 @@
+"""Snapping coordinates to road waypoints in memory.
+
+sql/snapping.sql takes, for each unsnapped device_data point, the nearest road
+within 100m, then the waypoint of that road nearest to the point, in two
+lateral subqueries per point, and stops at 20000 points a run to avoid
+timeouts. RoadSnapper holds the road lines and waypoints in numpy arrays,
+loaded once, and snaps arrays of points at a time:
+
+1. Road lines are cut into pieces no longer than the grid cells are wide,
+   twice the radius, and the pieces are binned by their midpoint, so that
+   those within the radius of a point are binned in the point's cell or one
+   of its eight neighbours.
+2. Distances from the points to all pieces binned there are computed at once,
+   and the nearest piece within the radius gives the road of each point.
+3. Each point snaps to the nearest waypoint of its road, by the
+   roads_waypoints table, or to none if no road is within the radius.
+
+Distances are in a local equirectangular projection around each point, close
+to the geodesic distances of PostGIS at this scale, but ties and near ties
+may resolve differently."""
+
+import struct
+
+from math import cos, pi
+
+import numpy as np
+
+from pyfiles.common_helpers import Equirectangular
+
+
+def wkb_vertices(wkb):
+    """Array of (lon, lat) rows of a little endian 2D WKB point or line."""
+    # Header of byte order and type, and point count for lines
+    kind, = struct.unpack_from("<I", wkb, 1)
+    return np.frombuffer(
+        wkb, "<f8", offset=9 if kind == 2 else 5).reshape(-1, 2)
+
+
+def ranges(starts, counts):
+    """Concatenated ranges of counts from starts, as index array."""
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + np.arange(counts.sum()) - offsets
+
+
+def lookup(sorted_keys, keys):
+    """Indices of keys in sorted_keys, and whether each was found."""
+    i = np.searchsorted(sorted_keys, keys)
+    found = i < len(sorted_keys)
+    found[found] = sorted_keys[i[found]] == keys[found]
+    return i, found
+
+
+def first_of_each(keys, *order):
+    """Indices of the first of each distinct key, by order arrays, the last
+    one primary."""
+    order = np.lexsort(order + (keys,))
+    first = np.ones(len(order), bool)
+    first[1:] = keys[order[1:]] != keys[order[:-1]]
+    return order[first]
+
+
+class RoadSnapper:
+    """Roads by id, as lines of (lon, lat) vertices, and waypoints by id,
+    as (lon, lat) points linked to the roads they are on."""
+
+    def __init__(self, lines, waypoints, links, radius=100, batch=4096):
+        """lines -- (road id, array of (lon, lat) rows) parts of roads,
+            a single vertex for a point
+        waypoints -- (ids, lons, lats) arrays of waypoints
+        links -- (road ids, waypoint ids) arrays of roads_waypoints rows;
+            links to waypoints not given are ignored
+        radius -- distance in metres within which to look for roads
+        batch -- points to process at once, bounding memory use"""
+
+        self.radius = radius
+        self.batch = batch
+        lines = [
+            (r, np.asarray(v, np.float64).reshape(-1, 2)) for r, v in lines]
+        lines = [(r, v) for r, v in lines if len(v)]
+
+        # Segments between consecutive vertices, and points as degenerate ones
+        road = np.array(
+            [r for r, v in lines for _ in range(max(1, len(v) - 1))],
+            np.int64)
+        a = np.concatenate(
+            [v[:max(1, len(v) - 1)] for _, v in lines] or [np.zeros((0, 2))])
+        b = np.concatenate(
+            [v[min(1, len(v) - 1):] for _, v in lines] or [np.zeros((0, 2))])
+
+        # Cells wide enough where narrowest, with a margin for approximation
+        maxlat = min(85, np.abs(a[:, 1]).max(initial=0) + radius / 1e5)
+        self.cell = 2 * radius * 1.01
+        self.ysize = self.cell / Equirectangular.latscale
+        self.xsize = self.cell / (
+            Equirectangular.latscale * cos(maxlat / 180 * pi))
+
+        # Cut segments into pieces no longer than a cell
+        kx = Equirectangular.latscale * np.cos((a[:, 1] + b[:, 1]) / 360 * pi)
+        length = np.hypot(
+            (b[:, 0] - a[:, 0]) * kx,
+            (b[:, 1] - a[:, 1]) * Equirectangular.latscale)
+        n = np.maximum(1, np.ceil(length / self.cell)).astype(np.int64)
+        segment = np.repeat(np.arange(len(n)), n)
+        k = ranges(np.zeros(len(n), np.int64), n)[:, None]
+        nn = n[segment][:, None]
+        pa = a[segment] + (b[segment] - a[segment]) * k / nn
+        pb = a[segment] + (b[segment] - a[segment]) * (k + 1) / nn
+
+        keys = self._key(*self._cells((pa + pb) / 2))
+        order = np.argsort(keys, kind="stable")
+        self.pa, self.pb = pa[order], pb[order]
+        self.road = road[segment][order]
+        self.keys, self.starts, self.counts = np.unique(
+            keys[order], return_index=True, return_counts=True)
+
+        # Waypoints of each road, in order of road id
+        wid = np.asarray(waypoints[0], np.int64)
+        wcoords = np.stack([
+            np.asarray(waypoints[1], np.float64),
+            np.asarray(waypoints[2], np.float64)], 1).reshape(-1, 2)
+        lroad, lwaypoint = (np.asarray(x, np.int64) for x in links)
+        worder = np.argsort(wid)
+        i, known = lookup(wid[worder], lwaypoint)
+        lorder = np.argsort(lroad[known], kind="stable")
+        i = worder[i[known][lorder]]
+        self.waypoint_ids = wid[i]
+        self.waypoint_coords = wcoords[i]
+        self.link_roads, self.link_starts, self.link_counts = np.unique(
+            lroad[known][lorder], return_index=True, return_counts=True)
+
+    def _cells(self, coords):
+        return (
+            np.floor(coords[:, 0] / self.xsize).astype(np.int64),
+            np.floor(coords[:, 1] / self.ysize).astype(np.int64))
+
+    @staticmethod
+    def _key(cx, cy):
+        return cx * (1 << 32) + cy
+
+    @staticmethod
+    def _metres(coords, at):
+        """Local x, y in metres of coords relative to rows of at."""
+        return (
+            (coords[:, 0] - at[:, 0]) * Equirectangular.latscale
+                * np.cos(at[:, 1] / 180 * pi),
+            (coords[:, 1] - at[:, 1]) * Equirectangular.latscale)
+
+    def snap(self, lon, lat):
+        """Waypoint ids of points given as arrays of longitude and latitude,
+        None for points with no road within the radius, or NaN. Returns a
+        list."""
+
+        coords = np.stack([
+            np.asarray(lon, np.float64).reshape(-1),
+            np.asarray(lat, np.float64).reshape(-1)], 1)
+        out = []
+        for i in range(0, len(coords), self.batch):
+            out += self._snap(coords[i:i + self.batch]).tolist()
+        return [None if x == -1 else x for x in out]
+
+    def _snap(self, coords):
+        waypoints = np.full(len(coords), -1, np.int64)
+        valid = np.flatnonzero(np.isfinite(coords).all(1))
+        if not len(valid) or not len(self.keys):
+            return waypoints
+
+        # Candidate pieces binned in the cells around each point
+        cx, cy = self._cells(coords[valid])
+        points, starts, counts = [], [], []
+        for ox in (-1, 0, 1):
+            for oy in (-1, 0, 1):
+                j, found = lookup(self.keys, self._key(cx + ox, cy + oy))
+                points.append(valid[found])
+                starts.append(self.starts[j[found]])
+                counts.append(self.counts[j[found]])
+        counts = np.concatenate(counts)
+        point = np.repeat(np.concatenate(points), counts)
+        piece = ranges(np.concatenate(starts), counts)
+
+        # Distance to the nearest point of each piece
+        at = coords[point]
+        ax, ay = self._metres(self.pa[piece], at)
+        bx, by = self._metres(self.pb[piece], at)
+        dx, dy = bx - ax, by - ay
+        dd = dx * dx + dy * dy
+        t = np.clip(
+            -(ax * dx + ay * dy) / np.where(dd > 0, dd, 1), 0, 1)
+        distance = np.hypot(ax + t * dx, ay + t * dy)
+
+        near = distance <= self.radius
+        point, road = point[near], self.road[piece[near]]
+        best = first_of_each(point, road, distance[near])
+        point, road = point[best], road[best]
+
+        # Nearest waypoint of each point's road
+        j, found = lookup(self.link_roads, road)
+        point, j = point[found], j[found]
+        counts = self.link_counts[j]
+        candidate = ranges(self.link_starts[j], counts)
+        point = np.repeat(point, counts)
+        x, y = self._metres(self.waypoint_coords[candidate], coords[point])
+        distance = np.hypot(x, y)
+        ids = self.waypoint_ids[candidate]
+        best = first_of_each(point, ids, distance)
+        waypoints[point[best]] = ids[best]
+        return waypoints
@@ -5,7 +5,8 @@ from collections import Counter
 from sqlalchemy.sql import and_, literal_column, select
 from sqlalchemy.types import Float
 
-from pyfiles.common_helpers import do_cluster, group_unsorted
+from pyfiles.common_helpers import do_cluster, group_unsorted, InvertedIndex
+from pyfiles.constants import CLUSTER_INDEXED
 
 
 def get_routes(db, threshold, user, start=None, end=None):
@@ -97,8 +98,11 @@ def get_routes(db, threshold, user, start=None, end=None):
             {   "probs": Counter({p: 1 for p in x.get("points", [])}),
                 "trips": [x]}
             for x in group]
+        index = CLUSTER_INDEXED and InvertedIndex(
+            lambda x: [p for p, prob in x["probs"].items() if prob],
+            threshold) or None
         clustered = do_cluster(
-            clusters, route_merge, proto_distance, threshold)
+            clusters, route_merge, proto_distance, threshold, index)
         for c in clustered:
             counter["intraclusters"] += 1
             counter["trips"] += len(c["trips"])
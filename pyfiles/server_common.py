@@ -1,6 +1,4 @@
 import json
-import tempfile
-import zipfile
 
 from collections import namedtuple
 from csv import DictWriter
@@ -8,7 +6,7 @@ from datetime import datetime, timedelta
 from itertools import groupby
 from io import StringIO
 
-from flask import abort, jsonify, make_response
+from flask import abort, current_app, jsonify, make_response
 
 from sqlalchemy.sql import (
     and_, between, cast, func, literal, not_, or_, select, text)
@@ -24,10 +22,16 @@ from pyfiles.common_helpers import (
     trace_linestrings)
 
 from pyfiles.constants import BAD_LOCATION_RADIUS
+from pyfiles.response_cache import ResponseCache
 from pyfiles.routes import get_routes
+from pyfiles.zip_stream import zip_stream
 
 from pyfiles.database_interface import (
-    mass_transit_types, update_user_distances, get_csv, get_device_table_ids)
+    mass_transit_types, update_user_distances, get_csv_chunks,
+    get_device_table_ids, get_legs_revision)
+
+# Per process cache of path responses, created on first use from config
+path_cache = None
 
 def common_trips_rows(request, db, user):
     firstday = request.args.get("firstday")
@@ -288,7 +292,20 @@ def common_setlegmode(request, db, user):
     return leg.device_id, legid, legact, legline
 
 
-def common_path(request, db, where):
+def get_path_cache():
+    global path_cache
+    if path_cache is None:
+        path_cache = ResponseCache(
+            current_app.config.get("PATH_CACHE_SIZE", 256),
+            current_app.config.get("PATH_CACHE_DIR"))
+    return path_cache
+
+
+def common_path(request, db, where, user=None, device=None):
+    """Path of given day as GeoJSON. Given the user whose legs where selects,
+    and the device if limited to one, past days are cached until the legs of
+    the user, or the points before their end, change."""
+
     dd = db.metadata.tables["device_data"]
     devices = db.metadata.tables["devices"]
     legs = db.metadata.tables["leg_modes"]
@@ -330,6 +347,19 @@ def common_path(request, db, where):
     if request.args.get("firstday") or request.args.get("lastday"):
         start, end = date_start, date_end
 
+    # Only complete days are cacheable, and only if covered by legs, see below
+    cachekey = cache = None
+    if user is not None and date and not (
+            request.args.get("firstday") or request.args.get("lastday")) \
+            and end <= datetime.now():
+        cache = get_path_cache()
+        cachekey = (int(user), device, date, maxpts, mindist, exarg)
+        revision = get_legs_revision(user)
+        body = cache.get(cachekey, revision)
+        if body is not None:
+            return current_app.response_class(
+                body, mimetype="application/json")
+
     # find end of user legs
     legsend = select(
         [func.max(legs.c.time_end).label("time_end")],
@@ -382,11 +412,13 @@ def common_path(request, db, where):
     points = db.engine.execute(query)
 
     # re-split into legs, and the raw part
-    segments = (
-        legpts for (legid, legpts) in dict_groups(points, ["legstart"]))
+    segments = dict_groups(points, ["legstart"])
 
     features = []
-    for points in segments:
+    rawtrace = False
+    for legid, points in segments:
+        rawtrace = rawtrace or legid.get("legstart") is None
+
         # discard the less credible location points
         points = trace_discard_sidesteps(points, BAD_LOCATION_RADIUS)
 
@@ -397,30 +429,33 @@ def common_path(request, db, where):
         features += trace_linestrings(points, (
             'id', 'activity', 'line_name', 'time_start', 'time_end'))
 
-    return jsonify({'type': 'FeatureCollection', 'features': features})
+    response = jsonify({'type': 'FeatureCollection', 'features': features})
+
+    # The raw trace past the end of legs changes without a legs revision
+    if cache is not None and not rawtrace:
+        cache.put(cachekey, revision, response.get_data())
+
+    return response
 
 
 def common_download_zip(user):
-    # Adapted from: https://stackoverflow.com/a/11971561/5528498
+    """Stream zip of the user's data as CSV files, paging through each
+    table while sending, in constant memory."""
     dev_ids = 'device_id in (' + get_device_table_ids(user) + ')'
     user_id = str(user)
-    with tempfile.SpooledTemporaryFile() as tmp:
-        with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as archive:
-            archive.writestr('users.csv', get_csv('SELECT id,register_timestamp FROM users WHERE id='+user_id))
-            archive.writestr('devices.csv', get_csv('SELECT id,user_id,device_model,created,last_activity,client_version FROM devices WHERE user_id='+user_id))
-            archive.writestr('client_log.csv', get_csv('SELECT * FROM client_log WHERE user_id='+user_id))
-            archive.writestr('device_alerts.csv', get_csv('SELECT * FROM device_alerts WHERE '+dev_ids))
-            archive.writestr('device_data.csv', get_csv('SELECT * FROM device_data WHERE '+dev_ids))
-            archive.writestr('device_data_filtered.csv', get_csv('SELECT * FROM device_data_filtered WHERE user_id='+user_id))
-            archive.writestr('leg_ends.csv', get_csv('SELECT * FROM leg_ends WHERE user_id='+user_id))
-            archive.writestr('leg_modes.csv', get_csv('SELECT * FROM leg_modes WHERE user_id='+user_id))
-            archive.writestr('legs.csv', get_csv('SELECT * FROM legs WHERE user_id='+user_id))
-            archive.writestr('travelled_distances.csv', get_csv('SELECT * FROM travelled_distances WHERE user_id='+user_id))
-
-        # Reset file pointer
-        tmp.seek(0)
-
-        # Write file data to response
-        response = make_response(tmp.read())
-        response.mimetype = 'application/x-zip-compressed'
-        return response
+    files = [
+        ('users.csv', 'SELECT id,register_timestamp FROM users WHERE id='+user_id),
+        ('devices.csv', 'SELECT id,user_id,device_model,created,last_activity,client_version FROM devices WHERE user_id='+user_id),
+        ('client_log.csv', 'SELECT * FROM client_log WHERE user_id='+user_id),
+        ('device_alerts.csv', 'SELECT * FROM device_alerts WHERE '+dev_ids),
+        ('device_data.csv', 'SELECT * FROM device_data WHERE '+dev_ids),
+        ('device_data_filtered.csv', 'SELECT * FROM device_data_filtered WHERE user_id='+user_id),
+        ('leg_ends.csv', 'SELECT * FROM leg_ends WHERE user_id='+user_id),
+        ('leg_modes.csv', 'SELECT * FROM leg_modes WHERE user_id='+user_id),
+        ('legs.csv', 'SELECT * FROM legs WHERE user_id='+user_id),
+        ('travelled_distances.csv', 'SELECT * FROM travelled_distances WHERE user_id='+user_id)]
+
+    # Queries run lazily as the archive reaches them
+    return current_app.response_class(
+        zip_stream((name, get_csv_chunks(query)) for name, query in files),
+        mimetype='application/x-zip-compressed')
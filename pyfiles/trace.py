@@ -0,0 +1,202 @@
+"""Columnar location trace representation.
+
+Device data points are read into flat arrays once, so that trace processing
+need not parse a GeoJSON string for every distance it computes. The points of
+a Trace can still be read like the device_data rows they came from, so the
+trace helpers in common_helpers accept either; they are made on first access,
+for callers needing only the arrays."""
+
+import json
+
+from datetime import datetime, timedelta
+from math import cos, pi
+
+import numpy as np
+
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+# Columns stored as activity codes and confidences
+ACTIVITY_COLUMNS = ("activity_1", "activity_2", "activity_3")
+CONF_COLUMNS = ("activity_1_conf", "activity_2_conf", "activity_3_conf")
+
+
+def epoch_us(dt):
+    """Microseconds since the epoch of naive datetime dt."""
+    return (dt - EPOCH) // MICROSECOND
+
+
+class TracePoint:
+    """One point of a Trace, indexable with device_data column names."""
+
+    __slots__ = (
+        "trace", "index", "coordinates", "coslat", "time", "us", "accuracy")
+
+    def __init__(self, trace, index, lon, lat, coslat, us, accuracy):
+        self.trace = trace
+        self.index = index
+        self.coordinates = (lon, lat)
+        self.coslat = coslat
+        self.time = trace.times[index]
+        self.us = us
+        self.accuracy = accuracy
+
+    def __getitem__(self, key):
+        if key == "time":
+            return self.time
+        if key == "accuracy":
+            return self.accuracy
+        if key == "geojson":
+            # Compact like ST_AsGeoJSON
+            return json.dumps(
+                {"type": "Point", "coordinates": list(self.coordinates)},
+                separators=(",", ":"))
+        if key in ACTIVITY_COLUMNS:
+            code = self.trace.activity[self.index, ACTIVITY_COLUMNS.index(key)]
+            return self.trace.activity_names[code] if code >= 0 else None
+        if key in CONF_COLUMNS:
+            conf = self.trace.conf[self.index, CONF_COLUMNS.index(key)]
+            return int(conf) if conf >= 0 else None
+        if key == "device_id":
+            return int(self.trace.device_id[self.index])
+        if key in self.trace.extra:
+            return self.trace.extra[key][self.index]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.trace.columns
+
+    def keys(self):
+        return self.trace.columns
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
+class Trace:
+    """Location trace of device data points in columnar arrays.
+
+    lon, lat -- float64 degrees, rounded to the precision of ST_AsGeoJSON
+    accuracy -- float64 metres
+    us -- int64 microseconds since the epoch
+    activity -- int8 points x 3 codes into activity_names, -1 for null
+    conf -- int16 points x 3 activity confidences, -1 for null
+    device_id -- int64
+    """
+
+    def __init__(self, rows):
+        """Build from rows with lon, lat, accuracy, time, device_id and the
+        activity columns. Other columns are kept as lists in extra."""
+
+        rows = list(rows)
+        n = len(rows)
+        keys = list(rows[0].keys()) if rows else []
+
+        activity_names = []
+        codes = {None: -1}
+        def code(name):
+            if name not in codes:
+                codes[name] = len(activity_names)
+                activity_names.append(name)
+            return codes[name]
+
+        activity = np.full((n, 3), -1, np.int8)
+        conf = np.full((n, 3), -1, np.int16)
+        for j, (acol, ccol) in enumerate(zip(ACTIVITY_COLUMNS, CONF_COLUMNS)):
+            if acol in keys:
+                activity[:, j] = [code(x[acol]) for x in rows]
+            if ccol in keys:
+                conf[:, j] = [-1 if x[ccol] is None else x[ccol] for x in rows]
+
+        times = [x["time"] for x in rows]
+
+        # Round to the 9 decimals ST_AsGeoJSON emits by default, as the
+        # coordinates were when read from GeoJSON.
+        self._setup(
+            [round(x["lon"], 9) for x in rows],
+            [round(x["lat"], 9) for x in rows],
+            [x["accuracy"] for x in rows],
+            times,
+            [epoch_us(x) for x in times],
+            activity,
+            activity_names,
+            conf,
+            [x["device_id"] for x in rows] if "device_id" in keys else [0] * n,
+            {   k: [x[k] for x in rows]
+                for k in keys if k not in (
+                    "lon", "lat", "time", "accuracy", "device_id")
+                    + ACTIVITY_COLUMNS + CONF_COLUMNS})
+
+    def _setup(
+            self, lon, lat, accuracy, times, us, activity, activity_names,
+            conf, device_id, extra):
+        """Set columns, given as lists where points need Python values."""
+
+        self.lon = lon
+        self.lat = lat
+        self.coslat = [cos(x / 180 * pi) for x in lat]
+        self.accuracy = accuracy
+        self.times = times
+        self.us = us
+        self.activity = activity
+        self.activity_names = activity_names
+        self.conf = conf
+        self.device_id = np.array(device_id, np.int64)
+        self.extra = extra
+        self.columns = (
+            ("geojson", "accuracy", "time", "device_id")
+            + ACTIVITY_COLUMNS + CONF_COLUMNS + tuple(extra))
+
+        self._points = None
+
+        # Columns as arrays for vectorized use
+        self.lon = np.array(self.lon, np.float64)
+        self.lat = np.array(self.lat, np.float64)
+        self.coslat = np.array(self.coslat, np.float64)
+        self.accuracy = np.array(self.accuracy, np.float64)
+        self.us = np.array(self.us, np.int64)
+
+    @property
+    def points(self):
+        if self._points is None:
+            self._points = [
+                TracePoint(self, i, *values) for i, values in enumerate(zip(
+                    self.lon.tolist(), self.lat.tolist(),
+                    self.coslat.tolist(), self.us.tolist(),
+                    self.accuracy.tolist()))]
+        return self._points
+
+    def __len__(self):
+        return len(self.us)
+
+    def __iter__(self):
+        return iter(self.points)
+
+    def __getitem__(self, i):
+        return self.points[i]
+
+    def _squared_distances(self, indices=None):
+        if indices is None:
+            indices = np.arange(len(self))
+        i0 = indices[:-1]
+        i1 = indices[1:]
+        x = (self.lon[i0] - self.lon[i1]) * 110320 * self.coslat[i1]
+        y = (self.lat[i0] - self.lat[i1]) * 110574
+        return x * x + y * y
+
+    def distances(self, indices=None):
+        """Distances in metres between consecutive points, or consecutive
+        points of given index sequence, computed as in
+        get_distance_between_coordinates."""
+        return np.sqrt(self._squared_distances(indices))
+
+    def path_length(self, points):
+        """Sum of distances in metres along given points of this trace, equal
+        to summing point_distance over them."""
+
+        sq = self._squared_distances(np.fromiter(
+            (p.index for p in points), np.int64, len(points)))
+        # Python pow and summation order, to keep bit-identical with the
+        # pointwise computation; np.sqrt rounds differently on occasion.
+        return sum(x ** .5 for x in sq.tolist())
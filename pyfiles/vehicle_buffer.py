@@ -0,0 +1,85 @@
+"""Buffer of live vehicle positions received between database flushes."""
+
+import datetime
+import json
+import threading
+
+from collections import deque
+
+
+def hfp_vehicle_row(topic, payload):
+    """mass_transit_data row of an HFP v2 vehicle position message, or None
+    if it has no location. The coordinate is also given as longitude and
+    latitude."""
+
+    # b'{"VP":{"desi":"95","dir":"1","oper":22,"veh":888,"tst":"2018-08-12T19:15:01Z","tsi":1534101301,"spd":5.02,"hdg":277,"lat":60.219960,"long":25.099226,"acc":0.43,"dl":0,"odo":2053,"drst":0,"oday":"2018-08-12","jrn":463,"line":138,"start":"22:10"}}'
+    payload = json.loads(payload.decode('utf-8'))['VP']
+    longitude = payload['long']
+    latitude = payload['lat']
+    if longitude is None or latitude is None:
+        return None
+
+    topics = topic.split('/')
+    line_type = topics[6].upper() # HFP V2, topics[5] in V1
+    if line_type == 'METRO':
+        line_type = 'SUBWAY'
+    return {
+        'time': datetime.datetime.fromtimestamp(payload['tsi']),
+        'line_name': payload['desi'],
+        'line_type': line_type,
+        'direction': int(payload['dir']),
+        'coordinate': 'POINT(%f %f)' % (longitude, latitude),
+        'longitude': longitude,
+        'latitude': latitude,
+        'vehicle_ref': str(payload['oper']) + '/' + str(payload['veh'])}
+
+
+class VehicleBuffer:
+    """Pending vehicle rows, unique in (vehicle_ref, time) as the database
+    requires within a single insert. Holds up to maxsize rows, dropping the
+    oldest beyond that."""
+
+    def __init__(self, maxsize=200000):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.rows = deque()
+        self.keys = set()
+
+        # Counters since start
+        self.received = 0
+        self.duplicates = 0
+        self.dropped = 0
+
+    def add(self, row):
+        """Buffer row unless a duplicate; returns whether it was added."""
+        key = (row['vehicle_ref'], row['time'])
+        with self.lock:
+            self.received += 1
+            if key in self.keys:
+                self.duplicates += 1
+                return False
+            if len(self.rows) >= self.maxsize:
+                old = self.rows.popleft()
+                self.keys.discard((old['vehicle_ref'], old['time']))
+                self.dropped += 1
+            self.rows.append(row)
+            self.keys.add(key)
+            return True
+
+    def take(self):
+        """Swap out and return the pending rows as a list."""
+        with self.lock:
+            rows = self.rows
+            self.rows = deque()
+            self.keys = set()
+        return list(rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def stats(self):
+        return {
+            "pending": len(self.rows),
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "dropped": self.dropped}
@@ -0,0 +1,279 @@
+"""In-memory index of recent live vehicle positions for mass transit matching.
+
+Positions fed from the HFP feed are collected into time buckets. A bucket is
+sealed into NumPy arrays sorted by grid cell when the next one starts, so a
+bounding box lookup is a range search per row of cells. Buckets older than the
+retention are dropped, as are the oldest ones while more positions than the
+cap are kept, at about 32 bytes each once sealed.
+
+VehicleTraceIndex.match scores vehicles near a leg as the
+match_mass_transit_live query does, with the difference that it samples the
+given points of the leg rather than all device data in the time range, and
+that distances are by local equirectangular projection rather than on the
+spheroid."""
+
+import threading
+
+from collections import Counter, deque, namedtuple
+from math import ceil, cos, pi
+
+import numpy as np
+
+from pyfiles.common_helpers import Equirectangular, point_coordinates
+from pyfiles.trace import epoch_us
+
+
+# Row of match results, ordered like those of match_mass_transit_live
+LiveMatch = namedtuple(
+    "LiveMatch", ["revsum", "hitrate", "vehicle_ref", "line_type", "line_name"])
+
+
+class Bucket:
+    """Sealed positions of a time span, sorted by grid cell key."""
+
+    __slots__ = ("tmin", "tmax", "key", "t", "lon", "lat", "vehicle", "line")
+
+    def __init__(self, columns, cell):
+        t, lon, lat, vehicle, line = columns
+        lon = np.array(lon, np.float64)
+        lat = np.array(lat, np.float64)
+        key = cell_keys(lon, lat, cell)
+        order = np.argsort(key, kind="stable")
+        self.key = key[order]
+        self.t = np.array(t, np.float64)[order]
+        self.lon = lon[order].astype(np.float32)
+        self.lat = lat[order].astype(np.float32)
+        self.vehicle = np.array(vehicle, np.int32)[order]
+        self.line = np.array(line, np.int32)[order]
+        self.tmin = self.t.min()
+        self.tmax = self.t.max()
+
+    def __len__(self):
+        return len(self.t)
+
+
+# Cells are numbered row by row, wide enough for any longitude
+CELL_ROW = 1 << 20
+
+
+def cell_keys(lon, lat, cell):
+    return (np.floor((lat + 90) / cell).astype(np.int64) * CELL_ROW
+        + np.floor((lon + 180) / cell).astype(np.int64))
+
+
+class VehicleTraceIndex:
+
+    def __init__(
+            self, hours=3, max_positions=10000000, bucket_seconds=300,
+            cell=.01):
+        self.retention = hours * 3600
+        self.max_positions = max_positions
+        self.bucket_seconds = bucket_seconds
+        self.cell = cell
+        self.lock = threading.Lock()
+
+        # Interned vehicle_ref and (line_type, line_name)
+        self.vehicles = []
+        self.vehicle_codes = {}
+        self.lines = []
+        self.line_codes = {}
+
+        self.sealed = deque()
+        self.nsealed = 0
+        self.pending = ([], [], [], [], [])
+        self.pending_bucket = None
+
+        # Positions are complete from this time on, epoch seconds
+        self.since = None
+
+    def after_fork(self):
+        """Replace lock that may have been held when forked."""
+        self.lock = threading.Lock()
+
+    def add(self, row):
+        """Add mass_transit_data row with longitude and latitude."""
+
+        t = epoch_us(row["time"]) / 1e6
+        bucket = int(t // self.bucket_seconds)
+        with self.lock:
+            if self.since is None:
+                self.since = t
+            if self.pending_bucket is None:
+                self.pending_bucket = bucket
+            elif bucket > self.pending_bucket:
+                self._seal()
+                self.pending_bucket = bucket
+
+            vehicle = self.vehicle_codes.get(row["vehicle_ref"])
+            if vehicle is None:
+                vehicle = self.vehicle_codes[row["vehicle_ref"]] = len(
+                    self.vehicles)
+                self.vehicles.append(row["vehicle_ref"])
+            line = (row["line_type"], row["line_name"])
+            linecode = self.line_codes.get(line)
+            if linecode is None:
+                linecode = self.line_codes[line] = len(self.lines)
+                self.lines.append(line)
+
+            for column, value in zip(self.pending, (
+                    t, row["longitude"], row["latitude"], vehicle, linecode)):
+                column.append(value)
+
+    def _seal(self):
+        if self.pending[0]:
+            self.sealed.append(Bucket(self.pending, self.cell))
+            self.nsealed += len(self.sealed[-1])
+        self.pending = ([], [], [], [], [])
+
+        # Drop expired and over cap; positions before the last dropped are
+        # incomplete
+        horizon = self.sealed[-1].tmax - self.retention if self.sealed else 0
+        while self.sealed and (
+                self.sealed[0].tmax < horizon
+                or self.nsealed > self.max_positions):
+            dropped = self.sealed.popleft()
+            self.nsealed -= len(dropped)
+            self.since = max(self.since, dropped.tmax)
+
+    def covers(self, tstart, tradius):
+        """Whether positions are complete from tradius before tstart."""
+        since = self.since
+        return since is not None and epoch_us(tstart) / 1e6 - tradius >= since
+
+    def __len__(self):
+        return self.nsealed + len(self.pending[0])
+
+    def positions(self, t0, t1, lon0, lat0, lon1, lat1):
+        """Arrays of t, lon, lat, vehicle, line of positions in time range
+        (t0, t1) and bounding box."""
+
+        with self.lock:
+            sealed = list(self.sealed)
+            pending = [list(x) for x in self.pending]
+
+        parts = []
+        for b in sealed:
+            if b.tmax <= t0 or b.tmin >= t1:
+                continue
+            rows = np.arange(
+                np.floor((lat0 + 90) / self.cell),
+                np.floor((lat1 + 90) / self.cell) + 1).astype(np.int64)
+            cx0 = int(np.floor((lon0 + 180) / self.cell))
+            cx1 = int(np.floor((lon1 + 180) / self.cell))
+            lo = np.searchsorted(b.key, rows * CELL_ROW + cx0, "left")
+            hi = np.searchsorted(b.key, rows * CELL_ROW + cx1, "right")
+            idx = np.concatenate(
+                [np.arange(l, h) for l, h in zip(lo, hi) if h > l]
+                or [np.zeros(0, np.int64)])
+            parts.append((
+                b.t[idx], b.lon[idx].astype(np.float64),
+                b.lat[idx].astype(np.float64), b.vehicle[idx], b.line[idx]))
+        if pending[0]:
+            parts.append((
+                np.array(pending[0], np.float64),
+                np.array(pending[1], np.float64),
+                np.array(pending[2], np.float64),
+                np.array(pending[3], np.int32),
+                np.array(pending[4], np.int32)))
+        if not parts:
+            return tuple(np.zeros(0) for _ in range(5))
+
+        t, lon, lat, vehicle, line = (
+            np.concatenate([p[i] for p in parts]) for i in range(5))
+        mask = ((t > t0) & (t < t1) & (lon >= lon0) & (lon <= lon1)
+            & (lat >= lat0) & (lat <= lat1))
+        return t[mask], lon[mask], lat[mask], vehicle[mask], line[mask]
+
+    def match(self, points, tradius, dradius, nsamples):
+        """Vehicles near the time-sorted points of a leg, as list of LiveMatch
+        best first, or None if the index does not cover the leg."""
+
+        if not points or not self.covers(points[0]["time"], tradius):
+            return None
+
+        # Sample integer interval as in match_mass_transit_live
+        n = len(points)
+        step = int(ceil((1 + n) / (1.0 + nsamples)))
+        trace = [points[rn - 1] for rn in range(1, n + 1) if rn % step == 0]
+        if not trace:
+            return []
+        coords = np.array([point_coordinates(p) for p in trace], np.float64)
+        times = np.array([epoch_us(p["time"]) / 1e6 for p in trace])
+
+        # Bounding box margin as in match_mass_transit_live
+        margin = dradius / cos(pi * np.abs(coords[:, 1]).max() / 180) / 110574
+        tstart = epoch_us(points[0]["time"]) / 1e6
+        tend = epoch_us(points[-1]["time"]) / 1e6
+        t, lon, lat, vehicle, line = self.positions(
+            tstart - tradius, tend + tradius,
+            coords[:, 0].min() - margin, coords[:, 1].min() - margin,
+            coords[:, 0].max() + margin, coords[:, 1].max() + margin)
+
+        # Vehicle traces in time order
+        order = np.lexsort((t, vehicle))
+        t, lon, lat, vehicle, line = (
+            x[order] for x in (t, lon, lat, vehicle, line))
+
+        revsum = Counter()
+        hits = Counter()
+        types = {}
+        names = {}
+        for (plon, plat), pt in zip(coords, times):
+            window = np.abs(t - pt) <= tradius
+            if not window.any():
+                continue
+            wv = vehicle[window]
+            dist = polyline_distances(
+                Equirectangular(plon, plat),
+                lon[window], lat[window], wv)
+            wline = line[window]
+            for v, d in dist.items():
+                if d > dradius:
+                    continue
+                revsum[v] += dradius - d
+                hits[v] += 1
+                vlines = [self.lines[x] for x in wline[wv == v].tolist()]
+                types.setdefault(v, []).append(mode(x[0] for x in vlines))
+                names.setdefault(v, []).append(mode(x[1] for x in vlines))
+
+        matches = [
+            LiveMatch(
+                revsum[v], 1.0 * hits[v] / len(trace), self.vehicles[v],
+                mode(types[v]), mode(names[v]))
+            for v in hits]
+        matches.sort(key=lambda x: (-x.hitrate, -x.revsum))
+        return matches
+
+
+def polyline_distances(projector, lon, lat, vehicle):
+    """Distance in metres from projector origin to the polyline of each
+    vehicle, given positions sorted by vehicle and time."""
+
+    x, y = projector.d2m(lon, lat)
+    best = np.hypot(x, y)
+    same = vehicle[:-1] == vehicle[1:]
+    if same.any():
+        x0, y0, x1, y1 = x[:-1][same], y[:-1][same], x[1:][same], y[1:][same]
+        dx, dy = x1 - x0, y1 - y0
+        lsq = dx * dx + dy * dy
+        par = np.clip(
+            np.divide(
+                -(x0 * dx + y0 * dy), lsq, out=np.zeros_like(lsq),
+                where=lsq > 0),
+            0, 1)
+        segdist = np.hypot(x0 + par * dx, y0 + par * dy)
+        best = best.copy()
+        np.minimum.at(best, np.flatnonzero(same), segdist)
+
+    uv, inv = np.unique(vehicle, return_inverse=True)
+    vbest = np.full(len(uv), np.inf)
+    np.minimum.at(vbest, inv, best)
+    return dict(zip(uv.tolist(), vbest.tolist()))
+
+
+def mode(values):
+    """Most frequent value, the least of equally frequent ones, as with the
+    mode() aggregate."""
+    counts = Counter(values)
+    top = max(counts.values())
+    return min(x for x, c in counts.items() if c == top)
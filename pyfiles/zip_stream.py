@@ -0,0 +1,64 @@
+"""Streaming ZIP archives of CSV files in bounded memory.
+
+zip_stream writes the archive into a sink that is emptied as the generator
+yields, so a response can send the archive while its rows are still being
+read. Entries are written with data descriptors, as the sink cannot seek
+back to fill in sizes, and with ZIP64 extensions, as their size is not known
+in advance."""
+
+import zipfile
+
+from csv import writer
+from io import StringIO
+
+
+class ZipSink:
+    """Unseekable file for ZipFile to write into, emptied by take."""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+def csv_chunks(columns, batches):
+    """UTF-8 CSV of a header of columns, then one chunk per batch of rows."""
+    buf = StringIO()
+    csv = writer(buf)
+    csv.writerow(columns)
+    for rows in batches:
+        csv.writerows(rows)
+        yield buf.getvalue().encode("utf8")
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf8") # header of no rows
+
+
+def zip_stream(files, chunk_size=1 << 16):
+    """Deflated ZIP archive of (name, chunks) files as byte strings of about
+    chunk_size or more. Each file's chunks are consumed only when its turn
+    comes, so they can be lazy queries."""
+
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, chunks in files:
+            with archive.open(name, "w", force_zip64=True) as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    if sink.size >= chunk_size:
+                        yield sink.take()
+    yield sink.take()
@@ -3,29 +3,39 @@ from datetime import timedelta
 from itertools import chain
 
 import json
+import multiprocessing
 import os
-import re
 import sys
 import time
-import requests
 import paho.mqtt.client as mqtt
 # import paho.mqtt.subscribe as subscribe
-import threading
 # import ssl # uncomment for using TLS with MQTT
 
 
 from pyfiles.database_interface import (
     init_db, data_points_by_user_id_after, device_data_delete_duplicates,
-    device_data_waypoint_snapping, generate_rankings,
+    device_data_waypoint_snapping, generate_certificate_rankings,
+    generate_rankings,
     hsl_alerts_insert, weather_forecast_insert, weather_observations_insert,
     traffic_disorder_insert, match_pubtrans_alert, match_pubtrans_alert_test,
-    match_traffic_disorder, update_global_statistics, update_user_distances)
+    match_traffic_disorder, prune_certificate_rankings,
+    refresh_certificate_rankings, update_global_statistics,
+    update_user_distances,
+    mass_transit_data_copy, mass_transit_data_partitions, recluster_leg_ends,
+    copy_cursor, point_ewkb_hex)
 
 from pyfiles.push_messaging import push_ptp_alert  # push_ptp_pubtrans, push_ptp_traffic,
 from pyfiles.push_messaging import PTP_TYPE_PUBTRANS, PTP_TYPE_DIGITRAFFIC
 from pyfiles.device_data_filterer import DeviceDataFilterer
+from pyfiles.journey_planner import DEFAULT_URL, JourneyPlannerClient
+from pyfiles.places_clusterer import cluster_places, match_places
+from pyfiles.reverse_geocoder import ReverseGeocoderClient
+from pyfiles.trace import Trace
+from pyfiles.vehicle_buffer import VehicleBuffer, hfp_vehicle_row
+from pyfiles.vehicle_index import VehicleTraceIndex
 
 from pyfiles.common_helpers import (
+    get_distance_between_coordinates,
     interpret_jore,
     pairwise,
     point_coordinates)
@@ -76,11 +86,31 @@ mass_transit_data_table = db.metadata.tables['mass_transit_data']
 global_statistics_table = db.metadata.tables['global_statistics']
 
 
+# Recent vehicle positions for matching legs locally, if enabled by config
+vehicle_index = None
+
+# Cached and rate limited journey planner queries of leg generation
+journey_planner = None
+
+# Reverse geocoding of place labels, created on first use
+reverse_geocoder = None
+
+
 def initialize():
-    global vehicle_push_lock
-    vehicle_push_lock = threading.Lock() # MQTT reception and DB write in separate threads
-    global push_vehicles
-    push_vehicles = []
+    global vehicle_buffer
+    vehicle_buffer = VehicleBuffer() # MQTT reception and DB write in separate threads
+    global vehicle_index
+    hours = app.config.get("VEHICLE_INDEX_HOURS")
+    if hours:
+        vehicle_index = VehicleTraceIndex(
+            hours, app.config.get("VEHICLE_INDEX_MAX_POSITIONS") or 10000000)
+    global journey_planner
+    # Rate limit is per process, shared by the leg generation workers
+    journey_planner = JourneyPlannerClient(
+        app.config.get("JOURNEY_PLANNER_URL") or DEFAULT_URL,
+        (app.config.get("JOURNEY_PLANNER_QUERIES_PER_SECOND") or 10.)
+            / (app.config.get("LEG_GENERATION_WORKERS") or 1),
+        app.config.get("JOURNEY_PLANNER_CONCURRENCY") or 4)
     print("initialising scheduler")
     scheduler = BackgroundScheduler()
     scheduler.start()
@@ -99,6 +129,9 @@ def run_daily_tasks():
     run_hourly_tasks()
     filter_device_data()
     generate_distance_data()
+    generate_certificate_rankings()
+    prune_certificate_rankings(
+        app.config.get("CERTIFICATE_RANKINGS_KEEP_DAYS") or 28)
     generate_global_statistics()
     set_leg_waypoints()
     mass_transit_cleanup()
@@ -111,12 +144,13 @@ def run_hourly_tasks():
     generate_trips()
 
 
-def generate_legs(keepto=None, maxtime=None, repair=False):
+def generate_legs(keepto=None, maxtime=None, repair=False, workers=None):
     """Record legs from stops and mobile activity found in device telemetry.
 
     keepto -- keep legs before this time, except last two or so for restart
     maxtime -- process device data up to this time
-    repair -- re-evaluate and replace all changed legs"""
+    repair -- re-evaluate and replace all changed legs
+    workers -- number of processes to use, default LEG_GENERATION_WORKERS"""
 
     now = datetime.datetime.now()
     if not keepto:
@@ -186,112 +220,34 @@ def generate_legs(keepto=None, maxtime=None, repair=False):
             devmax.c.firstpoint.label("start")])
 
     starts = starts.order_by(devmax.c.device_id)
-    for device, rewind, start in db.engine.execute(starts):
-        query = select(
-            [   func.ST_AsGeoJSON(dd.c.coordinate).label("geojson"),
-                dd.c.accuracy,
-                dd.c.time,
-                dd.c.device_id,
-                dd.c.activity_1, dd.c.activity_1_conf,
-                dd.c.activity_2, dd.c.activity_2_conf,
-                dd.c.activity_3, dd.c.activity_3_conf],
-            and_(
-                dd.c.device_id == device,
-                dd.c.time >= rewind,
-                dd.c.time < maxtime),
-            order_by=dd.c.time)
-
-        points = db.engine.execute(query).fetchall()
-
-        print("d"+str(device), "resume", str(start)[:19], \
-            "rewind", str(rewind)[:19], str(len(points))+"p")
-
-        filterer = DeviceDataFilterer() # not very objecty rly
-        lastend = None
-        newlegs = filterer.generate_device_legs(points, start)
 
-        for (prevleg, _), (leg, legmodes) in pairwise(
-                chain([(None, None)], newlegs)):
-
-          with db.engine.begin() as t:
-
-            lastend = leg["time_end"]
-
-            print(" ".join([
-                "d"+str(device),
-                str(leg["time_start"])[:19],
-                str(leg["time_end"])[:19],
-                leg["activity"]]), end=' ')
-
-            # Adjust leg for db entry
-            gj0 = leg.pop("geojson_start", None)
-            gj1 = leg.pop("geojson_end", None)
-            leg.update({
-                "device_id": device,
-                "coordinate_start": gj0 and func.ST_GeomFromGeoJSON(gj0),
-                "coordinate_end": gj1 and func.ST_GeomFromGeoJSON(gj1)})
-
-            # Deal with overlapping legs on rewind/repair
-            legid = t.execute(select(
-                [legs.c.id],
-                and_(*(legs.c[c] == leg[c] for c in list(leg.keys()))))).scalar()
-            if legid:
-                print("-> unchanged", end=' ')
-            else:
-                overlapstart = prevleg and prevleg["time_end"] or start
-                overlaps = [x[0] for x in t.execute(select(
-                    [legs.c.id],
-                    and_(
-                        legs.c.device_id == leg["device_id"],
-                        legs.c.time_start < leg["time_end"],
-                        legs.c.time_end > overlapstart),
-                    order_by=legs.c.time_start))]
-                if overlaps:
-                    legid, dels = overlaps[0], overlaps[1:]
-                    t.execute(legs.update(legs.c.id == legid, leg))
-                    print("-> update", end=' ')
-                    if dels:
-                        t.execute(legs.delete(legs.c.id.in_(dels)))
-                        print("-> delete %d" % len(dels))
-                else:
-                    ins = legs.insert(leg).returning(legs.c.id)
-                    legid = t.execute(ins).scalar()
-                    print("-> insert", end=' ')
-
-            # Delete mismatching modes, add new modes
-            modes = db.metadata.tables["modes"]
-            exmodes = {x[0]: x[1:] for x in t.execute(select(
-                [modes.c.source, modes.c.mode, modes.c.line],
-                legs.c.id == legid,
-                legs.join(modes)))}
-            for src in set(exmodes).union(legmodes):
-                ex, nu = exmodes.get(src), legmodes.get(src)
-                if nu == ex:
-                    continue
-                if ex is not None:
-                    print("-> del", src, ex, end=' ')
-                    t.execute(modes.delete(and_(
-                        modes.c.leg == legid, modes.c.source == src)))
-                if nu is not None:
-                    print("-> ins", src, nu, end=' ')
-                    t.execute(modes.insert().values(
-                        leg=legid, source=src, mode=nu[0], line=nu[1]))
-
-            print()
-
-        # Emit null activity terminator leg to mark trailing undecided points,
-        # if any, to avoid unnecessary reprocessing on resume.
-        rejects = [x for x in points if not lastend or x["time"] > lastend]
-        if rejects:
-            db.engine.execute(legs.delete(and_(
-                legs.c.device_id == device,
-                legs.c.time_start <= rejects[-1]["time"],
-                legs.c.time_end >= rejects[0]["time"])))
-            db.engine.execute(legs.insert({
-                "device_id": device,
-                "time_start": rejects[0]["time"],
-                "time_end": rejects[-1]["time"],
-                "activity": None}))
+    # Group devices by owning user, so that parallel workers do not contend
+    # over the same user's legs and leg_ends trigger updates.
+    owners = dict(db.engine.execute(select(
+        [devices_table.c.id, devices_table.c.user_id])).fetchall())
+    units = {}
+    for device, rewind, start in db.engine.execute(starts):
+        units.setdefault(owners.get(device, -device), []).append(
+            (device, rewind, start, maxtime))
+
+    if not workers:
+        workers = app.config.get("LEG_GENERATION_WORKERS") or 1
+    if workers > 1 and len(units) > 1:
+        # Connections must not be shared with forked children, so let them
+        # open their own; the pool runs each owner's devices as one unit.
+        db.engine.dispose()
+        pool = multiprocessing.get_context("fork").Pool(
+            workers, initializer=init_leg_worker)
+        try:
+            for _ in pool.imap_unordered(
+                    generate_legs_for_devices, list(units.values())):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for unit in units.values():
+            generate_legs_for_devices(unit)
 
     # Attach device legs to users.
     devices = db.metadata.tables["devices"]
@@ -389,9 +345,314 @@ def generate_legs(keepto=None, maxtime=None, repair=False):
     label_places(60)
 
 
+def init_leg_worker():
+    """Give a forked generate_legs worker a connection pool of its own. The
+    inherited pool is kept referenced, so its connections shared with the
+    parent are not closed on garbage collection."""
+
+    global inherited_pool
+    inherited_pool = db.engine.pool
+    db.engine.pool = inherited_pool.recreate()
+
+    # The MQTT thread may have held the index lock, and is not forked along
+    if vehicle_index is not None:
+        vehicle_index.after_fork()
+    if journey_planner is not None:
+        journey_planner.after_fork()
+
+
+def generate_legs_for_devices(unit):
+    """Generate legs for a list of (device, rewind, start, maxtime) windows,
+    typically the devices of one user, in the calling process."""
+
+    for device, rewind, start, maxtime in unit:
+        t0 = time.time()
+        npoints = generate_legs_for_device(device, rewind, start, maxtime)
+        print("d"+str(device), "%dp processed in %.2f seconds" % (
+            npoints, time.time() - t0))
+
+
+def generate_legs_for_device(device, rewind, start, maxtime):
+    """Record legs of one device from points between rewind and maxtime,
+    rewriting legs from start on. Returns the number of points read."""
+
+    dd = db.metadata.tables["device_data"]
+    legs = db.metadata.tables["legs"]
+
+    query = select(
+        [   func.ST_X(func.geometry(dd.c.coordinate)).label("lon"),
+            func.ST_Y(func.geometry(dd.c.coordinate)).label("lat"),
+            dd.c.accuracy,
+            dd.c.time,
+            dd.c.device_id,
+            dd.c.activity_1, dd.c.activity_1_conf,
+            dd.c.activity_2, dd.c.activity_2_conf,
+            dd.c.activity_3, dd.c.activity_3_conf],
+        and_(
+            dd.c.device_id == device,
+            dd.c.time >= rewind,
+            dd.c.time < maxtime),
+        order_by=dd.c.time)
+
+    points = Trace(db.engine.execute(query))
+
+    print("d"+str(device), "resume", str(start)[:19], \
+        "rewind", str(rewind)[:19], str(len(points))+"p")
+
+    filterer = DeviceDataFilterer(
+        vehicle_index, journey_planner) # not very objecty rly
+    newlegs = list(filterer.generate_device_legs(points, start))
+
+    with db.engine.begin() as t:
+        reconcile_device_legs(t, device, start, newlegs)
+
+        # Emit null activity terminator leg to mark trailing undecided points,
+        # if any, to avoid unnecessary reprocessing on resume.
+        lastend = newlegs and newlegs[-1][0]["time_end"]
+        rejects = [x for x in points if not lastend or x["time"] > lastend]
+        if rejects:
+            t.execute(legs.delete(and_(
+                legs.c.device_id == device,
+                legs.c.time_start <= rejects[-1]["time"],
+                legs.c.time_end >= rejects[0]["time"])))
+            t.execute(legs.insert({
+                "device_id": device,
+                "time_start": rejects[0]["time"],
+                "time_end": rejects[-1]["time"],
+                "activity": None}))
+
+    return len(points)
+
+
+def reconcile_device_legs(t, device, start, newlegs):
+    """Write generated (leg, modes) pairs of one device over its existing legs
+    in transaction t. Each leg is kept if identical to an existing one, else it
+    replaces the first leg overlapping it after the previous leg's end, or
+    start, deleting the other overlapping ones, or is inserted. The decisions
+    are made on one fetch of the affected rows, and applied in bulk."""
+
+    if not newlegs:
+        return
+
+    values = {
+        "n": list(range(len(newlegs))),
+        "time_start": [x["time_start"] for x, _ in newlegs],
+        "time_end": [x["time_end"] for x, _ in newlegs],
+        "activity": [x["activity"] for x, _ in newlegs],
+        "km": [x.get("km") for x, _ in newlegs],
+        "gj0": [x.get("geojson_start") for x, _ in newlegs],
+        "gj1": [x.get("geojson_end") for x, _ in newlegs]}
+
+    # Overlap checks start after the previous leg's end, or start for first
+    overlapstarts = [start] + values["time_end"][:-1]
+
+    # Identical legs per new leg, and all legs the overlap checks can hit
+    query = text("""
+        WITH v AS (
+            SELECT * FROM unnest(
+                CAST(:n AS integer[]),
+                CAST(:time_start AS timestamp[]),
+                CAST(:time_end AS timestamp[]),
+                CAST(:activity AS activity_type_enum[]),
+                CAST(:km AS float[]),
+                CAST(:gj0 AS text[]),
+                CAST(:gj1 AS text[]))
+            AS v(n, time_start, time_end, activity, km, gj0, gj1))
+        SELECT v.n, l.id, l.time_start, l.time_end
+        FROM v JOIN legs l
+        ON  l.device_id = :device
+        AND l.time_start = v.time_start
+        AND l.time_end = v.time_end
+        AND l.activity = v.activity
+        AND (v.km IS NULL OR l.km = v.km)
+        AND (v.gj0 IS NULL AND l.coordinate_start IS NULL
+            OR l.coordinate_start = ST_GeomFromGeoJSON(v.gj0))
+        AND (v.gj1 IS NULL AND l.coordinate_end IS NULL
+            OR l.coordinate_end = ST_GeomFromGeoJSON(v.gj1))
+        UNION ALL
+        SELECT NULL, id, time_start, time_end
+        FROM legs
+        WHERE device_id = :device
+        AND time_start < :hi
+        AND time_end > :lo""")
+
+    identical = {}
+    extent = {}
+    for n, legid, time_start, time_end in t.execute(
+            query,
+            device=device,
+            lo=min(overlapstarts),
+            hi=max(values["time_end"]),
+            **values):
+        if n is not None:
+            identical.setdefault(n, []).append(legid)
+        extent[legid] = (time_start, time_end)
+
+    # Replay the leg by leg decisions against the fetched extents. Generated
+    # legs are in time order, so those written earlier in the batch end at or
+    # before later overlap starts and need not be tracked.
+    assigned = [None] * len(newlegs)
+    updates = {}
+    deletes = set()
+    actions = []
+    for n, (leg, _) in enumerate(newlegs):
+        same = [x for x in identical.get(n, [])
+            if x not in deletes and x not in updates]
+        if same:
+            assigned[n] = same[0]
+            actions.append("-> unchanged")
+            continue
+
+        overlaps = sorted(
+            (ts, legid) for legid, (ts, te) in extent.items()
+            if legid not in deletes
+            and legid not in updates
+            and ts < leg["time_end"]
+            and te > overlapstarts[n])
+        if not overlaps:
+            actions.append("-> insert")
+            continue
+
+        legid, dels = overlaps[0][1], [x for _, x in overlaps[1:]]
+        assigned[n] = legid
+        updates[legid] = n
+        deletes.update(dels)
+        actions.append(
+            "-> update" + (" -> delete %d" % len(dels) if dels else ""))
+
+    def subset(ns):
+        return {k: [v[i] for i in ns] for k, v in values.items() if k != "n"}
+
+    # Apply updates, deletes and inserts, each in one statement.
+    if updates:
+        ids, ns = zip(*sorted(updates.items()))
+        t.execute(text("""
+            UPDATE legs SET
+                device_id = :device,
+                time_start = v.time_start,
+                time_end = v.time_end,
+                activity = v.activity,
+                km = coalesce(v.km, legs.km),
+                coordinate_start = ST_GeomFromGeoJSON(v.gj0),
+                coordinate_end = ST_GeomFromGeoJSON(v.gj1)
+            FROM unnest(
+                CAST(:id AS integer[]),
+                CAST(:time_start AS timestamp[]),
+                CAST(:time_end AS timestamp[]),
+                CAST(:activity AS activity_type_enum[]),
+                CAST(:km AS float[]),
+                CAST(:gj0 AS text[]),
+                CAST(:gj1 AS text[]))
+            AS v(id, time_start, time_end, activity, km, gj0, gj1)
+            WHERE legs.id = v.id"""),
+            device=device, id=list(ids), **subset(ns))
+
+    if deletes:
+        t.execute(
+            text("DELETE FROM legs WHERE id = ANY(CAST(:ids AS integer[]))"),
+            ids=list(deletes))
+
+    inserts = [n for n in range(len(newlegs)) if assigned[n] is None]
+    if inserts:
+        # Ids are drawn beforehand, as RETURNING cannot tell which leg of
+        # the input got which
+        rows = t.execute(text("""
+            WITH v AS (
+                SELECT nextval(pg_get_serial_sequence('legs', 'id')) id, u.*
+                FROM unnest(
+                    CAST(:n AS integer[]),
+                    CAST(:time_start AS timestamp[]),
+                    CAST(:time_end AS timestamp[]),
+                    CAST(:activity AS activity_type_enum[]),
+                    CAST(:km AS float[]),
+                    CAST(:gj0 AS text[]),
+                    CAST(:gj1 AS text[]))
+                AS u(n, time_start, time_end, activity, km, gj0, gj1)
+                ORDER BY u.n),
+            inserted AS (
+                INSERT INTO legs (
+                    id, device_id, time_start, time_end, activity, km,
+                    coordinate_start, coordinate_end)
+                SELECT
+                    v.id, :device, v.time_start, v.time_end, v.activity,
+                    v.km, ST_GeomFromGeoJSON(v.gj0), ST_GeomFromGeoJSON(v.gj1)
+                FROM v)
+            SELECT n, id FROM v"""),
+            device=device, n=inserts, **subset(inserts))
+        for n, legid in rows:
+            assigned[n] = legid
+
+    # Diff modes of the surviving legs against those recorded.
+    modes = db.metadata.tables["modes"]
+    final = {}
+    for n, (_, legmodes) in enumerate(newlegs):
+        final[assigned[n]] = legmodes
+    exmodes = {}
+    for legid, src, mode, line in t.execute(select(
+            [modes.c.leg, modes.c.source, modes.c.mode, modes.c.line],
+            modes.c.leg.in_(list(final)))):
+        exmodes.setdefault(legid, {})[src] = (mode, line)
+
+    modedels = []
+    modeins = []
+    modeacts = {}
+    for legid, legmodes in final.items():
+        ex = exmodes.get(legid, {})
+        for src in set(ex).union(legmodes):
+            e, nu = ex.get(src), legmodes.get(src)
+            if nu == e:
+                continue
+            if e is not None:
+                modeacts.setdefault(legid, []).append(
+                    " ".join(["-> del", src, str(e)]))
+                modedels.append((legid, src))
+            if nu is not None:
+                modeacts.setdefault(legid, []).append(
+                    " ".join(["-> ins", src, str(nu)]))
+                modeins.append(
+                    {"leg": legid, "source": src, "mode": nu[0], "line": nu[1]})
+
+    if modedels:
+        legids, srcs = zip(*modedels)
+        t.execute(text("""
+            DELETE FROM modes USING unnest(
+                CAST(:legs AS integer[]),
+                CAST(:sources AS mode_source_enum[])) AS v(leg, source)
+            WHERE modes.leg = v.leg AND modes.source = v.source"""),
+            legs=list(legids), sources=list(srcs))
+    if modeins:
+        t.execute(modes.insert(), modeins)
+
+    # Replace distance summaries of the legs written
+    written = [
+        n for n in range(len(newlegs)) if actions[n] != "-> unchanged"]
+    if written:
+        t.execute(text("""
+            DELETE FROM leg_distances
+            WHERE leg = ANY(CAST(:ids AS integer[]))"""),
+            ids=[assigned[n] for n in written])
+        distances = [
+            {"leg": assigned[n], "time": day, "km": km}
+            for n in written
+            for day, km in newlegs[n][0].get("distances", [])]
+        if distances:
+            t.execute(db.metadata.tables["leg_distances"].insert(), distances)
+
+    for n, (leg, _) in enumerate(newlegs):
+        print(" ".join([
+            "d"+str(device),
+            str(leg["time_start"])[:19],
+            str(leg["time_end"])[:19],
+            leg["activity"],
+            actions[n]] + modeacts.get(assigned[n], [])))
+
+
 def cluster_legs(limit):
-    """New leg ends and places are clustered live by triggers; this can be used
-    to cluster data created earlier."""
+    """New leg ends and places are clustered live by triggers, or leg ends
+    queued for recluster_leg_ends in LEG_ENDS_DEFERRED mode; this processes
+    the queue, and can be used to cluster data created earlier."""
+
+    recluster_leg_ends()
 
     print("cluster_legs up to", limit)
 
@@ -400,15 +661,135 @@ def cluster_legs(limit):
         t.execute(text("SELECT leg_ends_cluster(:limit)"), limit=limit)
 
 
+def recluster_places(dry_run=False):
+    """Rebuild all places from leg end coordinates with cluster_places, rather
+    than place by place as the triggers of sql/places.sql do, for instance
+    after changing DEST_RADIUS_MAX. Places whose leg ends mostly stay together
+    keep their id and label. Prints and returns how the result differs from
+    the trigger maintained places; dry_run only compares. Run from the
+    command line as
+
+        python scheduler.py recluster_places [--dry-run]"""
+
+    t0 = time.time()
+    with db.engine.begin() as t:
+        # Hold off triggers moving places meanwhile, read coordinates exactly
+        t.execute(text("LOCK TABLE places IN SHARE ROW EXCLUSIVE MODE"))
+        t.execute(text("SET LOCAL extra_float_digits = 3"))
+        ends = t.execute(text("""
+            SELECT id, ST_X(coordinate::geometry), ST_Y(coordinate::geometry),
+                place
+            FROM leg_ends WHERE coordinate IS NOT NULL ORDER BY id""")
+            ).fetchall()
+        old = {
+            pid: None if x is None else (x, y)
+            for pid, x, y in t.execute(text("""
+                SELECT id, ST_X(coordinate::geometry),
+                    ST_Y(coordinate::geometry)
+                FROM places"""))}
+        print("recluster_places: %d leg ends, %d places read in %.1fs" % (
+            len(ends), len(old), time.time() - t0))
+
+        t1 = time.time()
+        labels, centroids = cluster_places(
+            [x[1] for x in ends], [x[2] for x in ends], 2*DEST_RADIUS_MAX)
+        labels = labels.tolist()
+        centroids = centroids.tolist()
+        print("recluster_places: %d places clustered in %.1fs" % (
+            len(centroids), time.time() - t1))
+
+        # Keep places by largest number of leg ends staying in them
+        kept = match_places(labels, [x.place for x in ends])
+        created = [x for x in range(len(centroids)) if x not in kept]
+        removed = sorted(set(old) - set(kept.values()))
+        moved = {
+            pid: centroids[x] for x, pid in kept.items()
+            if old[pid] != tuple(centroids[x])}
+        far = sum(
+            1 for pid, c in moved.items()
+            if old[pid] is None or get_distance_between_coordinates(
+                old[pid], c) > DEST_RADIUS_MAX)
+        changed = [
+            (end.id, label) for end, label in zip(ends, labels)
+            if end.place is None or end.place != kept.get(label)]
+
+        report = {
+            "leg_ends": len(ends),
+            "leg_ends_changed": len(changed),
+            "places_before": len(old),
+            "places_after": len(centroids),
+            "places_kept": len(kept),
+            "places_moved": len(moved),
+            "places_moved_far": far,
+            "places_created": len(created),
+            "places_removed": len(removed)}
+        print(
+            "recluster_places: %d of %d leg ends (%.1f%%) change place; "
+            "%d places become %d: %d kept, of which %d moved, %d over %dm, "
+            "%d created, %d removed" % (
+                len(changed), len(ends),
+                100. * len(changed) / max(1, len(ends)),
+                len(old), len(centroids), len(kept), len(moved), far,
+                DEST_RADIUS_MAX, len(created), len(removed)))
+        if dry_run:
+            return report
+
+        # Number new places from the sequence
+        ids = dict(kept)
+        if created:
+            ids.update(zip(created, (x for x, in t.execute(text("""
+                SELECT nextval(pg_get_serial_sequence('places', 'id'))
+                FROM generate_series(1, :n)"""), n=len(created)))))
+
+        copy_cursor(
+            t.connection.cursor(), "places", ("id", "coordinate"),
+            ((ids[x], point_ewkb_hex(*centroids[x])) for x in created))
+        if moved:
+            t.execute(text("""
+                UPDATE places
+                SET coordinate =
+                    ST_SetSRID(ST_MakePoint(v.x, v.y), 4326)::geography
+                FROM unnest(
+                    CAST(:ids AS integer[]),
+                    CAST(:xs AS double precision[]),
+                    CAST(:ys AS double precision[])) v (id, x, y)
+                WHERE places.id = v.id"""),
+                ids=list(moved),
+                xs=[x for x, _ in moved.values()],
+                ys=[y for _, y in moved.values()])
+        if changed:
+            t.execute(text("""
+                UPDATE leg_ends SET place = v.place
+                FROM unnest(
+                    CAST(:ids AS integer[]), CAST(:places AS integer[]))
+                    v (id, place)
+                WHERE leg_ends.id = v.id"""),
+                ids=[x for x, _ in changed],
+                places=[ids[x] for _, x in changed])
+        t.execute(text("""
+            UPDATE leg_ends SET place = NULL
+            WHERE coordinate IS NULL AND place IS NOT NULL"""))
+        if removed:
+            t.execute(text(
+                "DELETE FROM places WHERE id = ANY(CAST(:ids AS integer[]))"),
+                ids=removed)
+
+    print("recluster_places: done in %.1fs" % (time.time() - t0))
+    return report
+
+
 def label_places(timeout):
     """Add labels to places that have no labels, or position has shifted
-    significantly since labeling.
+    significantly since labeling. Labels are reused by coordinate cell from
+    the reverse_geocoding_cache table, and cells not cached are queried in
+    parallel for up to timeout seconds.
 
-    Reverse geocoding api url and rate limit are read from configuration, for
-    example:
+    Reverse geocoding api url, rate limit and concurrency are read from
+    configuration, for example:
 
     REVERSE_GEOCODING_URI_TEMPLATE = 'https://search.mapzen.com/v1/reverse?api_key=API_KEY&sources=osm&size=20&point.lat={lat}&point.lon={lon}'
-    REVERSE_GEOCODING_QUERIES_PER_SECOND = 6"""
+    REVERSE_GEOCODING_QUERIES_PER_SECOND = 6
+    REVERSE_GEOCODING_CONCURRENCY = 4"""
 
     print("label_places up to %ds" % timeout)
 
@@ -421,43 +802,46 @@ def label_places(timeout):
             "not be labeled")
         return
 
+    global reverse_geocoder
+    if reverse_geocoder is None:
+        reverse_geocoder = ReverseGeocoderClient(
+            url_template, qps,
+            app.config.get('REVERSE_GEOCODING_CONCURRENCY') or 4)
+
+    deadline = time.time() + timeout
     places = db.metadata.tables["places"]
     labdist = func.ST_Distance(places.c.coordinate, places.c.label_coordinate)
-    t0 = time.time()
+    unlabeled = []
     for p in db.engine.execute(select(
             [   places.c.id,
                 func.ST_AsGeoJSON(places.c.coordinate).label("geojson")],
             or_(labdist == None, labdist > DEST_RADIUS_MAX), # = clust dist / 2
             order_by=nullsfirst(desc(labdist)))):
         lon, lat = point_coordinates(p)
-        url = url_template.format(lat=lat, lon=lon)
-#        response = json.loads(urllib.request.urlopen(url, timeout=timeout).read())
-        response = requests.get(url, timeout=timeout).json()
-        names, nameslower = [], set()
-        for prop in ["street", "name"]:
-            for feat in response["features"]:
-                name = feat["properties"].get(prop)
-                name = name and re.split(",", name)[0]
-                if name and name.lower() not in nameslower:
-                    names.append(name)
-                    nameslower.add(name.lower())
-
-        label = " / ".join(names[:2])
-        coordstr = "{:.4f}/{:.4f}".format(lat, lon)
-        label = label or coordstr # fallback
-
-        # Show progress due to rate limiting. Force encoding in case of pipe
-        print(coordstr, label.encode("utf-8"))
-
-        db.engine.execute(places.update(
-            places.c.id == p.id,
-            {"label": label, "label_coordinate": "POINT(%f %f)" % (lon, lat)}))
-
-        # Enforce configured API queries per second rate limit
-        time.sleep(1./qps)
-
-        if time.time() - t0 >= timeout:
-            break
+        unlabeled.append((p.id, reverse_geocoder.cell(lon, lat), lon, lat))
+
+    labels = reverse_geocoder.labels([x[1] for x in unlabeled], deadline)
+    labeled = [
+        (pid, labels[cell] or "{:.4f}/{:.4f}".format(lat, lon), lon, lat)
+        for pid, cell, lon, lat in unlabeled if cell in labels] # fallback
+    if labeled:
+        db.engine.execute(text("""
+            UPDATE places SET
+                label = v.label,
+                label_coordinate =
+                    ST_SetSRID(ST_MakePoint(v.x, v.y), 4326)::geography
+            FROM unnest(
+                CAST(:ids AS integer[]),
+                CAST(:labels AS text[]),
+                CAST(:xs AS double precision[]),
+                CAST(:ys AS double precision[])) v (id, label, x, y)
+            WHERE places.id = v.id"""),
+            ids=[x[0] for x in labeled],
+            labels=[x[1] for x in labeled],
+            xs=[x[2] for x in labeled],
+            ys=[x[3] for x in labeled])
+    print("label_places: %d of %d places labeled" % (
+        len(labeled), len(unlabeled)))
 
 
 def filter_device_data(maxtime=None):
@@ -472,7 +856,7 @@ def filter_device_data(maxtime=None):
         time = get_max_time_from_table("time", "device_data_filtered", "user_id", id_row["id"])
         device_data_rows = data_points_by_user_id_after(
             id_row["id"], time, maxtime)
-        device_data_filterer = DeviceDataFilterer()
+        device_data_filterer = DeviceDataFilterer(planner=journey_planner)
         device_data_filterer.generate_filtered_data(
             device_data_rows, id_row["id"])
 
@@ -481,16 +865,17 @@ def generate_distance_data():
     user_ids =  db.engine.execute(text("SELECT id FROM users;"))
     last_midnight = datetime.datetime.now().replace(
         hour=0, minute=0, second=0, microsecond=0)
+    days = []
     for id_row in user_ids:
         time = get_max_time_from_table("time", "travelled_distances", "user_id", id_row["id"]) + timedelta(days=1)
-        update_user_distances(id_row["id"], time, last_midnight, False)
+        days += update_user_distances(id_row["id"], time, last_midnight, False)
 
     # update rankings based on ratings
-    query = text("""
-        SELECT DISTINCT time FROM travelled_distances
-        WHERE ranking IS NULL AND total_distance IS NOT NULL""")
-    for row in db.engine.execute(query):
-        generate_rankings(row[0])
+    generate_rankings(unranked=True)
+
+    # Certificate rankings viewed already may cover newly summarized days
+    if days:
+        refresh_certificate_rankings(min(days), max(days) + timedelta(days=1))
 
 
 def generate_global_statistics():
@@ -606,8 +991,8 @@ def generate_trips():
 
 
 def mass_transit_cleanup():
-    """Delete and vacuum mass transit live location data older than configured
-    interval, for example
+    """Drop daily partitions of mass transit live location data older than
+    configured interval, for example
         MASS_TRANSIT_LIVE_KEEP_DAYS = 7"""
 
     # keep all data if nothing configured
@@ -615,29 +1000,17 @@ def mass_transit_cleanup():
     if not days:
         return
 
-    # Snap deletion to daystart; be noisy as these can take quite a long time.
-    # Also delete martians from the future, no use in preferring those forever.
-    log.info("Deleting mass_transit_data older than %d days...", days)
-    query = text("""
-        DELETE FROM mass_transit_data
-        WHERE time < date_trunc('day', now() - interval ':days days')
-           OR time > date_trunc('day', now() + interval '2 days')""")
-    delrows = db.engine.execute(query, days=days).rowcount
-    log.info("Deleted %d rows of mass_transit_data.", delrows)
-    if not delrows:
-        return
-
-    # vacuum to reuse space; cannot be wrapped in transaction, so another conn
-    log.info("Vacuuming and analyzing mass_transit_data...")
-    query = text("VACUUM ANALYZE mass_transit_data")
-    conn = db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
-    conn.execute(query)
-    conn.close()
-    log.info("Vacuuming and analyzing mass_transit_data complete.")
+    # Also drop martians from the future, no use in preferring those forever.
+    today = datetime.date.today()
+    keep_from = today - datetime.timedelta(days=days)
+    keep_to = today + datetime.timedelta(days=2)
+    for name, day in mass_transit_data_partitions():
+        if keep_from <= day < keep_to:
+            continue
+        log.info("Dropping mass_transit_data partition %s.", name)
+        with db.engine.begin() as t:
+            t.execute(text('DROP TABLE "%s"' % name))
 
-    # Note, to free space rather than mark for reuse, e.g. after configuring a
-    # lower retention limit, use VACUUM FULL. Not done automatically due to
-    # locking, additional temporary space usage, and potential OOM on reindex.
 
 # Retrieve vehicle positions from Siri real-time interface
 # As of Aug-2018 HSL no longer uses this, other cities available
@@ -680,59 +1053,30 @@ def retrieve_hsl_data():
 #        log.warning(
 #            "No mass transit data received at %s" % datetime.datetime.now())
 
-    global push_vehicles
-    if len(push_vehicles) > 0:
-        global vehicle_push_lock
-        vehicle_push_lock.acquire()
+    rows = vehicle_buffer.take()
+    if rows:
         try:
-            db.engine.execute(mass_transit_data_table.insert(push_vehicles))
+            mass_transit_data_copy(rows)
         except Exception as e:
-            print('retrieve_hsl_data() Exception: ' + e.message)
-        push_vehicles = []
-        vehicle_push_lock.release()
+            print('retrieve_hsl_data() Exception: ' + str(e))
+    stats = vehicle_buffer.stats()
+    if stats["duplicates"] or stats["dropped"]:
+        print("retrieve_hsl_data(): %d rows, %d duplicates and %d dropped of "
+            "%d received since start" % (
+                len(rows), stats["duplicates"], stats["dropped"],
+                stats["received"]))
 
 # Process High-Frequency Positioning (HFP) MQTT callback
 def handle_mass_transit(client, userdata, message):
     # print("%s %s" % (message.topic, message.payload))
-    # b'{"VP":{"desi":"95","dir":"1","oper":22,"veh":888,"tst":"2018-08-12T19:15:01Z","tsi":1534101301,"spd":5.02,"hdg":277,"lat":60.219960,"long":25.099226,"acc":0.43,"dl":0,"odo":2053,"drst":0,"oday":"2018-08-12","jrn":463,"line":138,"start":"22:10"}}'
-    payload = json.loads(message.payload.decode('utf-8'))['VP']
-    longitude = payload['long']
-    latitude = payload['lat']
-    if (longitude != None) and (latitude != None):
-        topics = message.topic.split('/')
-        # print('topic', topic)
-        # print(payload)
-        vehicle_row = {'time': datetime.datetime.fromtimestamp(payload['tsi']),
-                       'line_name': payload['desi'],
-                       #'line_type': topics[5].upper(), # HFP V1
-                       'line_type': topics[6].upper(), # HFP V2                       
-                       'direction': int(payload['dir']),
-                       'coordinate': 'POINT(%f %f)' % (longitude, latitude),
-                       'vehicle_ref': str(payload['oper']) + '/' + str(payload['veh'])}
-        # Check for duplicate time+vehicle_ref - the DB constraint borks if violated in a single insert
-        global push_vehicles
-        not_duplicate = True
-        if len(push_vehicles) > 0:
-            cont_loop = True
-            i = 0
-            while cont_loop:
-                row = push_vehicles[i]
-                if (row['time'] == vehicle_row['time']) and (row['vehicle_ref'] == vehicle_row['vehicle_ref']):
-                    cont_loop = False
-                    not_duplicate = False
-                else:
-                    i += 1
-                    if i == len(push_vehicles): cont_loop = False
-        if not_duplicate:
-            if vehicle_row['line_type'] == 'METRO':
-                vehicle_row['line_type'] = 'SUBWAY'
-                #print("handle_mass_transit(): time:", vehicle_row['time'], "line_name:", vehicle_row['line_name'], " -> METRO changed to SUBWAY !!!")
-            global vehicle_push_lock
-            vehicle_push_lock.acquire()
-            push_vehicles.append(vehicle_row)
-            vehicle_push_lock.release()
-        # DB writes currently done with retrieve_hsl_data
-        # db.engine.execute(mass_transit_data_table.insert([vehicle_row]))
+    vehicle_row = hfp_vehicle_row(message.topic, message.payload)
+    if vehicle_row is not None:
+        # Duplicate time+vehicle_ref would bork the DB constraint in a single
+        # insert, and are skipped by the buffer. DB writes are done with
+        # retrieve_hsl_data.
+        added = vehicle_buffer.add(vehicle_row)
+        if added and vehicle_index is not None:
+            vehicle_index.add(vehicle_row)
 
 
 def mass_transit_disconnect(client, userdata, rc):
@@ -847,6 +1191,9 @@ def main_loop():
     while 1:
         time.sleep(1)
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["recluster_places"]:
+        recluster_places(dry_run="--dry-run" in sys.argv[2:])
+        sys.exit(0)
     initialize()
     try:
         main_loop()
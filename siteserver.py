@@ -495,7 +495,7 @@ def path_json():
 
     devices = db.metadata.tables["devices"]
     response = make_response(
-        common_path(request, db, devices.c.user_id==user_id))
+        common_path(request, db, devices.c.user_id==user_id, user_id))
     response.headers['Content-Type'] = 'application/json'
     return response
 
@@ -137,28 +137,100 @@ $$ language plpgsql volatile;
 create or replace function legs_deleted() returns trigger as $$
 begin perform legs_changed(old, null); return null; end;
 $$ language plpgsql volatile;
-drop trigger if exists legs_deleted_trigger on legs;
-create trigger legs_deleted_trigger after delete on legs
-for each row execute procedure legs_deleted();
 
 
 create or replace function legs_inserted() returns trigger as $$
 begin perform legs_changed(null, new); return null; end;
 $$ language plpgsql volatile;
-drop trigger if exists legs_inserted_trigger on legs;
-create trigger legs_inserted_trigger after insert on legs
-for each row execute procedure legs_inserted();
 
 
 create or replace function legs_updated() returns trigger as $$
 begin perform legs_changed(old, new); return null; end;
 $$ language plpgsql volatile;
+
+
+-- In deferred mode, statement triggers only queue the legs whose user or end
+-- coordinates changed, old and new, in leg_ends_queue. The scheduler later
+-- processes the queue per user with recluster_leg_ends, taking the same steps
+-- as the row triggers above would have.
+create or replace function legs_queue_deleted() returns trigger as $$
+begin
+    insert into leg_ends_queue (
+        leg, old_user_id, old_coordinate_start, old_coordinate_end,
+        cluster_start, cluster_end)
+    select id, user_id, coordinate_start, coordinate_end,
+        cluster_start, cluster_end
+    from oldlegs where user_id is not null order by id;
+    return null;
+end;
+$$ language plpgsql volatile;
+
+
+create or replace function legs_queue_inserted() returns trigger as $$
+begin
+    insert into leg_ends_queue (
+        leg, user_id, coordinate_start, coordinate_end)
+    select id, user_id, coordinate_start, coordinate_end
+    from newlegs where user_id is not null order by id;
+    return null;
+end;
+$$ language plpgsql volatile;
+
+
+create or replace function legs_queue_updated() returns trigger as $$
+begin
+    insert into leg_ends_queue (
+        leg, old_user_id, old_coordinate_start, old_coordinate_end,
+        cluster_start, cluster_end, user_id, coordinate_start, coordinate_end)
+    select o.id, o.user_id, o.coordinate_start, o.coordinate_end,
+        o.cluster_start, o.cluster_end,
+        n.user_id, n.coordinate_start, n.coordinate_end
+    from oldlegs o join newlegs n on n.id = o.id
+    where (o.user_id is not null or n.user_id is not null)
+      and (o.user_id is distinct from n.user_id
+        or o.coordinate_start is distinct from n.coordinate_start
+        or o.coordinate_end is distinct from n.coordinate_end)
+    order by o.id;
+    return null;
+end;
+$$ language plpgsql volatile;
+
+
+-- Install the row or queueing triggers according to LEG_ENDS_DEFERRED.
+drop trigger if exists legs_deleted_trigger on legs;
+drop trigger if exists legs_inserted_trigger on legs;
 drop trigger if exists legs_updated_trigger on legs;
-create trigger legs_updated_trigger after update on legs
-for each row execute procedure legs_updated();
+drop trigger if exists legs_queue_deleted_trigger on legs;
+drop trigger if exists legs_queue_inserted_trigger on legs;
+drop trigger if exists legs_queue_updated_trigger on legs;
+do $$ begin
+    if :deferred then
+        create trigger legs_queue_deleted_trigger after delete on legs
+        referencing old table as oldlegs
+        for each statement execute procedure legs_queue_deleted();
+
+        create trigger legs_queue_inserted_trigger after insert on legs
+        referencing new table as newlegs
+        for each statement execute procedure legs_queue_inserted();
+
+        create trigger legs_queue_updated_trigger after update on legs
+        referencing old table as oldlegs new table as newlegs
+        for each statement execute procedure legs_queue_updated();
+    else
+        create trigger legs_deleted_trigger after delete on legs
+        for each row execute procedure legs_deleted();
+
+        create trigger legs_inserted_trigger after insert on legs
+        for each row execute procedure legs_inserted();
+
+        create trigger legs_updated_trigger after update on legs
+        for each row execute procedure legs_updated();
+    end if;
+end $$;
 
 
 -- Function that can be called to cluster legs created before leg_ends set up.
+-- Legs still queued in deferred mode are left to recluster_leg_ends.
 create or replace function legs_cluster(lim integer) returns void as $$
 declare
     leg legs%rowtype;
@@ -167,6 +239,7 @@ begin
         where user_id is not null
           and coordinate_start is not null
           and cluster_start is null
+          and not exists (select 1 from leg_ends_queue q where q.leg = legs.id)
         limit lim
     loop
         perform legs_link_start(leg);
@@ -176,6 +249,7 @@ begin
         where user_id is not null
           and coordinate_end is not null
           and cluster_end is null
+          and not exists (select 1 from leg_ends_queue q where q.leg = legs.id)
         limit lim
     loop
         perform legs_link_end(leg);
@@ -0,0 +1,106 @@
+-- Count changes to each user's legs, their modes, and the points they cover,
+-- for invalidating cached renderings of them. Statement level, so that bulk
+-- writes bump once.
+create or replace function legs_revisions_bump(users integer[])
+returns void as $$
+    insert into legs_revisions (user_id, revision)
+    select distinct u, 1 from unnest(users) u where u is not null order by u
+    on conflict (user_id)
+    do update set revision = legs_revisions.revision + 1;
+$$ language sql volatile;
+
+
+-- Transition tables are named alike for each event, so the same function
+-- serves all of them.
+create or replace function legs_revisions_legs() returns trigger as $$
+begin
+    perform legs_revisions_bump(array(
+        select distinct d.user_id
+        from changed l join devices d on d.id = l.device_id));
+    return null;
+end;
+$$ language plpgsql volatile;
+
+drop trigger if exists legs_revisions_deleted_trigger on legs;
+create trigger legs_revisions_deleted_trigger after delete on legs
+referencing old table as changed
+for each statement execute procedure legs_revisions_legs();
+
+drop trigger if exists legs_revisions_inserted_trigger on legs;
+create trigger legs_revisions_inserted_trigger after insert on legs
+referencing new table as changed
+for each statement execute procedure legs_revisions_legs();
+
+drop trigger if exists legs_revisions_updated_trigger on legs;
+create trigger legs_revisions_updated_trigger after update on legs
+referencing new table as changed
+for each statement execute procedure legs_revisions_legs();
+
+
+-- Modes deleted along with their legs find no leg here, but the leg deletion
+-- bumped already.
+create or replace function legs_revisions_modes() returns trigger as $$
+begin
+    perform legs_revisions_bump(array(
+        select distinct d.user_id
+        from changed m
+            join legs l on l.id = m.leg
+            join devices d on d.id = l.device_id));
+    return null;
+end;
+$$ language plpgsql volatile;
+
+drop trigger if exists legs_revisions_modes_deleted_trigger on modes;
+create trigger legs_revisions_modes_deleted_trigger after delete on modes
+referencing old table as changed
+for each statement execute procedure legs_revisions_modes();
+
+drop trigger if exists legs_revisions_modes_inserted_trigger on modes;
+create trigger legs_revisions_modes_inserted_trigger after insert on modes
+referencing new table as changed
+for each statement execute procedure legs_revisions_modes();
+
+drop trigger if exists legs_revisions_modes_updated_trigger on modes;
+create trigger legs_revisions_modes_updated_trigger after update on modes
+referencing new table as changed
+for each statement execute procedure legs_revisions_modes();
+
+
+-- Points inserted late or deleted as duplicates change the paths of days
+-- already covered by legs. Points after the end of the user's legs show only
+-- in the raw trace, which is not cached, so those do not bump. This runs on
+-- every upload: each device changed costs a primary key lookup and a probe of
+-- idx_legs_user_id_time_end_time_start, and uploads of new points, which
+-- follow the legs, write nothing.
+create or replace function legs_revisions_device_data() returns trigger as $$
+declare
+    users integer[];
+begin
+    users := array(
+        select d.user_id
+        from (
+            select device_id, min(time) time_min
+            from changed group by device_id) p
+        join devices d on d.id = p.device_id
+        where p.time_min <= (
+            select max(l.time_end) from legs l where l.user_id = d.user_id));
+    if users <> '{}' then
+        perform legs_revisions_bump(users);
+    end if;
+    return null;
+end;
+$$ language plpgsql volatile;
+
+drop trigger if exists legs_revisions_device_data_deleted_trigger
+on device_data;
+create trigger legs_revisions_device_data_deleted_trigger
+after delete on device_data
+referencing old table as changed
+for each statement execute procedure legs_revisions_device_data();
+
+drop trigger if exists legs_revisions_device_data_inserted_trigger
+on device_data;
+create trigger legs_revisions_device_data_inserted_trigger
+after insert on device_data
+referencing new table as changed
+for each statement execute procedure legs_revisions_device_data();
@@ -0,0 +1,21 @@
+-- Create the daily partition of mass_transit_data for given day if missing.
+-- Partitioned tables cannot have indexes of their own in PostgreSQL 10, so
+-- the uniqueness and lookup indexes are created on each partition.
+create or replace function mass_transit_data_partition(day date)
+returns void as $$
+declare
+    part text := 'mass_transit_data_p' || to_char(day, 'YYYYMMDD');
+begin
+    if to_regclass(part) is not null then return; end if;
+    execute format(
+        'create table if not exists %I partition of mass_transit_data'
+        ' for values from (%L) to (%L)',
+        part, day, day + 1);
+    execute format(
+        'create unique index if not exists %I on %I (time, vehicle_ref)',
+        part || '_time_vehicle_ref', part);
+    execute format(
+        'create index if not exists %I on %I (time, coordinate)',
+        part || '_time_coordinate', part);
+end;
+$$ language plpgsql volatile;